@@ -13,6 +13,12 @@ import time
 import shutil
 import glob
 import pathlib
+import threading
+import asyncio
+import json
+import hashlib
+from collections import deque
+from contextlib import contextmanager
 
 import tqdm
 import numpy as np
@@ -20,18 +26,54 @@ import tensorflow as tf
 from tensorflow.data import Dataset
 from sklearn.model_selection import train_test_split
 
-from finetune.utils import interpolate_pos_embed, list_transpose
+from finetune.utils import interpolate_pos_embed, list_transpose, iter_batches
 from finetune.encoding import EncodedOutput
 from finetune.input_pipeline import ENCODER
+from finetune.tfrecords import EncodedDataset
 from finetune.config import get_default_config
 from finetune.saver import Saver
 from finetune.errors import FinetuneError
 from finetune.model import get_model_fn, PredictMode
 from finetune.download import download_data_if_required
-from finetune.estimator_utils import PatchedParameterServerStrategy
+from finetune.estimator_utils import PatchedParameterServerStrategy, FeedHook
+from finetune.export import export_saved_model
+from finetune.batching import MicroBatcher
+from finetune.prediction_cache import PredictionCache
 
 JL_BASE = os.path.join(os.path.dirname(__file__), "model", "Base_model.jl")
 
+# files written by `BaseModel.featurize_to_file`
+FEATURES_FILENAME = "features.npy"
+SEQUENCE_FEATURES_FILENAME = "sequence_features.bin"
+OFFSETS_FILENAME = "offsets.npy"
+LENGTHS_FILENAME = "lengths.npy"
+PROGRESS_FILENAME = "progress.json"
+# number of examples written between each record of progress
+FEATURIZE_TO_FILE_INTERVAL = 1024
+# settings that outputs depend on besides the weights and the encoder, and so part of the prediction cache key.
+# `_threshold` is the threshold passed to `MultiLabelClassifier.predict`.
+FINGERPRINT_SETTINGS = (
+    "max_length", "chunk_long_sequences", "pad_token", "subtoken_predictions", "multi_label_sequences",
+    "multi_label_threshold", "_threshold", "seq_num_heads", "interpolate_pos_embed", "n_heads", "n_layer",
+    "act_fn", "n_embed"
+)
+
+
+def _restore_order(predictions, windows):
+    """
+    Puts the outputs of length sorted batches back in input order, a window at a time, see
+    `BasePipeline.length_sorted_batches`.
+    """
+    predictions = iter(predictions)
+    for first in predictions:
+        # the window is recorded when it is read, before any of its outputs exist
+        order = windows.popleft()
+        window = [None] * len(order)
+        for i, prediction in zip(order, itertools.chain([first], predictions)):
+            window[i] = prediction
+        yield from window
+
+
 class BaseModel(object, metaclass=ABCMeta):
     """
     A sklearn-style task agnostic base class for finetuning a Transformer language model.
@@ -72,6 +114,14 @@ class BaseModel(object, metaclass=ABCMeta):
         # Initializes the non-serialized bits of the class.
         self._set_random_seed(self.config.seed)
         self.estimator_ = None
+        # state of the sessions kept open by `cached_predict`, per thread
+        self._cached = threading.local()
+        self._weights_version = 0
+        # `MicroBatcher`s serving the coroutine APIs, by method name
+        self._batchers = {}
+        self._batchers_lock = threading.Lock()
+        self._prediction_cache = None
+        self._weights_fingerprint = (None, None)
         if self.config.tensorboard_folder is not None:
             self.estimator_dir = os.path.abspath(
                 os.path.join(self.config.tensorboard_folder, str(int(time.time())))
@@ -136,6 +186,8 @@ class BaseModel(object, metaclass=ABCMeta):
                 )
             )
         batch_size = batch_size or self.config.batch_size
+        # weights are about to change, so sessions kept open by `cached_predict` are stale
+        self._close_cached_predictor()
 
         val_input_fn, train_input_fn, val_size, val_interval = self.input_pipeline.get_train_input_fns(Xs, Y, batch_size=batch_size)
         if val_size <= 10 and self.config.keep_best_model:
@@ -168,12 +220,24 @@ class BaseModel(object, metaclass=ABCMeta):
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
             estimator.train(train_input_fn, hooks=train_hooks, steps=num_steps)
+        self._weights_version += 1
 
-    def get_estimator(self, force_build_lm=False):
-        conf = tf.ConfigProto(
-            allow_soft_placement=self.config.soft_device_placement,
-            log_device_placement=self.config.log_device_placement,
-        )
+    def write_tfrecords(self, path, Xs, Y=None, n_shards=1):
+        """
+        Encodes a dataset once to sharded TFRecord files, so that it can be trained on without re-encoding each epoch
+        and without holding it in memory.  Inputs are in the format accepted by `finetune`.
+
+        :param path: Directory to write the shards to.
+        :param Xs: Examples, or a callable returning an iterator over examples.
+        :param Y: Optionally, targets or a callable returning an iterator over targets.
+        :param n_shards: Number of files to spread the examples over.
+        :return: An `EncodedDataset` that can be passed to `finetune`, `predict` or `featurize` in place of `Xs`.
+        """
+        self.input_pipeline.write_tfrecords(path, Xs, Y=Y, n_shards=n_shards)
+        return EncodedDataset(path)
+
+    def get_estimator(self, force_build_lm=False, generation=None, sequence_features=False):
+        conf = self._session_config()
         num_gpus = len(self.config.visible_gpus)
         if num_gpus > 1:
             distribute_strategy = PatchedParameterServerStrategy(num_gpus_per_worker=num_gpus)
@@ -192,42 +256,259 @@ class BaseModel(object, metaclass=ABCMeta):
             keep_checkpoint_max=1
         )
 
-        model_fn = get_model_fn(
+        return tf.estimator.Estimator(
+            model_dir=self.estimator_dir,
+            model_fn=self._get_model_fn(
+                force_build_lm=force_build_lm, generation=generation, sequence_features=sequence_features
+            ),
+            config=config,
+            params=self.config
+        )
+
+    def _get_model_fn(self, force_build_lm=False, build_lm=None, generation=None, sequence_features=False):
+        if build_lm is None:
+            build_lm = force_build_lm or self.config.lm_loss_coef > 0.0 or self.input_pipeline.target_dim is None
+        return get_model_fn(
             target_model_fn=self._target_model,
             predict_op=self._predict_op,
             predict_proba_op=self._predict_proba_op,
             build_target_model=self.input_pipeline.target_dim is not None,
-            build_lm=force_build_lm or self.config.lm_loss_coef > 0.0 or self.input_pipeline.target_dim is None,
+            build_lm=build_lm,
             encoder=ENCODER,
             target_dim=self.input_pipeline.target_dim,
             label_encoder=self.input_pipeline.label_encoder,
-            saver=self.saver
+            saver=self.saver,
+            generation=generation,
+            sequence_features=sequence_features
         )
-        return tf.estimator.Estimator(
-            model_dir=self.estimator_dir,
-            model_fn=model_fn,
-            config=config,
-            params=self.config
+
+    def _session_config(self):
+        return tf.ConfigProto(
+            allow_soft_placement=self.config.soft_device_placement,
+            log_device_placement=self.config.log_device_placement,
         )
 
-    def _inference(self, Xs, mode=None):
-        estimator = self.get_estimator()
-        input_func = self.input_pipeline.get_predict_input_fn(Xs)
-        length = len(Xs) if not callable(Xs) else None
+    def export(self, path):
+        """
+        Writes the model to `path` as a self-contained SavedModel, with the finetuned weights folded into the graph,
+        that can be served by tensorflow alone or loaded with `finetune.export.load_exported`.
 
-        pred_gen = list(
-            map(
-                lambda y: y[mode] if mode else y,
-                tqdm.tqdm(
-                    estimator.predict(
-                        input_fn=input_func, predict_keys=mode
-                    ),
-                    total=length,
-                    desc="Inference"
-                )
+        There is a signature per `PredictMode` the model supports -- "NORM", "PROBA" and "FEAT" -- each taking the
+        encoded token ids ("tokens") and sequence lengths ("length") of a batch.
+
+        :param path: Directory to write the model to.  Must not already exist.
+        """
+        self.input_pipeline._resolve_max_length()
+        export_saved_model(
+            path,
+            model_fn=self._get_model_fn(build_lm=False),
+            input_pipeline=self.input_pipeline,
+            config=self.config,
+            session_config=self._session_config()
+        )
+
+    @contextmanager
+    def cached_predict(self):
+        """
+        Within this context, `predict`, `predict_proba` and `featurize` share a single graph and session, which are
+        built on the first call and closed on exit.  Later calls only pay for encoding and the forward pass, so this
+        suits serving many small requests.  Each thread that enters the context gets a session of its own.
+
+        Usage:
+            with model.cached_predict():
+                for text in stream:
+                    model.predict([text])
+        """
+        self._cached.enabled = True
+        try:
+            yield self
+        finally:
+            self._cached.enabled = False
+            self._close_cached_predictor()
+
+    def _close_cached_predictor(self):
+        predictions = getattr(self._cached, "predictions", None)
+        if predictions is not None:
+            # closing the generator exits the estimator's session
+            predictions.close()
+        self._cached.predictions = None
+        self._cached.batches = None
+
+    def _cached_inference_stream(self, Xs, mode=None, input_pipeline=None):
+        input_pipeline = input_pipeline or self.input_pipeline
+        if getattr(self._cached, "weights_version", None) != self._weights_version:
+            # the model has been finetuned since this thread's session was built
+            self._close_cached_predictor()
+        if getattr(self._cached, "predictions", None) is None:
+            self._cached.batches = deque()
+            self._cached.weights_version = self._weights_version
+            estimator = self.get_estimator()
+            feed_hook = FeedHook(self._cached.batches)
+            self._cached.predictions = estimator.predict(
+                input_fn=input_pipeline.get_cached_predict_input_fn(feed_hook),
+                hooks=[feed_hook],
+                yield_single_examples=False
             )
+
+        windows = deque()
+        if self.config.sort_by_length:
+            batches = input_pipeline.length_sorted_batches(Xs, windows)
+        else:
+            batches = input_pipeline.feature_batches(Xs)
+
+        def predictions():
+            for batch in batches:
+                self._cached.batches.append(batch)
+                batch_preds = next(self._cached.predictions)
+                if mode:
+                    yield from batch_preds[mode]
+                else:
+                    yield from (dict(zip(batch_preds, values)) for values in zip(*batch_preds.values()))
+
+        if self.config.sort_by_length:
+            yield from _restore_order(predictions(), windows)
+        else:
+            yield from predictions()
+
+    def _batcher(self, method):
+        with self._batchers_lock:
+            if method not in self._batchers:
+                self._batchers[method] = MicroBatcher(self, method=method)
+            return self._batchers[method]
+
+    def _close_batchers(self):
+        batchers = getattr(self, "_batchers", None)
+        if not batchers:
+            return
+        with self._batchers_lock:
+            for batcher in batchers.values():
+                batcher.close()
+            batchers.clear()
+
+    async def _abatched(self, method, *args):
+        # each example is queued separately, so examples awaited concurrently by different coroutines share batches.
+        # `args` are the positional arguments of `method`, each holding one element per example.
+        batcher = self._batcher(method)
+        return await asyncio.gather(*[asyncio.wrap_future(batcher.submit(*X)) for X in zip(*args)])
+
+    @property
+    def prediction_cache(self):
+        """
+        The `PredictionCache` holding outputs when `config.prediction_cache_mb` or `config.prediction_cache_dir` is set,
+        otherwise None.
+        """
+        max_bytes = int(self.config.prediction_cache_mb * 2 ** 20)
+        cache_dir = self.config.prediction_cache_dir
+        if not max_bytes and cache_dir is None:
+            return None
+        cache = self._prediction_cache
+        if cache is None or cache.max_bytes != max_bytes or cache.cache_dir != cache_dir:
+            cache = self._prediction_cache = PredictionCache(max_bytes, cache_dir)
+        return cache
+
+    def _model_fingerprint(self):
+        """
+        A hash of the weights, the encoder and the settings that outputs are computed with, see `FINGERPRINT_SETTINGS`.
+        """
+        variables = self.saver.variables
+        state = (self._weights_version, id(variables))
+        if self._weights_fingerprint[0] != state:
+            # hashing the weights takes a moment, so is only repeated once they have changed
+            weights_hash = hashlib.sha1()
+            if variables is None:
+                weights_hash.update(str(self.config.base_model_path).encode("utf-8"))
+            else:
+                for name in sorted(variables):
+                    weights_hash.update(name.encode("utf-8"))
+                    weights_hash.update(np.ascontiguousarray(variables[name]))
+            self._weights_fingerprint = (state, weights_hash.hexdigest())
+
+        settings = json.dumps([(key, self.config.get(key)) for key in FINGERPRINT_SETTINGS])
+        return hashlib.sha1(
+            (self._weights_fingerprint[1] + self.input_pipeline.encoder.fingerprint + settings).encode("utf-8")
+        ).hexdigest()
+
+    def _with_prediction_cache(self, name, Xs, compute):
+        """
+        Yields the output of each of `Xs`, only passing the examples missing from the prediction cache to `compute`,
+        each once however often it is repeated.  `compute` must yield one output per example it is given.
+
+        Generators, callables and `EncodedDataset`s are passed straight through, as they are read lazily.
+        """
+        cache = self.prediction_cache
+        if cache is None or callable(Xs) or isinstance(Xs, EncodedDataset) or not hasattr(Xs, "__len__"):
+            yield from compute(Xs)
+            return
+
+        Xs = list(Xs)
+        self.input_pipeline._resolve_max_length(Xs)
+        fingerprint = self._model_fingerprint()
+        keys = [cache.key(fingerprint, name, X) for X in Xs]
+        outputs = {}
+        misses = []
+        for key, X in zip(keys, Xs):
+            if key in outputs:
+                continue
+            found, value = cache.get(key)
+            outputs[key] = value
+            if not found:
+                misses.append((key, X))
+
+        # misses are computed in the order they first occur, so each is ready by the time it is needed
+        missing_keys = set(key for key, _ in misses)
+        computed = zip((key for key, _ in misses), compute([X for _, X in misses]))
+        for key in keys:
+            while key in missing_keys:
+                computed_key, value = next(computed)
+                cache.put(computed_key, value)
+                outputs[computed_key] = value
+                missing_keys.discard(computed_key)
+            yield outputs[key]
+
+    def _inference_stream(self, Xs, mode=None, sequence_features=False):
+        """
+        Yields the model outputs for each example as its batch finishes, so that memory use does not grow with the
+        number of examples.
+
+        :param sequence_features: Whether outputs also include the features of each token, see `featurize_to_file`.
+        """
+        if sequence_features:
+            # too large to be worth caching, and only asked for to be written out
+            return self._run_inference(Xs, mode, sequence_features=True)
+        return self._with_prediction_cache(mode, Xs, lambda Xs: self._run_inference(Xs, mode))
+
+    def _run_inference(self, Xs, mode=None, input_pipeline=None, sequence_features=False):
+        # `input_pipeline` is a copy of the model's pipeline, for callers that need their own view of the encoding
+        input_pipeline = input_pipeline or self.input_pipeline
+        # the cached session's graph has no sequence features, so they are computed by an estimator of their own
+        if getattr(self._cached, "enabled", False) and not sequence_features:
+            yield from self._cached_inference_stream(Xs, mode, input_pipeline=input_pipeline)
+            return
+
+        Xs = input_pipeline.single_pass_input(Xs)
+        estimator = self.get_estimator(sequence_features=sequence_features)
+        sort = self.config.sort_by_length and not isinstance(Xs, EncodedDataset)
+        windows = deque()
+        if sort:
+            input_func = input_pipeline.get_sorted_predict_input_fn(Xs, windows)
+        else:
+            input_func = input_pipeline.get_predict_input_fn(Xs)
+        length = len(Xs) if not callable(Xs) else None
+
+        predictions = tqdm.tqdm(
+            estimator.predict(
+                input_fn=input_func, predict_keys=mode
+            ),
+            total=length,
+            desc="Inference"
         )
-        return pred_gen
+        predictions = (y[mode] if mode else y for y in predictions)
+        if sort:
+            predictions = _restore_order(predictions, windows)
+        yield from predictions
+
+    def _inference(self, Xs, mode=None):
+        return list(self._inference_stream(Xs, mode))
 
     def fit(self, *args, **kwargs):
         """ An alias for finetune. """
@@ -240,6 +521,16 @@ class BaseModel(object, metaclass=ABCMeta):
     def predict(self, Xs):
         return self._predict(Xs)
 
+    def iter_predict(self, Xs):
+        """
+        A generator version of `predict`, that yields the prediction for each example as soon as its batch finishes.
+
+        :param Xs: An iterable of examples in the format accepted by `predict`, which is read lazily.
+        """
+        raw_preds = self._inference_stream(Xs, PredictMode.NORMAL)
+        for batch in iter_batches(raw_preds, self.config.batch_size):
+            yield from self.input_pipeline.label_encoder.inverse_transform(np.asarray(batch))
+
     def _predict_proba(self, Xs):
         """
         Produce raw numeric outputs for proba predictions
@@ -251,19 +542,29 @@ class BaseModel(object, metaclass=ABCMeta):
         """
         The base method for predicting from the model.
         """
-        raw_probas = self._predict_proba(*args, **kwargs)
-        classes = self.input_pipeline.label_encoder.classes_
+        return list(self.iter_predict_proba(*args, **kwargs))
 
-        formatted_predictions = []
-        for probas in raw_probas:
-            formatted_predictions.append(
-                dict(zip(classes, probas))
-            )
-        return formatted_predictions
+    def iter_predict_proba(self, Xs):
+        """
+        A generator version of `predict_proba`, that yields the class probabilities of each example as soon as its
+        batch finishes.
+
+        :param Xs: An iterable of examples in the format accepted by `predict_proba`, which is read lazily.
+        """
+        classes = self.input_pipeline.label_encoder.classes_
+        for probas in self._inference_stream(Xs, PredictMode.PROBAS):
+            yield dict(zip(classes, probas))
 
     def _featurize(self, Xs):
-        raw_preds = self._inference(Xs, PredictMode.FEATURIZE)
-        return np.asarray(raw_preds)
+        return np.asarray(list(self.iter_featurize(Xs)))
+
+    def iter_featurize(self, Xs):
+        """
+        A generator version of `featurize`, that yields the features of each example as soon as its batch finishes.
+
+        :param Xs: An iterable of examples in the format accepted by `featurize`, which is read lazily.
+        """
+        return self._inference_stream(Xs, PredictMode.FEATURIZE)
 
     @abstractmethod
     def featurize(self, *args, **kwargs):
@@ -273,6 +574,157 @@ class BaseModel(object, metaclass=ABCMeta):
         """
         return self._featurize(*args, **kwargs)
 
+    def featurize_to_file(self, Xs, path, dtype=np.float16, include_sequence=False):
+        """
+        Writes the features of each example to memory-mapped numpy files in the folder `path`, rather than holding them
+        in memory, for embedding very large datasets.  If interrupted, calling again with the same examples and model
+        picks up from the last examples recorded as written.
+
+        The folder holds;
+            features.npy: the pooled features, of shape [n_examples, ...] as returned by `featurize`.
+            progress.json: the number of examples written so far, along with the shapes of the files below.
+
+        and if `include_sequence`;
+            sequence_features.bin: the features of every token of every example, without padding, of shape
+                [n_tokens, n_embed].  Read it with `np.memmap(path, dtype, mode="r", shape=(offsets[-1], n_embed))`.
+            offsets.npy: the row of sequence_features.bin that each example starts at, of shape [n_examples + 1].
+            lengths.npy: the number of tokens of each input of each example, of shape [n_examples, ...].
+
+        :param Xs: A list or array of examples in the format accepted by `featurize`.
+        :param path: Folder to write to.  Created if it does not exist.
+        :param dtype: Numpy dtype the features are stored as.
+        :param include_sequence: Whether to also store the features of each token.
+        :returns: features.npy, opened as a read-only memory-mapped array.
+        """
+        if callable(Xs) or isinstance(Xs, EncodedDataset) or not hasattr(Xs, "__len__"):
+            raise FinetuneError("`featurize_to_file` requires a list or array of examples, so that it can resume")
+        if not len(Xs):
+            raise FinetuneError("`featurize_to_file` requires at least one example")
+        self.input_pipeline._resolve_max_length(Xs)
+        os.makedirs(path, exist_ok=True)
+        dtype = np.dtype(dtype)
+        progress_path = os.path.join(path, PROGRESS_FILENAME)
+        features_path = os.path.join(path, FEATURES_FILENAME)
+        sequence_path = os.path.join(path, SEQUENCE_FEATURES_FILENAME)
+        progress = {
+            "fingerprint": self._model_fingerprint(),
+            "n_examples": len(Xs),
+            "dtype": dtype.str,
+            "include_sequence": include_sequence,
+            "n_done": 0,
+            "n_tokens": 0
+        }
+
+        features = offsets = lengths = None
+        if os.path.exists(progress_path):
+            with open(progress_path) as fp:
+                written = json.load(fp)
+            for key in ("fingerprint", "n_examples", "dtype", "include_sequence"):
+                if written[key] != progress[key]:
+                    raise FinetuneError(
+                        "{} holds features of other examples or from another model or settings ({} differs), "
+                        "remove it to start again".format(path, key)
+                    )
+            progress = written
+            features = np.load(features_path, mmap_mode="r+")
+            if include_sequence:
+                offsets = np.load(os.path.join(path, OFFSETS_FILENAME), mmap_mode="r+")
+                lengths = np.load(os.path.join(path, LENGTHS_FILENAME), mmap_mode="r+")
+
+        if progress["n_done"] == progress["n_examples"]:
+            return np.load(features_path, mmap_mode="r")
+
+        remaining = itertools.islice(Xs, progress["n_done"], None)
+        if include_sequence:
+            sequence_file = open(sequence_path, "ab")
+            # drops any tokens written after the last record of progress
+            sequence_file.truncate(progress["n_tokens"] * progress.get("n_embed", 0) * dtype.itemsize)
+            outputs = self._inference_stream(remaining, sequence_features=True)
+        else:
+            features_stream = self._inference_stream(remaining, PredictMode.FEATURIZE)
+            outputs = ({PredictMode.FEATURIZE: output} for output in features_stream)
+
+        try:
+            for batch in iter_batches(outputs, FEATURIZE_TO_FILE_INTERVAL):
+                start = progress["n_done"]
+                end = start + len(batch)
+                if features is None:
+                    # the files are created once the shape of the features is known
+                    shape = np.shape(batch[0][PredictMode.FEATURIZE])
+                    features = np.lib.format.open_memmap(
+                        features_path, mode="w+", dtype=dtype, shape=(progress["n_examples"],) + shape
+                    )
+                    if include_sequence:
+                        progress["n_embed"] = np.shape(batch[0][PredictMode.SEQUENCE_FEATURIZE])[-1]
+                        offsets = np.lib.format.open_memmap(
+                            os.path.join(path, OFFSETS_FILENAME), mode="w+", dtype=np.int64,
+                            shape=(progress["n_examples"] + 1,)
+                        )
+                        lengths = np.lib.format.open_memmap(
+                            os.path.join(path, LENGTHS_FILENAME), mode="w+", dtype=np.int32,
+                            shape=(progress["n_examples"],) + np.shape(batch[0][PredictMode.LENGTH])
+                        )
+
+                features[start:end] = np.stack([output[PredictMode.FEATURIZE] for output in batch])
+                features.flush()
+                if include_sequence:
+                    for i, output in enumerate(batch, start):
+                        seq_feats = output[PredictMode.SEQUENCE_FEATURIZE]
+                        seq_feats = seq_feats.reshape((-1,) + seq_feats.shape[-2:])
+                        example_lengths = np.ravel(output[PredictMode.LENGTH])
+                        tokens = np.concatenate(
+                            [input_feats[:length] for input_feats, length in zip(seq_feats, example_lengths)]
+                        )
+                        sequence_file.write(tokens.astype(dtype).tobytes())
+                        offsets[i] = progress["n_tokens"]
+                        progress["n_tokens"] += len(tokens)
+                        offsets[i + 1] = progress["n_tokens"]
+                        lengths[i] = output[PredictMode.LENGTH]
+                    sequence_file.flush()
+                    offsets.flush()
+                    lengths.flush()
+
+                # progress is recorded only once the examples are written, and replaced whole
+                progress["n_done"] = end
+                fd, tmp_path = tempfile.mkstemp(dir=path)
+                with os.fdopen(fd, "w") as fp:
+                    json.dump(progress, fp)
+                os.replace(tmp_path, progress_path)
+        finally:
+            if include_sequence:
+                sequence_file.close()
+
+        return np.load(features_path, mmap_mode="r")
+
+    async def apredict(self, Xs):
+        """
+        A coroutine version of `predict` for use within asyncio services.  Encoding and inference run on a background
+        thread that keeps a session open, and the examples of concurrent awaits are batched together.  The thread runs
+        until `close` is called.
+
+        :param Xs: Examples in the format accepted by `predict`.
+        :returns: list of predictions.
+        """
+        return await self._abatched("predict", Xs)
+
+    async def apredict_proba(self, Xs):
+        """
+        A coroutine version of `predict_proba`, see `apredict`.
+
+        :param Xs: Examples in the format accepted by `predict_proba`.
+        :returns: list of dictionaries.  Each dictionary maps from a class label to its assigned class probability.
+        """
+        return await self._abatched("predict_proba", Xs)
+
+    async def afeaturize(self, Xs):
+        """
+        A coroutine version of `featurize`, see `apredict`.
+
+        :param Xs: Examples in the format accepted by `featurize`.
+        :returns: np.array of features of shape (n_examples, embedding_size).
+        """
+        return np.asarray(await self._abatched("featurize", Xs))
+
     @classmethod
     def get_eval_fn(cls):
         raise NotImplementedError("No default eval function is given, please pass an explicit eval fn to grid_search")
@@ -292,46 +744,58 @@ class BaseModel(object, metaclass=ABCMeta):
     def generate_text(self, seed_text='', max_length=None, use_extra_toks=True):
         """
         Performs a prediction on the Language modeling objective given some seed text. It uses a noisy greedy decoding.
-        Temperature parameter for decoding is set in the config.
+        Temperature parameter for decoding is set in the config.  Tokens are decoded incrementally, reusing the
+        attention keys and values of earlier tokens, so each new token costs a single position of the transformer.
         :param max_length: The maximum length to decode to.
         :param seed_text: Defaults to the empty string. This will form the starting point to begin modelling
         :return: A string containing the generated text.
         """
-        def dataset_encoded():
-            while not dataset_encoded.finished:
-                yield {"tokens": arr_encoded.token_ids, "mask": arr_encoded.mask}
+        return self.generate_texts([seed_text], max_length=max_length, use_extra_toks=use_extra_toks)[0]
 
-        dataset_encoded.finished = False
+    def generate_texts(self, seeds, num_beams=1, max_length=None, top_k=None, use_extra_toks=True):
+        """
+        Continues each of several seed texts with the language model, decoding batches of seeds together.  Each
+        continuation ends independently, when it reaches the classify token or `max_length` tokens.
+        :param seeds: A list of seed texts, which may be empty strings when `use_extra_toks` is set.
+        :param num_beams: The number of hypotheses a beam search keeps for each seed, or 1 to sample tokens with the
+            temperature set by `config.lm_temp`.
+        :param max_length: The maximum length to decode to.
+        :param top_k: When sampling, only sample from the `top_k` most likely tokens.
+        :param use_extra_toks: Whether the start and classify tokens are used to delimit the text.
+        :return: A list of strings containing the generated text for each seed.
+        """
+        self.input_pipeline._resolve_max_length()
+        start = [ENCODER.start] if use_extra_toks else []
+        seeds_encoded = []
+        for seed_text in seeds:
+            encoded = self.input_pipeline.encoder._encode([seed_text])
+            if len(encoded.token_ids) == 0 and not use_extra_toks:
+                raise ValueError("If you are not using the extra tokens, you must provide some non-empty seed text")
+            token_ids = start + encoded.token_ids.tolist()[:self.config.max_length - len(start)]
+            arr_encoded = self.input_pipeline._array_format(
+                EncodedOutput(token_ids=token_ids), length=self.config.max_length
+            )
+            seeds_encoded.append({"tokens": arr_encoded.token_ids, "length": arr_encoded.length})
 
         def get_input_fn():
             types, shapes = self.input_pipeline.feed_shape_type_def()
-            tf_dataset = Dataset.from_generator(dataset_encoded, types[0], shapes[0])
-            return tf_dataset.batch(1)
+            tf_dataset = Dataset.from_generator(lambda: iter(seeds_encoded), types[0], shapes[0])
+            return tf_dataset.batch(self.config.batch_size)
 
         self.config.use_extra_toks = use_extra_toks
-        encoded = ENCODER._encode([seed_text])
-        if encoded == [] and not use_extra_toks:
-            raise ValueError("If you are not using the extra tokens, you must provide some non-empty seed text")
-        start = [ENCODER.start] if use_extra_toks else []
-        encoded = EncodedOutput(token_ids=start + encoded.token_ids[0])
-
-        estimator = self.get_estimator(force_build_lm=True)
-        predict = estimator.predict(input_fn=get_input_fn,)
-
-        EOS = ENCODER.clf_token
-        with warnings.catch_warnings():
-            warnings.filterwarnings("ignore")
-            for i in range(len(encoded.token_ids), (max_length or self.config.max_length) - 2):
-                arr_encoded = self.input_pipeline._array_format(encoded)
-                class_idx = next(predict)[PredictMode.GENERATE_TEXT]
-                encoded.token_ids.append(class_idx[i])
-                if encoded.token_ids[-1] == EOS:
-                    break
-            dataset_encoded.finished = True
-
-        del self.config["use_extra_toks"]
-
-        return ENCODER.decode(encoded.token_ids)
+        max_length = min(max_length or self.config.max_length, self.config.max_length)
+        estimator = self.get_estimator(generation={"max_length": max_length, "num_beams": num_beams, "top_k": top_k})
+        try:
+            with warnings.catch_warnings():
+                warnings.filterwarnings("ignore")
+                generated = list(estimator.predict(input_fn=get_input_fn))
+        finally:
+            del self.config["use_extra_toks"]
+
+        return [
+            ENCODER.decode(gen[PredictMode.GENERATE_TEXT][:gen[PredictMode.GENERATE_TEXT_LENGTH]].tolist())
+            for gen in generated
+        ]
 
     def __getstate__(self):
         """
@@ -471,7 +935,28 @@ class BaseModel(object, metaclass=ABCMeta):
 
         return max(aggregated_results, key=lambda x: x[1])[0]
 
+    def close(self):
+        """
+        Stops the background threads serving `apredict`, `apredict_proba` and `afeaturize`, each closing its session
+        on its own thread, and closes the session `cached_predict` may have left open on this thread.  Those threads
+        hold a reference to the model, so a model that used the coroutine APIs is only garbage collected once closed.
+        The model can still be used afterwards.
+
+        Usage:
+            with Classifier() as model:
+                ...
+        """
+        self._close_batchers()
+        self._close_cached_predictor()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
     def __del__(self):
+        self.close()
         if self.cleanup_glob is not None:
             for file_or_folder in glob.glob(self.cleanup_glob):
                 try:
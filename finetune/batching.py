@@ -0,0 +1,144 @@
+"""
+Coalescing of single-example requests from many threads into batched forward passes.
+"""
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+from finetune.errors import FinetuneError
+
+DEFAULT_MAX_WAIT = 0.005
+_STOP = object()
+
+
+class MicroBatcher(object):
+    """
+    Runs a model method such as `predict` on a background thread, over batches gathered from requests submitted by
+    any number of threads.  A batch is run as soon as it holds `batch_size` requests or the oldest request has waited
+    `max_wait` seconds.  The background thread keeps a session open with `cached_predict`, so each batch costs a
+    single forward pass.
+
+    Usage:
+        with MicroBatcher(model) as batcher:
+            future = batcher.submit("An example")
+            prediction = future.result()
+    """
+
+    def __init__(self, model, method="predict", batch_size=None, max_wait=DEFAULT_MAX_WAIT):
+        """
+        :param model: A `BaseModel`.
+        :param method: Name of the model method to run on each batch, for instance "predict_proba" or "featurize".
+        :param batch_size: Most requests to run together.  Defaults to `config.batch_size`.
+        :param max_wait: Longest time, in seconds, a request waits for others to share its batch.
+        """
+        self.model = model
+        self.method = method
+        self.batch_size = batch_size or model.config.batch_size
+        self.max_wait = max_wait
+        self.n_requests = 0
+        self.n_batches = 0
+        self._queue = queue.Queue()
+        self._closed = False
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="finetune-{}-batcher".format(method), daemon=True)
+        self._thread.start()
+
+    def submit(self, *X):
+        """
+        :param X: A single example, as one element of each positional argument of the model method, for instance a
+            question and its answers for `MultipleChoice.predict`.
+        :return: A `concurrent.futures.Future` of the method's output for `X`.
+        """
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise FinetuneError("Cannot submit to a closed MicroBatcher")
+            self._queue.put((X, future))
+        return future
+
+    @property
+    def queue_depth(self):
+        """ Number of submitted requests that are not yet part of a batch. """
+        return self._queue.qsize()
+
+    @property
+    def batch_fill(self):
+        """ Mean fraction of `batch_size` used by the batches run so far. """
+        if not self.n_batches:
+            return 0.
+        return self.n_requests / (self.n_batches * self.batch_size)
+
+    def metrics(self):
+        return {
+            "queue_depth": self.queue_depth,
+            "n_requests": self.n_requests,
+            "n_batches": self.n_batches,
+            "batch_fill": self.batch_fill,
+        }
+
+    def _next_batch(self):
+        """
+        Blocks until a request arrives, then gathers more until the batch is full or the deadline passes.
+
+        :return: The list of (X, future) requests, and whether the batcher has been closed.
+        """
+        item = self._queue.get()
+        if item is _STOP:
+            return [], True
+        batch = [item]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run_batch(self, batch):
+        # requests cancelled while queued are dropped
+        batch = [(X, future) for X, future in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        Xs, futures = zip(*batch)
+        try:
+            # each argument of the method gets the list of that argument of every request
+            results = getattr(self.model, self.method)(*[list(arg) for arg in zip(*Xs)])
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            return
+        self.n_requests += len(batch)
+        self.n_batches += 1
+        for future, result in zip(futures, results):
+            future.set_result(result)
+
+    def _run(self):
+        with self.model.cached_predict():
+            closed = False
+            while not closed:
+                batch, closed = self._next_batch()
+                self._run_batch(batch)
+
+    def close(self):
+        """
+        Runs any requests already submitted, then stops the background thread and closes its session.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(_STOP)
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -4,6 +4,7 @@ import tensorflow as tf
 from finetune.base import BaseModel
 from finetune.classifier import Classifier, ClassificationPipeline
 from finetune.encoding import ArrayEncodedOutput
+from finetune.utils import pad_and_stack
 
 
 class ComparisonPipeline(ClassificationPipeline):
@@ -11,6 +12,11 @@ class ComparisonPipeline(ClassificationPipeline):
     def _format_for_encoding(self, X):
         return [X]
 
+    def _encoding_requests(self, pair, Y=None):
+        return [
+            self._encoding_request(self._format_for_encoding(pair)),
+            self._encoding_request(self._format_for_encoding(pair[::-1]))
+        ]
 
     def _text_to_ids(self, pair, Y=None, pad_token=None):
         """
@@ -24,14 +30,14 @@ class ComparisonPipeline(ClassificationPipeline):
         arr_backward = next(super()._text_to_ids(reversed_pair, Y=None))
         kwargs = arr_forward._asdict()
         kwargs['tokens'] = [arr_forward.tokens, arr_backward.tokens]
-        kwargs['token_ids'] = np.stack([arr_forward.token_ids, arr_backward.token_ids], 0)
-        kwargs['mask'] = np.stack([arr_forward.mask, arr_backward.mask], 0)
+        kwargs['token_ids'] = pad_and_stack([arr_forward.token_ids, arr_backward.token_ids])
+        kwargs['length'] = np.array([arr_forward.length, arr_backward.length], dtype=np.int32)
         yield ArrayEncodedOutput(**kwargs)
 
     def feed_shape_type_def(self):
         TS = tf.TensorShape
-        return ({"tokens": tf.int32, "mask": tf.int32}, tf.int32), (
-            {"tokens": TS([2, self.config.max_length, 2]), "mask": TS([2, self.config.max_length])},
+        return ({"tokens": tf.int32, "length": tf.int32}, tf.int32), (
+            {"tokens": TS([2, self._sequence_length]), "length": TS([2])},
             TS([self.target_dim]))
 
 
@@ -67,7 +67,8 @@ class Settings(dict):
     :param n_epochs: Number of iterations through training data, defaults to `3`.
     :param random_seed: Random seed to use for repeatability purposes, defaults to `42`.
     :param max_length:  Maximum number of subtokens per sequence. Examples longer than this number will be truncated 
-        (unless `chunk_long_sequences=True` for SequenceLabeler models). Defaults to `512`.
+        (unless `chunk_long_sequences=True` for SequenceLabeler models).  If "auto", the smallest length that fits
+        `max_length_percentile` percent of a sample of the training data is chosen.  Defaults to `512`.
     :param weight_stddev: Standard deviation of initial weights.  Defaults to `0.02`.
     :param chunk_long_sequences: When True, use a sliding window approach to predict on 
         examples that are longer than max length.  Defaults to `False`.
@@ -119,6 +120,45 @@ class Settings(dict):
         If you are using a single GPU and have more than 4Gb of GPU memory you should set this to GPU PCI number (0, 1, 2, etc.). Defaults to `"cpu"`.
     :param eval_acc: if True, calculates accuracy and writes it to the tensorboard summary files for valudation runs.
     :param save_dtype: specifies what precision to save model weights with.  Defaults to `np.float32`.
+    :param pretokenizer: Backend used to split text into words before byte-pair encoding.  `"spacy"` uses spacy's
+        english tokenizer, `"regex"` is a faster re-implementation of its token boundaries that does not load spacy.
+        Defaults to `"spacy"`.
+    :param pretokenize_batch_size: Number of examples read ahead and tokenized together by the pretokenizer
+        before encoding.  Defaults to `128`.
+    :param pretokenize_n_process: Number of processes used by spacy when tokenizing a batch of examples.  Defaults to `1`.
+    :param encoding_n_jobs: Number of worker processes used to encode training and inference examples.
+        Values greater than `1` encode `encoding_n_jobs * pretokenize_batch_size` examples at a time in a process pool.
+        Defaults to `1`.
+    :param encoding_cache_dir: Directory in which to cache the byte-pair encoding of each example, so that repeated runs
+        over the same text skip tokenization.  Defaults to `None` (no caching).
+    :param dynamic_padding: Pad each batch only to the length of its longest sequence rather than to `max_length`.
+        Defaults to `False`.
+    :param bucket_boundaries: When `dynamic_padding=True`, training examples are grouped into batches of similar
+        length using these sequence length boundaries.  Defaults to `None` (powers of two below `max_length`).
+    :param in_memory_dataset: Encode list and array inputs once into numpy arrays that are fed with
+        `Dataset.from_tensor_slices`, so that shuffling, batching and every epoch run without python.  The arrays are
+        embedded in the graph, so this is limited to datasets that encode to less than 2GB.  Defaults to `False`.
+    :param hash_val_split: When training on a generator, assign each example to the validation set by a hash of its
+        text rather than by shuffling the stream and taking `val_size` examples.  Validation examples are then only
+        encoded once and are kept in memory across evaluations, and are never encoded as part of the training stream.
+        The validation set holds approximately `val_size` examples.  Defaults to `False`.
+    :param pack_sequences: When finetuning only the language model, without targets, concatenate consecutive examples
+        into each sequence of up to `max_length` tokens so that little of each batch is padding.  Each example keeps its
+        own positions and only attends to itself.  Not applied when targets are given, even with `lm_loss_coef=1`, as
+        a packed sequence has no single target for the target model, so pass no targets to pack.  Defaults to `False`.
+    :param max_length_percentile: When `max_length="auto"`, the percentage of sampled examples that must fit within the
+        chosen `max_length`.  Lengths above `512` are only chosen if `interpolate_pos_embed=True`.  Defaults to `99`.
+    :param sort_by_length: At inference, batch examples in order of their encoded length and pad each batch only to
+        its longest example, so that short examples are not run at the length of long ones.  Outputs are returned in
+        the original order.  Defaults to `False`.
+    :param length_sort_window: When `sort_by_length=True`, the number of examples read and sorted together, which
+        bounds how many encoded examples and outputs are held in memory.  Defaults to `10000`.
+    :param prediction_cache_mb: Megabytes of memory in which to keep the outputs of `predict`, `predict_proba` and
+        `featurize` for each example, so that repeated examples skip inference.  The least recently used outputs are
+        evicted first, and repeated examples within a single call are only run once.  Outputs are tied to the model
+        weights and settings they were computed with.  Defaults to `0` (no caching).
+    :param prediction_cache_dir: Directory in which to also store every cached output, so that they outlive the
+        process and `prediction_cache_mb`.  Defaults to `None` (memory only).
     """
     def get_grid_searchable(self):
         return self.grid_searchable
@@ -203,6 +243,21 @@ def get_default_config():
         params_device="cpu",
         eval_acc=False,
         save_dtype=None,
+        pretokenizer="spacy",
+        pretokenize_batch_size=128,
+        pretokenize_n_process=1,
+        encoding_n_jobs=1,
+        encoding_cache_dir=None,
+        dynamic_padding=False,
+        bucket_boundaries=None,
+        in_memory_dataset=False,
+        hash_val_split=False,
+        pack_sequences=False,
+        max_length_percentile=99,
+        sort_by_length=False,
+        length_sort_window=10000,
+        prediction_cache_mb=0,
+        prediction_cache_dir=None,
 
         # Must remain fixed
         n_heads=12,
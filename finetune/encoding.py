@@ -6,33 +6,44 @@ import json
 import os
 import warnings
 import functools
+import hashlib
+import heapq
+import itertools
+import atexit
+import multiprocessing
+import copy
 from collections import namedtuple
+from collections.abc import Sequence
 import codecs
 
 import ftfy
-import spacy
 import numpy as np
 import tensorflow as tf
 
 from finetune.config import PAD_TOKEN
+from finetune.vocab import get_compiled_vocab
+from finetune.pretokenizers import get_pretokenizer, DEFAULT_PRETOKENIZER, PRETOKENIZE_BATCH_SIZE
 
 ENCODER_PATH = os.path.join(os.path.dirname(__file__), 'model/encoder_bpe_40000.json')
 BPE_PATH = os.path.join(os.path.dirname(__file__), 'model/vocab_40000.bpe')
-NLP = spacy.load('en', disable=['parser', 'tagger', 'ner', 'textcat'])
+COMPILED_VOCAB_PATH = os.path.join(os.path.dirname(__file__), 'model/vocab_40000_compiled')
+BPE_CACHE_SIZE = 2 ** 16
+STREAM_PIECE_SIZE = 4096
 
 EncodedOutput = namedtuple("EncodedOutput", [
-    "token_ids", # list of list of subtoken ids (ints)
-    "tokens",    # list of list of subtokens (strs)
-    "labels",    # list of list of labels 
-    "char_locs", # list of list of character locations (ints)
+    "token_ids", # int32 array of subtoken ids, shape (n_tokens,)
+    "tokens",    # `SubTokens`, subtoken strings (str) decoded from `token_ids` on demand
+    "labels",    # list of labels, one per subtoken
+    "char_locs", # int32 array of character locations, shape (n_tokens,)
+    "offsets",   # optionally, int32 array of row boundaries (CSR) when several texts are encoded together
 ])
 EncodedOutput.__new__.__defaults__ = (None,) * len(EncodedOutput._fields)
 ArrayEncodedOutput = namedtuple("ArrayEncodedOutput", [
-    "token_ids", # int array shape (batch, seq_length)
-    "tokens",    # list of list of subtokens (str) passed through from `EncoderOutput`
-    "labels",    # object array shape (batch, seq_length)
-    "char_locs", # list of list of char_locs (int) passed through from `EncoderOutput`
-    "mask",      # int array shape (batch, seq_length)
+    "token_ids", # int32 array of padded subtoken ids, shape (seq_length,)
+    "tokens",    # subtokens passed through from `EncodedOutput`
+    "labels",    # object array shape (seq_length,)
+    "char_locs", # char_locs passed through from `EncodedOutput`
+    "length",    # number of subtokens before padding (int)
 ])
 ArrayEncodedOutput.__new__.__defaults__ = (None,) * len(ArrayEncodedOutput._fields)
 
@@ -45,21 +56,167 @@ SUBS = {
 }
 
 
-def _flatten(nested_lists):
-    return functools.reduce(lambda x, y: x + y, nested_lists, [])
+@functools.lru_cache(maxsize=None)
+def _default_decoder():
+    encoder = TextEncoder()
+    encoder._lazy_init()
+    return encoder.decoder
 
 
-def _get_pairs(word):
+class SubTokens(Sequence):
     """
-    Return set of symbol pairs in a word.
-    word is represented as tuple of symbols (symbols being variable-length strings)
+    The byte-pair encoded token strings of an array of token ids.  Strings are only decoded when accessed, and
+    slicing returns another `SubTokens` over a view of the same ids.
+
+    Subtokens whose id does not decode to their text, as they were mapped by `SUBS` or are not in the vocabulary,
+    are kept in `substitutions`, a dict from position to string.
+    """
+    __slots__ = ['token_ids', 'decoder', 'substitutions']
+
+    def __init__(self, token_ids, decoder=None, substitutions=None):
+        """
+        :param token_ids: Array of subtoken ids.
+        :param decoder: The decoder of the encoder that produced `token_ids`.
+        :param substitutions: Optionally, a dict from position to the string of subtokens that `decoder` would not
+            reproduce.
+        """
+        self.token_ids = token_ids
+        self.decoder = decoder
+        self.substitutions = substitutions or {}
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self.token_ids))
+            if step == 1:
+                substitutions = {i - start: sub for i, sub in self.substitutions.items() if start <= i < stop}
+            else:
+                positions = range(start, stop, step)
+                substitutions = {
+                    positions.index(i): sub for i, sub in self.substitutions.items() if i in positions
+                }
+            return SubTokens(self.token_ids[idx], self.decoder, substitutions)
+        if idx < 0:
+            idx += len(self.token_ids)
+        if idx in self.substitutions:
+            return self.substitutions[idx]
+        # tokens that have been through pickle, for instance from a worker process, may have lost their decoder
+        decoder = self.decoder if self.decoder is not None else _default_decoder()
+        return decoder.get(int(self.token_ids[idx]))
+
+    def __len__(self):
+        return len(self.token_ids)
+
+    def __eq__(self, other):
+        return isinstance(other, Sequence) and list(self) == list(other)
+
+    def __repr__(self):
+        return "SubTokens(token_ids={})".format(self.token_ids)
+
+    def __reduce__(self):
+        # the decoder holds the whole vocabulary, so is left out and set again by the receiving encoder
+        return SubTokens, (self.token_ids, None, self.substitutions)
+
+
+def sliding_windows(encoded, window_size, step_size):
     """
-    pairs = set()
-    prev_char = word[0]
-    for char in word[1:]:
-        pairs.add((prev_char, char))
-        prev_char = char
-    return pairs
+    Splits an `EncodedOutput` into overlapping windows of `window_size` subtokens, starting every `step_size`
+    subtokens.  Windows are views of `encoded`, so no per-window copies are made.
+    """
+    for start in range(0, len(encoded.token_ids), step_size):
+        end = start + window_size
+        yield EncodedOutput(
+            token_ids=encoded.token_ids[start:end],
+            tokens=encoded.tokens[start:end],
+            labels=encoded.labels[start:end] if encoded.labels is not None else None,
+            char_locs=encoded.char_locs[start:end],
+        )
+
+
+# a single space between two non-whitespace characters, where splitting the text does not change how it is
+# standardized or pretokenized
+_PIECE_BOUNDARY_RE = re.compile(r'(?<=\S) (?=\S)')
+
+
+def _split_pieces(text, piece_size):
+    """
+    Yields (offset, piece) for consecutive pieces of roughly `piece_size` characters, split on single spaces.
+    """
+    start = 0
+    while len(text) - start > piece_size:
+        boundary = _PIECE_BOUNDARY_RE.search(text, start + piece_size)
+        if boundary is None:
+            break
+        yield start, text[start:boundary.start()]
+        start = boundary.end()
+    yield start, text[start:]
+
+
+def encoded_rows(encoded):
+    """
+    Splits an `EncodedOutput` of several texts into one `EncodedOutput` per text, using its `offsets`.
+    """
+    rows = []
+    for start, end in zip(encoded.offsets[:-1], encoded.offsets[1:]):
+        rows.append(EncodedOutput(
+            token_ids=encoded.token_ids[start:end],
+            tokens=encoded.tokens[start:end],
+            labels=encoded.labels[start:end] if encoded.labels is not None else None,
+            char_locs=encoded.char_locs[start:end],
+        ))
+    return rows
+
+
+def _merge_symbols(word, bpe_ranks):
+    """
+    Apply byte-pair merges to a tuple of symbols, lowest ranked pair first.
+
+    Symbols are held in a doubly linked list and candidate pairs in a heap keyed by (rank, position), so each merge
+    round only touches the neighbours of merged pairs rather than rescanning the whole word.  All occurrences of the
+    lowest ranked pair are merged left to right before any newly formed pair is considered, which matches the
+    reference implementation exactly.
+    """
+    symbols = list(word)
+    prev = list(range(-1, len(symbols) - 1))
+    nxt = list(range(1, len(symbols) + 1))
+    nxt[-1] = -1
+
+    heap = []
+
+    def push(i):
+        if i == -1 or nxt[i] == -1:
+            return
+        pair = (symbols[i], symbols[nxt[i]])
+        rank = bpe_ranks.get(pair)
+        if rank is not None:
+            heapq.heappush(heap, (rank, i) + pair)
+
+    for i in range(len(symbols) - 1):
+        push(i)
+
+    while heap:
+        rank = heap[0][0]
+        candidates = []
+        while heap and heap[0][0] == rank:
+            candidates.append(heapq.heappop(heap))
+
+        merged = []
+        for _, i, first, second in sorted(candidates, key=lambda c: c[1]):
+            j = nxt[i]
+            if symbols[i] != first or j == -1 or symbols[j] != second:
+                # stale entry, one of the symbols was consumed by an earlier merge
+                continue
+            symbols[i] = first + second
+            symbols[j] = None
+            nxt[i] = nxt[j]
+            if nxt[j] != -1:
+                prev[nxt[j]] = i
+            merged.append(i)
+
+        for i in merged:
+            push(prev[i])
+            push(i)
+
+    return [symbol for symbol in symbols if symbol is not None]
 
 
 def _text_standardize(text):
@@ -73,6 +230,22 @@ def _text_standardize(text):
     return ftfy.fix_text(text.strip().lower())
 
 
+_WORKER_ENCODER = None
+
+
+def _init_encoding_worker():
+    # vocab and merges are loaded once per worker process rather than once per task
+    global _WORKER_ENCODER
+    _WORKER_ENCODER = TextEncoder()
+    _WORKER_ENCODER._lazy_init()
+
+
+def _encode_in_worker(args):
+    Xs, Y, max_length, pad_token, cache, pretokenizer = args
+    encoder = _WORKER_ENCODER.with_pretokenizer(pretokenizer)
+    return encoder.encode_multi_input(Xs, Y=Y, max_length=max_length, pad_token=pad_token, cache=cache)
+
+
 class TextEncoder(object):
     """
     A modified wrapper for a public python BPE tokenizer. The modifications allow encoding directly into the formats
@@ -80,32 +253,82 @@ class TextEncoder(object):
     """
     UNK_IDX = 0
 
-    def __init__(self):
+    def __init__(self, cache_size=BPE_CACHE_SIZE, use_compiled_vocab=True, pretokenizer=DEFAULT_PRETOKENIZER):
+        """
+        :param cache_size: Maximum number of words to keep in the byte-pair encoding LRU cache.
+            `None` means unbounded.
+        :param use_compiled_vocab: Load the vocabulary and merges from memory-mapped arrays, compiling them from the
+            json and bpe files on first use.  Falls back to parsing the json and bpe files if they cannot be compiled.
+        :param pretokenizer: Name of the backend used to split text into words before byte-pair encoding,
+            see `finetune.pretokenizers.PRETOKENIZERS`.
+        """
         self.initialized = False
+        self.cache_size = cache_size
+        self.use_compiled_vocab = use_compiled_vocab
+        self._cached_bpe = functools.lru_cache(maxsize=cache_size)(self._bpe)
+        self._cached_subtokens = functools.lru_cache(maxsize=cache_size)(self._subtokens)
+        self._pools = {}
+        self._fingerprint = None
+        self.pretokenizer = get_pretokenizer(pretokenizer)
+        self.pretokenizer_name = pretokenizer
+        # encoders sharing this one's vocabulary, by pretokenizer, see `with_pretokenizer`
+        self._variants = {pretokenizer: self}
+
+    def with_pretokenizer(self, name):
+        """
+        An encoder that splits text into words with the backend `name`, and otherwise shares this encoder's vocabulary,
+        caches and worker pools.  Encoders are never switched between backends in place, so that models with different
+        `pretokenizer` settings can encode concurrently.
+        """
+        if name not in self._variants:
+            self._lazy_init()
+            variant = copy.copy(self)
+            variant.pretokenizer = get_pretokenizer(name)
+            variant.pretokenizer_name = name
+            variant._fingerprint = None
+            self._variants[name] = variant
+        return self._variants[name]
 
     def _lazy_init(self):
         if self.initialized:
             return
 
-        self.encoder = json.load(open(ENCODER_PATH))
-        self.decoder = {v: k for k, v in self.encoder.items()}
+        compiled = get_compiled_vocab(ENCODER_PATH, BPE_PATH, COMPILED_VOCAB_PATH) if self.use_compiled_vocab else None
+        if compiled is not None:
+            self.encoder, self.decoder, self.bpe_ranks = compiled
+        else:
+            self.encoder = json.load(open(ENCODER_PATH))
+            self.decoder = {v: k for k, v in self.encoder.items()}
+            merges = codecs.open(BPE_PATH, encoding='utf8').read().split('\n')[1:-1]
+            merges = [tuple(merge.split()) for merge in merges]
+            self.bpe_ranks = dict(zip(merges, range(len(merges))))
 
         self.special_tokens = ['_start_', '_delimiter_', '_classify_']
         for token in self.special_tokens:
             self.encoder[token] = len(self.encoder)
+            self.decoder[self.encoder[token]] = token
 
-        self.decoder = {v: k for k, v in self.encoder.items()}
-
-        merges = codecs.open(BPE_PATH, encoding='utf8').read().split('\n')[1:-1]
-        merges = [tuple(merge.split()) for merge in merges]
-        self.bpe_ranks = dict(zip(merges, range(len(merges))))
-        self.cache = {}
         self.start = self.encoder['_start_']
         self.delimiter = self.encoder['_delimiter_']
         self.clf_token = self.encoder['_classify_']
         self.initialized = True
 
 
+    @property
+    def fingerprint(self):
+        """
+        A hash of the vocabulary, merges, special tokens and pretokenizer.  Identifies encodings produced by this encoder.
+        """
+        if self._fingerprint is None:
+            self._lazy_init()
+            sha = hashlib.sha1()
+            for path in (ENCODER_PATH, BPE_PATH):
+                with open(path, 'rb') as fp:
+                    sha.update(fp.read())
+            sha.update(json.dumps([self.special_tokens, self.pretokenizer_name]).encode('utf-8'))
+            self._fingerprint = sha.hexdigest()
+        return self._fingerprint
+
     @property
     def vocab_size(self):
         self._lazy_init()
@@ -115,106 +338,121 @@ class TextEncoder(object):
         return self.encoder[key]
 
     def __setitem__(self, key, value):
+        self._lazy_init()
         self.encoder[key] = value
+        self.decoder[value] = key
 
     def bpe(self, token):
-        word = tuple(token[:-1]) + (token[-1] + '</w>',)
-        if token in self.cache:
-            return self.cache[token]
-        pairs = _get_pairs(word)
+        return self._cached_bpe(token)
+
+    def cache_info(self):
+        """
+        Hit / miss statistics of the per-word byte-pair encoding cache.
+        """
+        return self._cached_bpe.cache_info()
 
-        if not pairs:
+    def _bpe(self, token):
+        word = tuple(token[:-1]) + (token[-1] + '</w>',)
+        if len(word) == 1:
             return token + '</w>'
 
-        while True:
-            bigram = min(pairs, key=lambda pair: self.bpe_ranks.get(pair, float('inf')))
-            if bigram not in self.bpe_ranks:
-                break
-            first, second = bigram
-            new_word = []
-            i = 0
-            while i < len(word):
-                try:
-                    j = word.index(first, i)
-                    new_word.extend(word[i:j])
-                    i = j
-                except:
-                    new_word.extend(word[i:])
-                    break
-
-                if word[i] == first and i < len(word) - 1 and word[i + 1] == second:
-                    new_word.append(first + second)
-                    i += 2
-                else:
-                    new_word.append(word[i])
-                    i += 1
-            new_word = tuple(new_word)
-            word = new_word
-            if len(word) == 1:
-                break
-            else:
-                pairs = _get_pairs(word)
-        word = ' '.join(word)
+        word = ' '.join(_merge_symbols(word, self.bpe_ranks))
         if word == '\n  </w>':
             word = '\n</w>'
-        self.cache[token] = word
         return word
 
-    def _encode(self, texts, labels=None, verbose=True):
+    def _tokenize(self, texts, batch_size=PRETOKENIZE_BATCH_SIZE, n_process=1):
+        """
+        Standardize and pretokenize a list of texts.  More than one text is run through the pretokenizer's `pipe`.
+        """
+        standardized = [_text_standardize(text) for text in texts]
+        if len(standardized) == 1:
+            docs = [self.pretokenizer(standardized[0])]
+        else:
+            docs = self.pretokenizer.pipe(standardized, batch_size=batch_size, n_process=n_process)
+        return [[token.text for token in doc] for doc in docs]
+
+    def pretokenize(self, texts, batch_size=PRETOKENIZE_BATCH_SIZE, n_process=1):
+        """
+        Tokenize a batch of texts ahead of encoding them.  Passing the result to `_encode` or `encode_multi_input` lets
+        examples that are encoded one at a time share a single batched pretokenizer call.
+
+        :param texts: List of raw text.
+        :param batch_size: Number of texts passed to the pretokenizer at once.
+        :param n_process: Number of processes used by the pretokenizer, if supported.
+        :return: A dict from each text to its tokens.
+        """
+        texts = list(dict.fromkeys(texts))
+        return dict(zip(texts, self._tokenize(texts, batch_size=batch_size, n_process=n_process)))
+
+    def _subtokens(self, token):
+        """
+        :return: The ids of the byte-pair encoded subtokens of `token`, the character offset of the end of each
+            subtoken relative to the start of `token`, and the (index, string) of each subtoken that its id does not
+            decode to.
+        """
+        bpe_toks = self.bpe(token).split(' ')
+        assert len("".join(bpe_toks).replace("</w>", "")) == len(token.replace(' ', ''))
+        ids = tuple(self.encoder.get(SUBS.get(t, t), self.UNK_IDX) for t in bpe_toks)
+        ends = tuple(itertools.accumulate(len(t.replace("</w>", '')) for t in bpe_toks))
+        substitutions = tuple((i, t) for i, t in enumerate(bpe_toks) if t in SUBS or t not in self.encoder)
+        return ids, ends, substitutions
+
+    def subtokens(self, token_ids, substitutions=None):
+        """
+        :return: `SubTokens` decoding `token_ids` with this encoder's vocabulary.
+        """
+        return SubTokens(token_ids, self.decoder, substitutions)
+
+    def _encode(self, texts, labels=None, verbose=True, pretokenized=None):
         """
         Convert a batch of raw text to a batch of byte-pair encoded token indices.
+        The subtokens of all texts are concatenated, `offsets[i]:offsets[i + 1]` are those of the i-th text.
+
+        :param pretokenized: Optionally, the tokens of some of `texts`, as returned by `pretokenize`.
         """
         self._lazy_init()
-        batch_tokens = []
-        batch_token_idxs = []
-        batch_label_idxs = []
-        batch_character_locs = []
-        label = None
-        
+        pretokenized = pretokenized or {}
+        missing = list(dict.fromkeys(text for text in texts if text not in pretokenized))
+        if missing:
+            pretokenized = {**pretokenized, **dict(zip(missing, self._tokenize(missing)))}
+
+        token_ids = []
+        char_locs = []
+        substitutions = {}
+        batch_labels = [] if labels is not None else None
+        offsets = [0]
+
         for i, text in enumerate(texts):
-            if labels is not None:
-                label = labels[i]
             raw_text = text.lower()
-            tokens = NLP(_text_standardize(text))
-            subtokens = []
-            subtoken_idxs = []
-            tok_pos = []
             token_start = 0
 
-            for j, token in enumerate(tokens):
-                bpe_toks = self.bpe(token.text).split(' ')
-
+            for token in pretokenized[text]:
                 try:
-                    if token.text.strip():
-                        token_start = raw_text.index(token.text, token_start)
+                    if token.strip():
+                        token_start = raw_text.index(token, token_start)
                 except:
                     # text_standardization oddity
                     continue
 
-                subtokens.extend(bpe_toks)
-                subtoken_idxs.extend([
-                    self.encoder.get(SUBS.get(t, t), self.UNK_IDX)
-                    for t in bpe_toks
-                ])
-                
-                assert len("".join(bpe_toks).replace("</w>", "")) == len(token.text.replace(' ', ''))
-                subtoken_positions = np.cumsum([len(tok.replace("</w>", '')) for tok in bpe_toks]) + token_start
-
-                token_start += len(token.text.strip())
-                
-                tok_pos.extend(subtoken_positions)
-            
-            batch_tokens.append(subtokens)
-            batch_token_idxs.append(subtoken_idxs)
-            batch_character_locs.append(tok_pos)
+                ids, ends, token_substitutions = self._cached_subtokens(token)
+                for pos, sub in token_substitutions:
+                    substitutions[len(token_ids) + pos] = sub
+                token_ids.extend(ids)
+                char_locs.extend([token_start + end for end in ends])
+                token_start += len(token.strip())
+
             if labels is not None:
-                batch_label_idxs.append([label] * len(subtoken_idxs))
+                batch_labels.extend([labels[i]] * (len(token_ids) - offsets[-1]))
+            offsets.append(len(token_ids))
 
+        token_ids = np.array(token_ids, dtype=np.int32)
         return EncodedOutput(
-            token_ids=batch_token_idxs,
-            tokens=batch_tokens,
-            labels=batch_label_idxs,
-            char_locs=batch_character_locs,
+            token_ids=token_ids,
+            tokens=self.subtokens(token_ids, substitutions),
+            labels=batch_labels,
+            char_locs=np.array(char_locs, dtype=np.int32),
+            offsets=np.array(offsets, dtype=np.int32),
         )
 
     def decode(self, ids):
@@ -224,43 +462,53 @@ class TextEncoder(object):
 
         return "".join([self.decoder.get(word_idx, '<unk>') for word_idx in ids]).replace("</w>", " ")
 
-    def _cut_and_concat(self, *, encoded, max_length, verbose, special_tokens=None, start=None, delimiter=None,
-                        end=None):
+    def _cut_length(self, lengths, max_length):
         """
-        Takes some tokenized text and arranges it into a format that maximises the amount of kept text from each
-        whilst keeping the overall sequence length within max_length tokens. It also adds the 3 special tokens. Start,
-         Classify and Delimiter.
-        :param encoded: Lists of shape [batch, n_fields, num_tokens]
+        Finds the length to cut each field to, so as to maximise the amount of kept text from each whilst keeping the
+        overall sequence length, including the special tokens, within max_length tokens.
+        :param lengths: Number of tokens in each field.
         :param max_length: Int representing the max length of a single sample
-        :param verbose: Bool of whether to print the TQDM bar or not.
+        :return: The number of tokens to keep from each field, or None if no field needs to be cut.
+        """
+        num_samples = len(lengths)
+        adjusted_max_length = max_length - num_samples - 1
+        allocated_max_len = adjusted_max_length // num_samples
+
+        overflows = [allocated_max_len - length for length in lengths]
+        spare = sum(overflows)
+
+        if spare >= 0:
+            return None
+
+        warnings.warn("Document is longer than max length allowed, trimming document to {} tokens.".format(
+            max_length
+        ))
+        empty_tokens = sum(max(overflow, 0) for overflow in overflows)
+        num_over = [max(overflow, 0) for overflow in overflows].count(0)
+        if num_over == 0:
+            return allocated_max_len
+        return allocated_max_len + (empty_tokens // num_over)
+
+    def _cut_and_concat(self, *, encoded, cut_len, special_tokens=None, start=None, delimiter=None, end=None):
+        """
+        Cuts each field to `cut_len` and joins them with the 3 special tokens. Start, Classify and Delimiter.
+        :param encoded: A list of int arrays or lists, one per field.
+        :param cut_len: Number of tokens to keep from each field, as returned by `_cut_length`.
         :param start: Override the default start token.
         :param delimiter: Override the default delimiter token.
         :param end: Override the default classify token
-        :return: Formatted outputs of the form. [batch, num_tokens] where num_tokens' <= max_length
+        :return: An int32 array if `encoded` holds arrays, otherwise a list.
         """
         start = start or special_tokens or self.start
         delimiter = delimiter or special_tokens or self.delimiter
         clf_token = end or special_tokens or self.clf_token
 
-        num_samples = len(encoded)
-        adjusted_max_length = max_length - num_samples - 1
-        allocated_max_len = adjusted_max_length // num_samples
-
-        overflows = [allocated_max_len - len(sequence) for sequence in encoded]
-        spare = sum(overflows)
-
-        if spare >= 0:
-            cut_len = None
-        else:
-            warnings.warn("Document is longer than max length allowed, trimming document to {} tokens.".format(
-                max_length
-            ))
-            empty_tokens = sum(max(overflow, 0) for overflow in overflows)
-            num_over = [max(overflow, 0) for overflow in overflows].count(0)
-            if num_over == 0:
-                cut_len = allocated_max_len
-            else:
-                cut_len = allocated_max_len + (empty_tokens // num_over)
+        if encoded and isinstance(encoded[0], np.ndarray):
+            pieces = [np.array([start], dtype=np.int32)]
+            for d in encoded:
+                pieces += [d[:cut_len], np.array([delimiter], dtype=np.int32)]
+            pieces[-1] = np.array([clf_token], dtype=np.int32)
+            return np.concatenate(pieces).astype(np.int32, copy=False)
 
         joined = [start]
         for d in encoded:
@@ -269,7 +517,29 @@ class TextEncoder(object):
 
         return joined
 
-    def encode_multi_input(self, Xs, Y=None, max_length=None, verbose=True, pad_token=PAD_TOKEN):
+    def _encode_fields(self, Xs, cache=None, pretokenized=None):
+        """
+        Encodes each field of an example without truncation, reading from and writing to `cache` when provided.
+        Returns an `EncodedOutput` with `offsets` per field, delimiting the subtokens of each segment.
+        """
+        cached = cache.get(Xs) if cache is not None else None
+        if cached is not None:
+            for field in cached:
+                field.tokens.decoder = self.decoder
+            return cached
+
+        fields = []
+        for field in Xs:
+            assert isinstance(field, (list, tuple)), "This should be a list of strings, if its not," \
+                "you've done something wrong... instead it's {}".format(tf.contrib.framework.nest.map_structure(type, field))
+            fields.append(self._encode(field, pretokenized=pretokenized))
+
+        if cache is not None:
+            cache.put(Xs, fields)
+        return fields
+
+    def encode_multi_input(self, Xs, Y=None, max_length=None, verbose=True, pad_token=PAD_TOKEN, cache=None,
+                           pretokenized=None):
         """
         Encodes the text for passing to the model, also tracks the location of each token to allow reconstruction.
         It can also, optionally, construct a per-token labels as required for training.
@@ -277,44 +547,24 @@ class TextEncoder(object):
         :param Y: A list of list of targets -- [n_batch, n_segments]
         :param max_length: Max length of the sequences.
         :param verbose: Flag to set whether to output a status bar.
+        :param cache: Optionally, an `EncodingCache` to read encodings from and store new encodings in.
+        :param pretokenized: Optionally, the tokens of some of the text in `Xs`, as returned by `pretokenize`.
         :return: A Labeled Sequence Object.
         """
-
-        token_ids = []
-        tokens = []
-        positions = []
-        labels = []
-
-        # for each field in that example
-        for field in Xs:
-            assert isinstance(field, (list, tuple)), "This should be a list of strings, if its not," \
-                "you've done something wrong... instead it's {}".format(tf.contrib.framework.nest.map_structure(type, field))
-            encoded = self._encode(field, labels=Y)
-            token_ids.append(_flatten(encoded.token_ids))
-            tokens.append(_flatten(encoded.tokens))
-            positions.append(_flatten(encoded.char_locs))
-            labels.append(_flatten(encoded.labels))
-            if len(tokens[-1]) > (max_length - 2):
+        fields = self._encode_fields(Xs, cache=cache, pretokenized=pretokenized)
+        for field in fields:
+            if len(field.token_ids) > (max_length - 2):
                 warnings.warn(
                     "Some examples are longer than the max_length. Please trim documents or increase `max_length`. "
                     "Fallback behaviour is to use the first {} byte-pair encoded tokens".format(max_length - 2)
                 )
 
         # merge fields + truncate if necessary
-        token_ids = self._cut_and_concat(
-            encoded=token_ids,
-            max_length=max_length,
-            verbose=verbose
-        )
-        tokens = self._cut_and_concat(
-            encoded=tokens,
-            max_length=max_length,
-            verbose=verbose
-        )
+        cut_len = self._cut_length([len(field.token_ids) for field in fields], max_length)
+        token_ids = self._cut_and_concat(encoded=[field.token_ids for field in fields], cut_len=cut_len)
         locations = self._cut_and_concat(
-            encoded=positions,
-            max_length=max_length,
-            verbose=verbose,
+            encoded=[field.char_locs for field in fields],
+            cut_len=cut_len,
             special_tokens=-1
         )
 
@@ -322,15 +572,131 @@ class TextEncoder(object):
             labels = None
         else:
             labels = self._cut_and_concat(
-                encoded=labels,
-                max_length=max_length,
-                verbose=verbose,
+                encoded=[
+                    [label for label, length in zip(Y, np.diff(field.offsets)) for _ in range(length)]
+                    for field in fields
+                ],
+                cut_len=cut_len,
                 special_tokens=pad_token
             )
 
+        # each field follows the start token, or the delimiter after the previous field
+        substitutions = {}
+        position = 1
+        for field in fields:
+            n_kept = len(field.token_ids[:cut_len])
+            for pos, sub in field.tokens.substitutions.items():
+                if pos < n_kept:
+                    substitutions[position + pos] = sub
+            position += n_kept + 1
+
         return EncodedOutput(
             token_ids=token_ids,
-            tokens=tokens,
+            tokens=self.subtokens(token_ids, substitutions),
             labels=labels,
             char_locs=locations,
         )
+
+    def encode_windows(self, segments, Y=None, window_size=None, step_size=None, pad_token=PAD_TOKEN,
+                       piece_size=STREAM_PIECE_SIZE):
+        """
+        Streaming equivalent of `sliding_windows(encode_multi_input([segments], Y, max_length=sys.maxsize))`.
+        Text is encoded a piece at a time and each window is yielded as soon as all of its subtokens are available,
+        so memory use is bounded by the window and piece sizes rather than by the length of the document.
+
+        :param segments: A list of strings, the segments of a single field.
+        :param Y: Optionally, a target per segment.
+        :param window_size: Number of subtokens per window.
+        :param step_size: Number of subtokens between the starts of consecutive windows.
+        :param piece_size: Approximate number of characters encoded at a time.
+        :return: A generator of EncodedOutput windows.
+        """
+        token_ids = [self.start]
+        char_locs = [-1]
+        labels = [pad_token] if Y is not None else None
+        # substitutions of the buffered subtokens, by absolute position
+        substitutions = {}
+        # absolute position of the first buffered subtoken, and of the next window to yield
+        base = 0
+        window_start = 0
+
+        def window():
+            start = window_start - base
+            ids = np.array(token_ids[start:start + window_size], dtype=np.int32)
+            window_substitutions = {
+                i - window_start: sub for i, sub in substitutions.items()
+                if window_start <= i < window_start + window_size
+            }
+            return EncodedOutput(
+                token_ids=ids,
+                tokens=self.subtokens(ids, window_substitutions),
+                labels=labels[start:start + window_size] if labels is not None else None,
+                char_locs=np.array(char_locs[start:start + window_size], dtype=np.int32),
+            )
+
+        for i, segment in enumerate(segments):
+            for offset, piece in _split_pieces(segment, piece_size):
+                encoded = self._encode([piece])
+                for pos, sub in encoded.tokens.substitutions.items():
+                    substitutions[base + len(token_ids) + pos] = sub
+                token_ids.extend(encoded.token_ids.tolist())
+                char_locs.extend((encoded.char_locs + offset).tolist())
+                if labels is not None:
+                    labels.extend([Y[i]] * len(encoded.token_ids))
+
+                while base + len(token_ids) >= window_start + window_size:
+                    yield window()
+                    window_start += step_size
+                    # drop subtokens before the next window
+                    consumed = window_start - base
+                    del token_ids[:consumed], char_locs[:consumed]
+                    if labels is not None:
+                        del labels[:consumed]
+                    substitutions = {i: sub for i, sub in substitutions.items() if i >= window_start}
+                    base = window_start
+
+        token_ids.append(self.clf_token)
+        char_locs.append(-1)
+        if labels is not None:
+            labels.append(pad_token)
+        while window_start < base + len(token_ids):
+            yield window()
+            window_start += step_size
+
+    def _get_pool(self, n_jobs):
+        if n_jobs not in self._pools:
+            # the pool may be created from a tf.data thread once tensorflow is running, and forking a process with
+            # running threads can deadlock the child, so workers are started from a fresh interpreter instead
+            start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            pool = multiprocessing.get_context(start_method).Pool(n_jobs, initializer=_init_encoding_worker)
+            atexit.register(pool.terminate)
+            self._pools[n_jobs] = pool
+        return self._pools[n_jobs]
+
+    def encode_batch(self, texts, Y=None, max_length=None, n_jobs=None, pad_token=PAD_TOKEN, cache=None):
+        """
+        Encodes many examples at once by fanning `encode_multi_input` out to a pool of worker processes.
+        The pool is created on first use and reused by later calls.
+
+        :param texts: A list of examples, each in the format expected by `encode_multi_input`.
+        :param Y: Optionally, a list of per-example targets in the format expected by `encode_multi_input`.
+        :param max_length: Max length of the sequences.
+        :param n_jobs: Number of worker processes.  Defaults to the number of available cpus.
+        :param cache: Optionally, an `EncodingCache` shared by all workers.
+        :return: A list of EncodedOutput objects, in the same order as `texts`.
+        """
+        if Y is None:
+            Y = [None] * len(texts)
+        n_jobs = n_jobs or os.cpu_count()
+        if n_jobs == 1 or len(texts) <= 1:
+            return [
+                self.encode_multi_input(Xs, Y=y, max_length=max_length, pad_token=pad_token, cache=cache)
+                for Xs, y in zip(texts, Y)
+            ]
+        args = [(Xs, y, max_length, pad_token, cache, self.pretokenizer_name) for Xs, y in zip(texts, Y)]
+        chunksize = max(1, len(args) // (4 * n_jobs))
+        encoded = self._get_pool(n_jobs).map(_encode_in_worker, args, chunksize=chunksize)
+        for encoded_example in encoded:
+            # tokens are returned from the workers without a decoder
+            encoded_example.tokens.decoder = self.decoder
+        return encoded
@@ -0,0 +1,118 @@
+"""
+Content-addressed on-disk cache of encoded examples.
+"""
+import os
+import json
+import hashlib
+import tempfile
+
+import numpy as np
+
+from finetune.encoding import EncodedOutput, SubTokens
+
+# bumped whenever the entry layout changes, so that stale entries are never read
+CACHE_FORMAT_VERSION = 3
+
+
+class EncodingCache(object):
+    """
+    Stores the byte-pair encoding of each example under `cache_dir`, keyed by a hash of the example's text and the
+    encoder's fingerprint, so that repeated `finetune` / `predict` calls on the same text skip tokenization entirely.
+
+    Entries hold each field's encoding before truncation, so a single entry serves every `max_length` and
+    `chunk_long_sequences` setting.  Each entry is a single file of little-endian int32s laid out as:
+
+        [n_fields, n_segments * n_fields, token_counts * n_fields, offsets * (n_segments + 1) * n_fields,
+         token_ids * n_tokens, char_locs * n_tokens, substitution_counts * n_fields,
+         (position, n_chars) * n_substitutions, codepoints * n_chars]
+
+    where substitutions are the strings of subtokens that their ids do not decode to, see `SubTokens`.
+    """
+
+    def __init__(self, cache_dir, fingerprint):
+        """
+        :param cache_dir: Directory to store cached encodings in.  Created if it does not exist.
+        :param fingerprint: A string that identifies the encoder, see `TextEncoder.fingerprint`.
+        """
+        self.cache_dir = cache_dir
+        self.fingerprint = fingerprint
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, Xs):
+        text = json.dumps([[str(segment) for segment in field] for field in Xs], ensure_ascii=False)
+        key = hashlib.sha1('{}{}{}'.format(CACHE_FORMAT_VERSION, self.fingerprint, text).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key + '.bin')
+
+    def get(self, Xs):
+        """
+        :param Xs: A list of lists of string -- [n_fields, n_segments]
+        :return: An `EncodedOutput` per field, with `offsets` delimiting each segment, or None if the example is not
+            in the cache.
+        """
+        try:
+            data = np.fromfile(self._path(Xs), dtype='<i4').astype(np.int32, copy=False)
+        except (FileNotFoundError, NotADirectoryError):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        n_fields = data[0]
+        n_segments = data[1:1 + n_fields]
+        n_tokens = data[1 + n_fields:1 + 2 * n_fields]
+        start = 1 + 2 * n_fields + np.sum(n_segments + 1)
+        offsets = np.split(data[1 + 2 * n_fields:start], np.cumsum(n_segments + 1))[:-1]
+        total_tokens = np.sum(n_tokens)
+        token_ids = data[start:start + total_tokens]
+        char_locs = data[start + total_tokens:start + 2 * total_tokens]
+        start += 2 * total_tokens
+        n_substitutions = data[start:start + n_fields]
+        start += n_fields
+        positions, n_chars = data[start:start + 2 * np.sum(n_substitutions)].reshape(-1, 2).T
+        codepoints = data[start + 2 * np.sum(n_substitutions):]
+        strings = [''.join(map(chr, chars)) for chars in np.split(codepoints, np.cumsum(n_chars))[:-1]]
+
+        fields = []
+        ends = np.cumsum(n_tokens)
+        sub_ends = np.cumsum(n_substitutions)
+        for n, end, field_offsets, n_subs, sub_end in zip(n_tokens, ends, offsets, n_substitutions, sub_ends):
+            substitutions = {
+                int(position): string
+                for position, string in zip(positions[sub_end - n_subs:sub_end], strings[sub_end - n_subs:sub_end])
+            }
+            fields.append(EncodedOutput(
+                token_ids=token_ids[end - n:end],
+                tokens=SubTokens(token_ids[end - n:end], substitutions=substitutions),
+                char_locs=char_locs[end - n:end],
+                offsets=field_offsets,
+            ))
+        return fields
+
+    def put(self, Xs, fields):
+        """
+        :param Xs: A list of lists of string -- [n_fields, n_segments]
+        :param fields: An `EncodedOutput` with `offsets` per field, in the format returned by `get`.
+        """
+        substitutions = [sorted(field.tokens.substitutions.items()) for field in fields]
+        data = np.concatenate([np.asarray(part, dtype='<i4') for part in (
+            [len(fields)],
+            [len(field.offsets) - 1 for field in fields],
+            [len(field.token_ids) for field in fields],
+        )] + [np.asarray(field.offsets, dtype='<i4') for field in fields]
+          + [np.asarray(field.token_ids, dtype='<i4') for field in fields]
+          + [np.asarray(field.char_locs, dtype='<i4') for field in fields]
+          + [np.asarray(part, dtype='<i4') for part in (
+              [len(field_subs) for field_subs in substitutions],
+              [value for field_subs in substitutions for position, string in field_subs
+               for value in (position, len(string))],
+              [ord(char) for field_subs in substitutions for _, string in field_subs for char in string],
+          )])
+
+        path = self._path(Xs)
+        folder = os.path.dirname(path)
+        os.makedirs(folder, exist_ok=True)
+        # write then rename, so that concurrent readers and writers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=folder)
+        with os.fdopen(fd, 'wb') as fp:
+            data.tofile(fp)
+        os.replace(tmp_path, path)
@@ -90,3 +90,24 @@ class LazySummaryHook(tf.train.SummarySaverHook):
         if not isinstance(summary_op, list):
             return [summary_op]
         return summary_op
+
+
+class FeedHook(training.SessionRunHook):
+    """
+    Feeds the placeholders returned by an input function with the next batch of a deque on every run, so that a
+    prediction session can be kept open and given batches as they arrive.  Exactly one batch must be queued per run.
+    """
+
+    def __init__(self, batches):
+        self.batches = batches
+        self.placeholders = None
+
+    def before_run(self, run_context):
+        if len(self.batches) != 1:
+            raise FinetuneError(
+                "Expected exactly one batch to be queued per prediction, found {}".format(len(self.batches))
+            )
+        batch = self.batches.popleft()
+        return training.SessionRunArgs(
+            fetches=None, feed_dict={self.placeholders[name]: batch[name] for name in self.placeholders}
+        )
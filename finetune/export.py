@@ -0,0 +1,139 @@
+"""
+Export of finetuned models as self-contained SavedModels, for serving without rebuilding the model graph.
+"""
+import os
+
+import joblib
+import numpy as np
+import tensorflow as tf
+
+from finetune.errors import FinetuneError
+from finetune.model import PredictMode
+
+PIPELINE_FILENAME = 'input_pipeline.jl'
+EXPORTED_MODES = [PredictMode.NORMAL, PredictMode.PROBAS, PredictMode.FEATURIZE]
+
+
+def _frozen_graph_def(model_fn, input_pipeline, config, session_config=None):
+    """
+    Builds the prediction graph with token id placeholders, initializes it with the finetuned weights and folds the
+    weights into the graph as constants.
+
+    :return: The frozen graph def, the names of the input tensors by feature name and of the output tensors by mode.
+    """
+    types, shapes = input_pipeline.feed_shape_type_def()
+    types, shapes = types[0], shapes[0]
+    with tf.Graph().as_default() as graph:
+        features = {
+            name: tf.placeholder(types[name], tf.TensorShape([None]).concatenate(shapes[name]), name=name)
+            for name in types
+        }
+        spec = model_fn(features, None, tf.estimator.ModeKeys.PREDICT, config)
+        outputs = {mode: spec.predictions[mode] for mode in EXPORTED_MODES if mode in spec.predictions}
+        with tf.Session(config=session_config) as sess:
+            sess.run(spec.scaffold.init_op)
+            graph_def = tf.graph_util.convert_variables_to_constants(
+                sess, graph.as_graph_def(), [tensor.op.name for tensor in outputs.values()]
+            )
+    return (
+        graph_def,
+        {name: tensor.name for name, tensor in features.items()},
+        {mode: tensor.name for mode, tensor in outputs.items()}
+    )
+
+
+def export_saved_model(path, model_fn, input_pipeline, config, session_config=None):
+    """
+    Writes a SavedModel to `path` with a signature per `PredictMode` the model supports, named by the mode and taking
+    the features of `BasePipeline.feed_shape_type_def` (token ids and lengths) with a leading batch dimension.  The
+    input pipeline is stored alongside, so that `load_exported` can encode text for it.
+    """
+    if os.path.exists(path):
+        raise FinetuneError("Cannot export to {}, it already exists".format(path))
+
+    graph_def, input_names, output_names = _frozen_graph_def(model_fn, input_pipeline, config, session_config)
+    with tf.Graph().as_default() as graph:
+        tf.import_graph_def(graph_def, name="")
+        inputs = {name: graph.get_tensor_by_name(tensor_name) for name, tensor_name in input_names.items()}
+        signatures = {
+            mode: tf.saved_model.signature_def_utils.predict_signature_def(
+                inputs=inputs, outputs={mode: graph.get_tensor_by_name(tensor_name)}
+            )
+            for mode, tensor_name in output_names.items()
+        }
+        default_mode = PredictMode.NORMAL if PredictMode.NORMAL in signatures else PredictMode.FEATURIZE
+        signatures[tf.saved_model.signature_constants.DEFAULT_SERVING_SIGNATURE_DEF_KEY] = signatures[default_mode]
+
+        builder = tf.saved_model.builder.SavedModelBuilder(path)
+        with tf.Session(graph=graph, config=session_config) as sess:
+            builder.add_meta_graph_and_variables(
+                sess, [tf.saved_model.tag_constants.SERVING], signature_def_map=signatures
+            )
+        builder.save()
+
+    extra = os.path.join(path, 'assets.extra')
+    os.makedirs(extra, exist_ok=True)
+    joblib.dump(input_pipeline, os.path.join(extra, PIPELINE_FILENAME))
+
+
+class ExportedModel(object):
+    """
+    A model loaded from a SavedModel written by `BaseModel.export`.  The graph holds the finetuned weights as
+    constants, so loading is a single graph import with no variable initialization.
+
+    `predict`, `predict_proba` and `featurize` match those of `BaseModel`, before any task specific post-processing
+    (for instance `SequenceLabeler` returns a label per token rather than labeled spans).
+    """
+
+    def __init__(self, path, session_config=None):
+        """
+        :param path: Directory the model was exported to.
+        :param session_config: Optionally, a `tf.ConfigProto` for the session.
+        """
+        try:
+            self.input_pipeline = joblib.load(os.path.join(path, 'assets.extra', PIPELINE_FILENAME))
+        except FileNotFoundError:
+            raise FinetuneError("{} does not contain a model written by `export`".format(path))
+        self.graph = tf.Graph()
+        self.sess = tf.Session(graph=self.graph, config=session_config)
+        meta_graph = tf.saved_model.loader.load(self.sess, [tf.saved_model.tag_constants.SERVING], path)
+        self.signatures = {
+            mode: signature for mode, signature in meta_graph.signature_def.items() if mode in EXPORTED_MODES
+        }
+
+    def close(self):
+        self.sess.close()
+
+    def _run(self, Xs, mode):
+        if mode not in self.signatures:
+            raise FinetuneError("The exported model does not support {}".format(mode))
+        signature = self.signatures[mode]
+        output = signature.outputs[mode].name
+        outputs = []
+        for batch in self.input_pipeline.feature_batches(Xs):
+            feed_dict = {signature.inputs[name].name: value for name, value in batch.items()}
+            outputs.extend(self.sess.run(output, feed_dict=feed_dict))
+        return outputs
+
+    def predict(self, Xs):
+        raw_preds = self._run(Xs, PredictMode.NORMAL)
+        return self.input_pipeline.label_encoder.inverse_transform(np.asarray(raw_preds))
+
+    def predict_proba(self, Xs):
+        raw_probas = self._run(Xs, PredictMode.PROBAS)
+        classes = self.input_pipeline.label_encoder.classes_
+        return [dict(zip(classes, probas)) for probas in raw_probas]
+
+    def featurize(self, Xs):
+        return np.asarray(self._run(Xs, PredictMode.FEATURIZE))
+
+
+def load_exported(path, session_config=None):
+    """
+    Loads a model written by `BaseModel.export`.
+
+    :param path: Directory the model was exported to.
+    :param session_config: Optionally, a `tf.ConfigProto` for the session.
+    :return: An `ExportedModel`.
+    """
+    return ExportedModel(path, session_config=session_config)
@@ -2,6 +2,10 @@ import itertools
 import logging
 import sys
 import math
+import json
+import hashlib
+import functools
+import copy
 
 from abc import ABCMeta, abstractmethod
 
@@ -14,11 +18,69 @@ from sklearn.model_selection import train_test_split
 
 from finetune.errors import FinetuneError
 from finetune.config import PAD_TOKEN
-from finetune.encoding import TextEncoder, ArrayEncodedOutput, EncodedOutput
+from finetune.encoding import TextEncoder, ArrayEncodedOutput, EncodedOutput, sliding_windows
+from finetune.encoding_cache import EncodingCache
+from finetune.tfrecords import EncodedDataset, write_tfrecords
 from finetune.imbalance import compute_class_weights
+from finetune.utils import pad_and_stack, iter_batches
 
 ENCODER = TextEncoder()
 LOGGER = logging.getLogger('finetune')
+# number of positional embeddings in the pretrained model, and so the default `max_length`
+PRETRAINED_MAX_LENGTH = 512
+AUTO_MAX_LENGTH_SAMPLE_SIZE = 1000
+
+
+def _iter_texts(X):
+    """
+    Yields every string contained in a (possibly nested) example.
+    """
+    if isinstance(X, str):
+        yield X
+    elif isinstance(X, (list, tuple, np.ndarray)):
+        for item in X:
+            yield from _iter_texts(item)
+
+
+def _hashable(X):
+    if isinstance(X, (list, tuple, np.ndarray)):
+        return tuple(_hashable(item) for item in X)
+    return X
+
+
+def _in_validation_split(X, val_fraction, seed=None):
+    """
+    Deterministically assigns an example to the validation set with probability `val_fraction`, by hashing its text.
+    """
+    text = json.dumps(list(_iter_texts(X)))
+    digest = hashlib.sha1('{}{}'.format(seed, text).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') / 2 ** 64 < val_fraction
+
+
+def _encoding_key(Xs, Y, max_length, pad_token):
+    # pad_token only affects the encoded labels
+    return _hashable((Xs, Y, max_length, pad_token if Y is not None else None))
+
+
+def _trim_to_length(tensor, shape, length):
+    """
+    Slices the variable length dimension of `shape`, if any, of an example that was padded for storage.
+    """
+    dims = shape.as_list()
+    if None not in dims:
+        return tensor
+    size = [-1] * len(dims)
+    size[dims.index(None)] = length
+    trimmed = tf.slice(tensor, [0] * len(dims), tf.stack(size))
+    trimmed.set_shape(shape)
+    return trimmed
+
+
+def _stack_examples(values, shape, dtype):
+    dims = shape.as_list()
+    if None in dims:
+        return pad_and_stack(values, axis=dims.index(None)).astype(dtype.as_numpy_dtype)
+    return np.asarray(values, dtype=dtype.as_numpy_dtype)
 
 
 class BasePipeline(metaclass=ABCMeta):
@@ -29,6 +91,10 @@ class BasePipeline(metaclass=ABCMeta):
         self.pad_idx_ = None
         self.rebuild = False
         self.epoch = 0
+        # text prepared ahead of encoding by `_encode_ahead`, for the group of examples being encoded
+        self._pre_encoded = {}
+        self._pretokenized = {}
+        self._cache = None
 
     @abstractmethod
     def _target_encoder(self):
@@ -37,58 +103,189 @@ class BasePipeline(metaclass=ABCMeta):
 
     def feed_shape_type_def(self):
         TS = tf.TensorShape
-        return ({"tokens": tf.int32, "mask": tf.float32}, tf.float32), (
-            {"tokens": TS([self.config.max_length, 2]), "mask": TS([self.config.max_length])}, TS([self.target_dim]))
+        return ({"tokens": tf.int32, "length": tf.int32}, tf.float32), (
+            {"tokens": TS([self._sequence_length]), "length": TS([])}, TS([self.target_dim]))
+
+    @property
+    def _sequence_length(self):
+        """
+        Length of the sequence dimension of every example, or None when batches are dynamically padded.
+        """
+        return None if self.config.dynamic_padding else self.config.max_length
 
-    def _array_format(self, encoded_output, pad_token=PAD_TOKEN):
+    @property
+    def _target_pad_value(self):
+        """
+        Value that targets with a sequence dimension are padded with when batches are dynamically padded.
+        """
+        return 0
+
+    def _array_format(self, encoded_output, pad_token=PAD_TOKEN, length=None):
         """
-        Returns numpy array of token idxs and corresponding mask
-        Returned `x` array contains two channels:
-            0: byte-pair encoding embedding
-            1: positional embedding
+        Returns numpy array of token idxs and the number of tokens before padding.  Positional indices and the
+        language model loss mask are rebuilt from these in-graph, rather than being fed with every example.
+        Arrays are padded to `length`, which defaults to `config.max_length`, or to the length of the sequence itself
+        when `config.dynamic_padding` is set and batches are padded by the input pipeline instead.
         """
         seq_length = len(encoded_output.token_ids)
-        x = np.zeros((self.config.max_length, 2), dtype=np.int32)
-        mask = np.zeros((self.config.max_length), dtype=np.float32)
+        if length is None:
+            length = seq_length if self.config.dynamic_padding else self.config.max_length
+        x = np.zeros((length), dtype=np.int32)
 
         if encoded_output.labels is not None:
-            labels_arr = np.empty((self.config.max_length), dtype='object')
+            labels_arr = np.empty((length), dtype='object')
             labels_arr.fill(pad_token)
         else:
             labels_arr = None
 
         # BPE embedding
-        x[:seq_length, 0] = encoded_output.token_ids
-        # masking: value of 1 means "consider this in cross-entropy LM loss"
-        mask[1:seq_length] = 1
-        if encoded_output.labels:
+        x[:seq_length] = encoded_output.token_ids
+        if encoded_output.labels is not None:
             labels_arr[:seq_length] = encoded_output.labels
-        # positional_embeddings
-        x[:, 1] = np.arange(ENCODER.vocab_size, ENCODER.vocab_size + self.config.max_length)
 
         return ArrayEncodedOutput(
             token_ids=x,
             tokens=encoded_output.tokens,
             labels=labels_arr,
             char_locs=encoded_output.char_locs,
-            mask=mask,
+            length=seq_length,
         )
 
     def text_to_tokens_mask(self, X, Y=None):
         out_gen = self._text_to_ids(X)
         for out in out_gen:
-            feats = {"tokens": out.token_ids, "mask": out.mask}
+            feats = {"tokens": out.token_ids, "length": out.length}
             if Y is None:
                 yield feats
             else:
                 yield feats, self.label_encoder.transform([Y])[0]
 
-    def _post_data_initialization(self, Y):
-        self.label_encoder = self._target_encoder()
-        if not callable(Y):
+    def _encode_ahead(self, examples, with_targets=False):
+        """
+        Reads examples ahead in groups and prepares all of their text in bulk, then yields the output of
+        `text_to_tokens_mask` for each example.  By default each group of `config.pretokenize_batch_size` examples is
+        tokenized with a single batched pretokenizer call.  When `config.encoding_n_jobs > 1`, groups are
+        `encoding_n_jobs` times larger and fully encoded by a pool of worker processes.
+
+        Examples are encoded through a copy of the pipeline that holds the prepared text of the current group, so
+        that streams read at the same time, such as training and validation, never see each other's groups.
+        """
+        stream = copy.copy(self)
+        n_jobs = self.config.encoding_n_jobs
+        group_size = self.config.pretokenize_batch_size * max(n_jobs, 1)
+        examples = iter(examples)
+        while True:
+            batch = list(itertools.islice(examples, group_size))
+            if not batch:
+                return
+            stream._pretokenized = {}
+            stream._pre_encoded = {}
+            if len(batch) > 1:
+                requests = list(itertools.chain.from_iterable(
+                    self._encoding_requests(*example) if with_targets else self._encoding_requests(example)
+                    for example in batch
+                ))
+                if n_jobs > 1:
+                    stream._pre_encoded = self._pre_encode(requests, n_jobs)
+                else:
+                    # documents that are chunked are streamed from the encoder a piece at a time instead
+                    stream._pretokenized = self.encoder.pretokenize(
+                        list(_iter_texts([Xs for Xs, _, max_length, _ in requests if max_length != sys.maxsize])),
+                        batch_size=self.config.pretokenize_batch_size,
+                        n_process=self.config.pretokenize_n_process
+                    )
+            for example in batch:
+                yield stream.text_to_tokens_mask(*example) if with_targets else stream.text_to_tokens_mask(example)
+
+    @property
+    def encoder(self):
+        """
+        The shared `TextEncoder`, splitting words with the `config.pretokenizer` backend.
+        """
+        return ENCODER.with_pretokenizer(self.config.pretokenizer)
+
+    @property
+    def _encoding_cache(self):
+        cache_dir = self.config.encoding_cache_dir
+        if cache_dir is None:
+            return None
+        cache = getattr(self, '_cache', None)
+        if cache is None or cache.cache_dir != cache_dir or cache.fingerprint != self.encoder.fingerprint:
+            cache = self._cache = EncodingCache(cache_dir, self.encoder.fingerprint)
+        return cache
+
+    def _pre_encode(self, requests, n_jobs):
+        groups = {}
+        for Xs, Y, max_length, pad_token in requests:
+            group = groups.setdefault((max_length, _hashable(pad_token)), (max_length, pad_token, [], []))
+            group[2].append(Xs)
+            group[3].append(Y)
+
+        pre_encoded = {}
+        for max_length, pad_token, Xs, Y in groups.values():
+            encoded = self.encoder.encode_batch(
+                Xs, Y=Y, max_length=max_length, n_jobs=n_jobs, pad_token=pad_token, cache=self._encoding_cache
+            )
+            for Xs_i, Y_i, encoded_i in zip(Xs, Y, encoded):
+                pre_encoded[_encoding_key(Xs_i, Y_i, max_length, pad_token)] = encoded_i
+        return pre_encoded
+
+    def _encoding_request(self, Xs, Y=None, pad_token=PAD_TOKEN):
+        """
+        Arguments to `encode_multi_input` for a single formatted input.
+        """
+        if self.config.chunk_long_sequences and len(Xs) == 1:
+            # can only chunk single sequence inputs
+            max_length = sys.maxsize
+        else:
+            max_length = self.config.max_length
+        return Xs, Y, max_length, pad_token
+
+    def _encoding_requests(self, X, Y=None):
+        """
+        Arguments of each `encode_multi_input` call made when running `text_to_tokens_mask(X, Y)`.
+        Subclasses that encode an example in several parts override this so those parts can be encoded ahead of time.
+        """
+        return [self._encoding_request(self._format_for_encoding(X))]
+
+    def _encode_multi_input(self, Xs, Y=None, max_length=None, pad_token=PAD_TOKEN):
+        encoded = self._pre_encoded.get(_encoding_key(Xs, Y, max_length, pad_token))
+        if encoded is None:
+            encoded = self.encoder.encode_multi_input(
+                Xs, Y=Y, max_length=max_length, pad_token=pad_token, cache=self._encoding_cache,
+                pretokenized=self._pretokenized
+            )
+        return encoded
+
+    def _encode_windows(self, Xs, Y=None, window_size=None, step_size=None, pad_token=PAD_TOKEN):
+        """
+        Overlapping windows of a single field input that is too long to be encoded in one sequence.  Unless the whole
+        document has already been encoded, or is to be cached, windows are streamed from the encoder so that the
+        whole document is never held in memory at once.
+        """
+        key = _encoding_key(Xs, Y, sys.maxsize, pad_token)
+        if key in self._pre_encoded or self._encoding_cache is not None:
+            encoded = self._encode_multi_input(Xs, Y=Y, max_length=sys.maxsize, pad_token=pad_token)
+            return sliding_windows(encoded, window_size, step_size)
+        return self.encoder.encode_windows(
+            Xs[0], Y=Y, window_size=window_size, step_size=step_size, pad_token=pad_token
+        )
+
+    def _post_data_initialization(self, Y, label_encoder=None):
+        """
+        :param Y: Targets, or a callable returning an iterator over targets, to fit the label encoder to.
+        :param label_encoder: Optionally, a label encoder that has already been fit, in which case `Y` is only used to
+            compute class weights.
+        """
+        if label_encoder is not None:
+            self.label_encoder = label_encoder
+            Y_fit = Y
+        elif not callable(Y):
+            self.label_encoder = self._target_encoder()
             Y_fit = Y
             self.label_encoder.fit(Y)
         else:
+            self.label_encoder = self._target_encoder()
             Y_fit = list(itertools.islice(Y(), 10000))
             self.label_encoder.fit(Y_fit)
 
@@ -99,7 +296,7 @@ class BasePipeline(metaclass=ABCMeta):
         if Y_fit is not None:
             self.config.class_weights = compute_class_weights(class_weights=self.config.class_weights, Y=Y_fit)
 
-    def _dataset_with_targets(self, Xs, Y, train):
+    def _dataset_with_targets(self, Xs, Y, train, keep=None):
         if not callable(Xs) and not callable(Y):
             dataset = lambda: zip(Xs, Y)
         elif callable(Xs) and callable(Y):
@@ -107,23 +304,167 @@ class BasePipeline(metaclass=ABCMeta):
         else:
             raise ValueError("Either neither or both of Xs and Y should be callable, not a mixture")
 
-        dataset_encoded = lambda: itertools.chain.from_iterable(
-            map(lambda xy: self.text_to_tokens_mask(*xy), dataset()))
+        if keep is not None:
+            unfiltered = dataset
+            dataset = lambda: ((X, y) for X, y in unfiltered() if keep(X))
+
+        dataset_encoded = lambda: itertools.chain.from_iterable(self._encode_ahead(dataset(), with_targets=True))
         shape_def = self.feed_shape_type_def()
+        if self.config.in_memory_dataset and not callable(Xs) and len(Xs):
+            dataset_encoded_list = list(dataset_encoded())
+            if self.config.chunk_long_sequences:
+                self.config.dataset_size = len(dataset_encoded_list)
+            return self._dataset_from_arrays(dataset_encoded_list, *shape_def)
         if not callable(Y) and self.config.chunk_long_sequences:
             dataset_encoded_list = list(dataset_encoded())  # come up with a more principled way to do this .
             self.config.dataset_size = len(dataset_encoded_list)
         return Dataset.from_generator(lambda: self.wrap_tqdm(dataset_encoded(), train), *shape_def)
 
-    def _dataset_without_targets(self, Xs, train):
+    def _packed_shape_type_def(self):
+        types, shapes = self.feed_shape_type_def()
+        return (
+            dict(types[0], positions=tf.int32),
+            dict(shapes[0], positions=tf.TensorShape([self._sequence_length]))
+        )
+
+    def _can_pack(self):
+        # only single sequence examples can be packed
+        _, shapes = self.feed_shape_type_def()
+        return self.config.pack_sequences and shapes[0]["tokens"].ndims == 1
+
+    def _pack_sequences(self, examples):
+        """
+        Concatenates consecutive encoded examples, each delimited by its own start and classify tokens, into sequences
+        of up to `config.max_length` tokens.  Each sequence also holds the position of every token within its example.
+        """
+        tokens = []
+        positions = []
+        for example in examples:
+            length = int(example["length"])
+            if tokens and len(tokens) + length > self.config.max_length:
+                yield self._packed_features(tokens, positions)
+                tokens = []
+                positions = []
+            tokens.extend(example["tokens"][:length])
+            positions.extend(range(length))
+        if tokens:
+            yield self._packed_features(tokens, positions)
+
+    def _packed_features(self, tokens, positions):
+        length = len(tokens) if self.config.dynamic_padding else self.config.max_length
+        x = np.zeros((length), dtype=np.int32)
+        pos = np.zeros((length), dtype=np.int32)
+        x[:len(tokens)] = tokens
+        pos[:len(positions)] = positions
+        return {"tokens": x, "length": len(tokens), "positions": pos}
+
+    def _dataset_without_targets(self, Xs, train, keep=None, pack=False):
         if not callable(Xs):
             Xs_fn = lambda: self.wrap_tqdm(Xs, train)
         else:
             Xs_fn = lambda: self.wrap_tqdm(Xs(), train)
 
-        dataset_encoded = lambda: itertools.chain.from_iterable(map(self.text_to_tokens_mask, Xs_fn()))
+        if keep is not None:
+            unfiltered = Xs_fn
+            Xs_fn = lambda: (X for X in unfiltered() if keep(X))
+
+        dataset_encoded = lambda: itertools.chain.from_iterable(self._encode_ahead(Xs_fn()))
         types, shapes = self.feed_shape_type_def()
-        return Dataset.from_generator(dataset_encoded, types[0], shapes[0])  # 0s cut out the targets
+        types, shapes = types[0], shapes[0]  # 0s cut out the targets
+        if pack:
+            unpacked = dataset_encoded
+            dataset_encoded = lambda: self._pack_sequences(unpacked())
+            types, shapes = self._packed_shape_type_def()
+        if self.config.in_memory_dataset and not callable(Xs) and len(Xs):
+            return self._dataset_from_arrays(list(dataset_encoded()), types, shapes)
+        return Dataset.from_generator(dataset_encoded, types, shapes)
+
+    def _dataset_from_records(self, records, with_targets=True):
+        records.check_config(self.config)
+        types, shapes = self.feed_shape_type_def()
+        if with_targets:
+            return records.dataset(types, shapes)
+        return records.dataset(types[0], shapes[0])
+
+    def write_tfrecords(self, path, Xs, Y=None, n_shards=1):
+        """
+        Encodes examples, with their targets if given, to sharded TFRecord files that can be read back by wrapping
+        `path` in an `EncodedDataset`.  As when training, the label encoder is fit to `Y`.
+
+        :param path: Directory to write the shards to.
+        :param Xs: Examples, or a callable returning an iterator over examples.
+        :param Y: Optionally, targets or a callable returning an iterator over targets.
+        :param n_shards: Number of files to spread the examples over.
+        :return: The number of examples written, which may exceed the number of inputs when long sequences are chunked.
+        """
+        self._resolve_max_length(Xs)
+        types, _ = self.feed_shape_type_def()
+        if Y is None:
+            examples = self._encode_ahead(Xs() if callable(Xs) else Xs)
+            targets_sample = None
+            label_encoder = None
+        else:
+            self._post_data_initialization(Y)
+            # feed_shape_type_def depends on the fitted label encoder
+            types, _ = self.feed_shape_type_def()
+            pairs = zip(Xs(), Y()) if callable(Y) else zip(Xs, Y)
+            examples = self._encode_ahead(pairs, with_targets=True)
+            targets_sample = list(itertools.islice(Y() if callable(Y) else Y, 10000))
+            label_encoder = self.label_encoder
+
+        return write_tfrecords(
+            path,
+            itertools.chain.from_iterable(examples),
+            types if Y is not None else types[0],
+            n_shards=n_shards,
+            label_encoder=label_encoder,
+            targets_sample=targets_sample,
+            max_length=self.config.max_length,
+            dynamic_padding=self.config.dynamic_padding,
+        )
+
+    def _dataset_from_arrays(self, examples, types, shapes):
+        """
+        Builds a dataset from examples that have all been encoded up front, by stacking them into contiguous arrays
+        that tf.data slices without calling back into python.  Examples of varying length are zero padded for
+        storage and trimmed back to their own length by the dataset.
+
+        :param examples: A list of the outputs of `text_to_tokens_mask`.
+        :param types: The types given by `feed_shape_type_def`, or only those of the features if there are no targets.
+        :param shapes: The shapes given by `feed_shape_type_def`, or only those of the features.
+        """
+        with_targets = isinstance(types, tuple)
+        if with_targets:
+            (feature_types, target_type), (feature_shapes, target_shape) = types, shapes
+            features, targets = zip(*examples)
+        else:
+            feature_types, feature_shapes = types, shapes
+            features = examples
+
+        lengths = np.asarray([feats["tokens"].shape[-1] for feats in features], dtype=np.int32)
+        arrays = {
+            name: _stack_examples([feats[name] for feats in features], feature_shapes[name], feature_types[name])
+            for name in feature_types
+        }
+        if with_targets:
+            arrays = (arrays, _stack_examples(targets, target_shape, target_type))
+
+        if not self.config.dynamic_padding:
+            return Dataset.from_tensor_slices(arrays)
+
+        def trim(arrays, length):
+            if with_targets:
+                features, targets = arrays
+            else:
+                features = arrays
+            features = {
+                name: _trim_to_length(value, feature_shapes[name], length) for name, value in features.items()
+            }
+            if with_targets:
+                return features, _trim_to_length(targets, target_shape, length)
+            return features
+
+        return Dataset.from_tensor_slices((arrays, lengths)).map(trim)
 
     def _integer_val_size(self, val_size):
         if isinstance(val_size, float):
@@ -157,16 +498,79 @@ class BasePipeline(metaclass=ABCMeta):
 
         return int(val_size), int(val_interval)
 
+    def _bucket_boundaries(self):
+        if self.config.bucket_boundaries is not None:
+            return list(self.config.bucket_boundaries)
+        boundaries = []
+        boundary = 16
+        while boundary < self.config.max_length:
+            boundaries.append(boundary)
+            boundary *= 2
+        return boundaries
+
+    def _batch(self, dataset, batch_size, with_targets=True, bucket=False):
+        """
+        Batches a dataset of examples.  When `config.dynamic_padding` is set, each batch is only padded to the length
+        of its longest sequence, and if `bucket` is set examples are first grouped with others of similar length.
+        """
+        if not self.config.dynamic_padding:
+            return dataset.batch(batch_size, drop_remainder=False)
+
+        types = dataset.output_types
+        if with_targets:
+            padding_values = (
+                {name: tf.constant(0, dtype=dtype) for name, dtype in types[0].items()},
+                tf.constant(self._target_pad_value, dtype=types[1])
+            )
+        else:
+            padding_values = {name: tf.constant(0, dtype=dtype) for name, dtype in types.items()}
+
+        if bucket:
+            boundaries = self._bucket_boundaries()
+            dataset = dataset.apply(tf.contrib.data.bucket_by_sequence_length(
+                element_length_func=lambda features, *targets: tf.shape(features["tokens"])[-1],
+                bucket_boundaries=boundaries,
+                bucket_batch_sizes=[batch_size] * (len(boundaries) + 1),
+                padded_shapes=dataset.output_shapes,
+                padding_values=padding_values
+            ))
+        else:
+            dataset = dataset.padded_batch(batch_size, dataset.output_shapes, padding_values)
+        return dataset
+
     def resampling(self, Xs, Y):
         return Xs, Y
 
-    def _make_dataset(self, Xs, Y, train=False):
-        if Y is not None:
-            dataset = lambda: self._dataset_with_targets(Xs, Y, train=train)
+    def _make_dataset(self, Xs, Y, train=False, keep=None, pack=False):
+        """
+        :param keep: Optionally, a function of each example that is False for examples to leave out of the dataset.
+        :param pack: Whether to pack several examples into each sequence, see `_pack_sequences`.  Only applies to
+            examples without targets.
+        """
+        if isinstance(Xs, EncodedDataset):
+            dataset = lambda: self._dataset_from_records(Xs, with_targets=Xs.with_targets)
+        elif Y is not None:
+            dataset = lambda: self._dataset_with_targets(Xs, Y, train=train, keep=keep)
         else:
-            dataset = lambda: self._dataset_without_targets(Xs, train=train)
+            dataset = lambda: self._dataset_without_targets(Xs, train=train, keep=keep, pack=pack)
         return dataset
 
+    def _hash_split_validation(self, Xs, Y, in_validation):
+        """
+        Reads the examples assigned to the validation set out of the inputs in a single pass, encoding only those.
+
+        :return: A list of the outputs of `text_to_tokens_mask` for the validation examples.
+        """
+        Xs_iter = Xs() if callable(Xs) else Xs
+        if Y is None:
+            examples = (X for X in Xs_iter if in_validation(X))
+            encoded = self._encode_ahead(examples)
+        else:
+            Y_iter = Y() if callable(Y) else Y
+            examples = ((X, y) for X, y in zip(Xs_iter, Y_iter) if in_validation(X))
+            encoded = self._encode_ahead(examples, with_targets=True)
+        return list(itertools.chain.from_iterable(encoded))
+
     def wrap_tqdm(self, gen, train):
 
         if train is None:
@@ -198,7 +602,54 @@ class BasePipeline(metaclass=ABCMeta):
 
         return internal_gen()
 
+    def _resolve_max_length(self, Xs=None):
+        """
+        When `config.max_length` is "auto", replaces it with the smallest length that holds
+        `config.max_length_percentile` percent of a sample of `Xs` without truncation.
+        """
+        if self.config.max_length != "auto":
+            return
+        if isinstance(Xs, EncodedDataset):
+            self.config.max_length = Xs.metadata["max_length"]
+            return
+
+        if Xs is None:
+            sample = []
+        elif callable(Xs):
+            sample = list(itertools.islice(Xs(), AUTO_MAX_LENGTH_SAMPLE_SIZE))
+        else:
+            sample = list(Xs)
+            if len(sample) > AUTO_MAX_LENGTH_SAMPLE_SIZE:
+                indices = np.random.RandomState(self.config.seed).choice(
+                    len(sample), AUTO_MAX_LENGTH_SAMPLE_SIZE, replace=False
+                )
+                sample = [sample[i] for i in indices]
+
+        if not sample:
+            self.config.max_length = PRETRAINED_MAX_LENGTH
+            LOGGER.info("No examples to choose max_length from, using max_length={}".format(self.config.max_length))
+            return
+
+        lengths = np.sort([
+            max(
+                len(self._encode_multi_input(Xs_req, max_length=sys.maxsize).token_ids)
+                for Xs_req, _, _, _ in self._encoding_requests(X)
+            )
+            for X in sample
+        ])
+        index = int(math.ceil(len(lengths) * self.config.max_length_percentile / 100.)) - 1
+        max_length = int(lengths[min(max(index, 0), len(lengths) - 1)])
+        if not self.config.interpolate_pos_embed:
+            max_length = min(max_length, PRETRAINED_MAX_LENGTH)
+        self.config.max_length = max_length
+        LOGGER.info(
+            "Selected max_length={} from {} sampled examples ({}th percentile), {:.2%} of which will be truncated".format(
+                max_length, len(lengths), self.config.max_length_percentile, np.mean(lengths > max_length)
+            )
+        )
+
     def get_train_input_fns(self, Xs, Y=None, batch_size=None, val_size=None):
+        self._resolve_max_length(Xs)
         self.epoch = 1
         batch_size = batch_size or self.config.batch_size
 
@@ -226,10 +677,36 @@ class BasePipeline(metaclass=ABCMeta):
 
         if Y is not None:
             self._post_data_initialization(Y)
+        elif isinstance(Xs, EncodedDataset) and Xs.with_targets:
+            self._post_data_initialization(Xs.targets_sample, label_encoder=Xs.label_encoder)
 
-        if callable(Xs) or Y is None:
+        pack = Y is None and self._can_pack()
+        if self.config.hash_val_split and (callable(Xs) or Y is None) and not isinstance(Xs, EncodedDataset):
+            self._skip_tqdm = 0
+            in_validation = functools.partial(
+                _in_validation_split,
+                val_fraction=self.config.val_size / max(self.config.dataset_size, 1),
+                seed=self.config.seed
+            )
+            val_examples = self._hash_split_validation(Xs, Y, in_validation) if self.config.val_size else []
+            self.config.val_size = len(val_examples)
+            self.config.dataset_size = max(self.config.dataset_size - self.config.val_size, 0)
+            types, shapes = self.feed_shape_type_def()
+            if Y is None:
+                types, shapes = types[0], shapes[0]
+            if pack:
+                val_examples = list(self._pack_sequences(val_examples))
+                types, shapes = self._packed_shape_type_def()
+            if val_examples:
+                val_dataset_unbatched = lambda: self._dataset_from_arrays(val_examples, types, shapes)
+            else:
+                val_dataset_unbatched = lambda: Dataset.from_generator(lambda: iter([]), types, shapes)
+            train_dataset_unbatched = lambda: self._make_dataset(
+                Xs, Y, train=True, keep=lambda X: not in_validation(X), pack=pack
+            )().shuffle(shuffle_buffer_size, seed=self.config.seed)
+        elif callable(Xs) or Y is None:
             self._skip_tqdm = val_size
-            dataset = self._make_dataset(Xs, Y, train=True)
+            dataset = self._make_dataset(Xs, Y, train=True, pack=pack)
             val_dataset_unbatched = lambda: dataset().shuffle(
                 shuffle_buffer_size, seed=self.config.seed
             ).take(self.config.val_size)
@@ -248,17 +725,122 @@ class BasePipeline(metaclass=ABCMeta):
         if self.config.chunk_long_sequences:
             train_dataset_unbatched()
 
-        val_dataset = lambda: val_dataset_unbatched().batch(batch_size, drop_remainder=False).cache().prefetch(prefetch_buffer)
-        train_dataset = lambda: train_dataset_unbatched().batch(batch_size, drop_remainder=False).repeat(
-            self.config.n_epochs).prefetch(prefetch_buffer)
+        with_targets = Y is not None or (isinstance(Xs, EncodedDataset) and Xs.with_targets)
+        val_dataset = lambda: self._batch(
+            val_dataset_unbatched(), batch_size, with_targets=with_targets
+        ).cache().prefetch(prefetch_buffer)
+        train_dataset = lambda: self._batch(
+            train_dataset_unbatched(), batch_size, with_targets=with_targets, bucket=True
+        ).repeat(self.config.n_epochs).prefetch(prefetch_buffer)
 
         return val_dataset, train_dataset, self.config.val_size, self.config.val_interval
 
+    def single_pass_input(self, Xs):
+        """
+        Adapts an iterable that can only be read once, such as a generator, to the callable input taken by
+        `get_predict_input_fn`, first resolving an "auto" `max_length` from its leading examples.
+        Other inputs are returned unchanged.
+        """
+        if callable(Xs) or isinstance(Xs, EncodedDataset) or hasattr(Xs, "__len__"):
+            return Xs
+        examples = iter(Xs)
+        if self.config.max_length == "auto":
+            head = list(itertools.islice(examples, AUTO_MAX_LENGTH_SAMPLE_SIZE))
+            self._resolve_max_length(head)
+            examples = itertools.chain(head, examples)
+        return lambda: examples
+
     def get_predict_input_fn(self, Xs, batch_size=None):
+        self._resolve_max_length(Xs)
         batch_size = batch_size or self.config.batch_size
         prefetch_buffer = 2  # breaks the pipeline to allow concurrency
-        tf_dataset = lambda: self._dataset_without_targets(Xs, train=None)
-        return lambda: tf_dataset().batch(batch_size).prefetch(prefetch_buffer)
+        if isinstance(Xs, EncodedDataset):
+            tf_dataset = lambda: self._dataset_from_records(Xs, with_targets=False)
+        else:
+            tf_dataset = lambda: self._dataset_without_targets(Xs, train=None)
+        return lambda: self._batch(tf_dataset(), batch_size, with_targets=False).prefetch(prefetch_buffer)
+
+    def feature_batches(self, Xs, batch_size=None):
+        """
+        Encodes examples into batches of stacked features, as fed to the placeholders of
+        `get_cached_predict_input_fn`.
+
+        :param Xs: Examples, or a callable returning an iterator over examples.
+        :return: A generator of dicts of feature name -> array with a leading batch dimension.
+        """
+        self._resolve_max_length(Xs)
+        batch_size = batch_size or self.config.batch_size
+        types, shapes = self.feed_shape_type_def()
+        types, shapes = types[0], shapes[0]
+        examples = itertools.chain.from_iterable(self._encode_ahead(Xs() if callable(Xs) else Xs))
+        while True:
+            batch = list(itertools.islice(examples, batch_size))
+            if not batch:
+                return
+            yield {name: _stack_examples([feats[name] for feats in batch], shapes[name], types[name]) for name in types}
+
+    def length_sorted_batches(self, Xs, windows, batch_size=None):
+        """
+        Encodes examples into batches of examples of similar length, each padded only to its longest example.
+        Examples are read `config.length_sort_window` at a time and sorted by length within each window.  As each
+        window is read, the input position of each of its examples, in the order they are batched, is appended to the
+        `windows` deque so that outputs can be put back in input order.
+
+        :param Xs: Examples, or a callable returning an iterator over examples.
+        :return: A generator of dicts of feature name -> array with a leading batch dimension.
+        """
+        self._resolve_max_length(Xs)
+        batch_size = batch_size or self.config.batch_size
+        types = self.feed_shape_type_def()[0][0]
+        examples = itertools.chain.from_iterable(self._encode_ahead(Xs() if callable(Xs) else Xs))
+        for window in iter_batches(examples, self.config.length_sort_window):
+            lengths = [np.max(feats["length"]) for feats in window]
+            order = np.argsort(lengths, kind="stable")
+            windows.append(order)
+            for batch_order in iter_batches(order, batch_size):
+                batch = [window[i] for i in batch_order]
+                batch_length = max(lengths[i] for i in batch_order)
+                yield {
+                    name: (
+                        pad_and_stack([feats[name][..., :batch_length] for feats in batch], axis=-1)
+                        if name == "tokens" else np.asarray([feats[name] for feats in batch])
+                    ).astype(types[name].as_numpy_dtype)
+                    for name in types
+                }
+
+    def _batch_shapes(self):
+        # the shapes of batches of features, with a sequence dimension of any length when batches are length sorted
+        shapes = self.feed_shape_type_def()[1][0]
+        batch_shapes = {name: tf.TensorShape([None]).concatenate(shape) for name, shape in shapes.items()}
+        if self.config.sort_by_length:
+            batch_shapes["tokens"] = tf.TensorShape([None] * batch_shapes["tokens"].ndims)
+        return batch_shapes
+
+    def get_sorted_predict_input_fn(self, Xs, windows, batch_size=None):
+        """
+        An input function of the batches of `length_sorted_batches`.
+        """
+        types = self.feed_shape_type_def()[0][0]
+        prefetch_buffer = 2  # breaks the pipeline to allow concurrency
+        return lambda: Dataset.from_generator(
+            lambda: self.length_sorted_batches(Xs, windows, batch_size=batch_size), types, self._batch_shapes()
+        ).prefetch(prefetch_buffer)
+
+    def get_cached_predict_input_fn(self, feed_hook):
+        """
+        An input function for a long-lived prediction session, of placeholders that `feed_hook` fills with a batch of
+        `feature_batches` or `length_sorted_batches` on every run.
+        """
+        types = self.feed_shape_type_def()[0][0]
+        batch_shapes = self._batch_shapes()
+
+        def input_fn():
+            feed_hook.placeholders = {
+                name: tf.placeholder(types[name], batch_shapes[name], name=name) for name in types
+            }
+            return feed_hook.placeholders
+
+        return input_fn
 
     @property
     def pad_idx(self):
@@ -280,32 +862,13 @@ class BasePipeline(metaclass=ABCMeta):
 
     def _text_to_ids(self, Xs, Y=None, pad_token=PAD_TOKEN):
         Xs = self._format_for_encoding(Xs)
-        if self.config.chunk_long_sequences and len(Xs) == 1:
-            # can only chunk single sequence inputs
+        Xs, Y, max_length, pad_token = self._encoding_request(Xs, Y=Y, pad_token=pad_token)
+        if max_length == sys.maxsize:
             chunk_size = self.config.max_length - 2
             step_size = chunk_size // 3
-            encoded = ENCODER.encode_multi_input(
-                Xs,
-                Y=Y,
-                max_length=sys.maxsize,
-                pad_token=pad_token
-            )
-            length = len(encoded.token_ids)
-            starts = list(range(0, length, step_size))
-            for start in starts:
-                d = dict()
-                end = start + chunk_size
-                for field in EncodedOutput._fields:
-                    field_value = getattr(encoded, field)
-                    if field_value is not None:
-                        d[field] = field_value[start:end]
-                yield self._array_format(EncodedOutput(**d), pad_token=pad_token)
+            for window in self._encode_windows(Xs, Y=Y, window_size=chunk_size, step_size=step_size,
+                                               pad_token=pad_token):
+                yield self._array_format(window, pad_token=pad_token)
         else:
-            encoder_out = ENCODER.encode_multi_input(
-                Xs,
-                Y=Y,
-                max_length=self.config.max_length,
-                pad_token=pad_token
-            )
-
-            yield self._array_format(encoder_out, pad_token=pad_token)
+            encoded = self._encode_multi_input(Xs, Y=Y, max_length=max_length, pad_token=pad_token)
+            yield self._array_format(encoded, pad_token=pad_token)
@@ -5,7 +5,7 @@ import tensorflow as tf
 from tensorflow.train import Scaffold
 from tensorflow.contrib.opt.python.training.weight_decay_optimizers import AdamWOptimizer
 
-from finetune.network_modules import featurizer, language_model
+from finetune.network_modules import featurizer, language_model, generate_sequences
 from finetune.utils import sample_with_temperature
 from finetune.optimizers import schedules
 from finetune.imbalance import class_weight_tensor
@@ -17,30 +17,41 @@ class PredictMode:
     NORMAL = "NORM"
     PROBAS = "PROBA"
     GENERATE_TEXT = "GEN_TEXT"
+    GENERATE_TEXT_LENGTH = "GEN_TEXT_LEN"
+    SEQUENCE_FEATURIZE = "SEQ_FEAT"
+    LENGTH = "LEN"
 
 
 def get_model_fn(target_model_fn, predict_op, predict_proba_op, build_target_model, build_lm, encoder, target_dim,
-                 label_encoder, saver):
-    def language_model_op(X, M, params, featurizer_state):
+                 label_encoder, saver, generation=None, sequence_features=False):
+    """
+    :param generation: If given, the model_fn only builds a text generation graph for prediction, with this dict of
+        keyword arguments to `generate_sequences`.
+    :param sequence_features: Whether predictions also include the features of each token and the sequence lengths.
+    """
+    def language_model_logit_mask(params):
+        # rules out the positional embeddings, and the special tokens when they are not in use
+        lm_logit_mask = np.zeros([1, encoder.vocab_size + params.max_length], dtype=np.float32)
+        lm_logit_mask[:, encoder.vocab_size:] = -np.inf
+
+        if "use_extra_toks" in params and not params.use_extra_toks:
+            lm_logit_mask[:, encoder.start] = -np.inf
+            lm_logit_mask[:, encoder.delimiter] = -np.inf
+            lm_logit_mask[:, encoder.clf_token] = -np.inf
+        return lm_logit_mask
+
+    def language_model_op(X, lengths, params, featurizer_state, positions=None):
         language_model_state = language_model(
             X=X,
-            M=M,
+            lengths=lengths,
+            positions=positions,
             config=params,
             embed_weights=featurizer_state['embed_weights'],
             hidden=featurizer_state['sequence_features'],
         )
 
         lm_logits = language_model_state["logits"]
-
-        lm_logit_mask = np.zeros([1, lm_logits.get_shape().as_list()[-1]], dtype=np.float32)
-        lm_logit_mask[:, encoder.vocab_size:] = -np.inf
-
-        if "use_extra_toks" in params and not params.use_extra_toks:
-            lm_logit_mask[:, encoder.start] = -np.inf
-            lm_logit_mask[:, encoder.delimiter] = -np.inf
-            lm_logit_mask[:, encoder.clf_token] = -np.inf
-
-        lm_logits += lm_logit_mask
+        lm_logits += language_model_logit_mask(params)
         lm_predict_op = sample_with_temperature(lm_logits, params.lm_temp)
         return lm_predict_op, language_model_state
 
@@ -63,7 +74,29 @@ def get_model_fn(target_model_fn, predict_op, predict_proba_op, build_target_mod
             )
         return target_model_state
 
+    def generation_model_fn(features, params):
+        with tf.variable_scope(tf.get_variable_scope()):
+            generated = generate_sequences(
+                X=features["tokens"],
+                lengths=features["length"],
+                encoder=encoder,
+                config=params,
+                logit_mask=language_model_logit_mask(params),
+                **generation
+            )
+        return tf.estimator.EstimatorSpec(
+            mode=tf.estimator.ModeKeys.PREDICT,
+            predictions={
+                PredictMode.GENERATE_TEXT: generated["tokens"],
+                PredictMode.GENERATE_TEXT_LENGTH: generated["lengths"]
+            },
+            scaffold=Scaffold(init_op=saver.get_scaffold_init_op())
+        )
+
     def _model_fn(features, labels, mode, params):
+        if generation is not None and mode == tf.estimator.ModeKeys.PREDICT:
+            return generation_model_fn(features, params)
+
         if "labels" in features:
             assert labels is None, "For some reason distributed tensorflow doesnt let us use labels argument"
             labels = features["labels"]
@@ -76,14 +109,20 @@ def get_model_fn(target_model_fn, predict_op, predict_proba_op, build_target_mod
         estimator_mode = mode
         train = estimator_mode == tf.estimator.ModeKeys.TRAIN
         X = features["tokens"]
-        M = features["mask"]
+        lengths = features["length"]
+        # only present when several examples are packed into each sequence
+        positions = features.get("positions")
         Y = labels
         pred_op = None
 
         with tf.variable_scope(tf.get_variable_scope()):
             train_loss = 0.0
-            featurizer_state = featurizer(X, config=params, encoder=encoder, train=train)
+            featurizer_state = featurizer(X, config=params, encoder=encoder, train=train, positions=positions)
             predictions = {PredictMode.FEATURIZE: featurizer_state["features"]}
+            if sequence_features:
+                # only fetched on request, as they are max_length times the size of the pooled features
+                predictions[PredictMode.SEQUENCE_FEATURIZE] = featurizer_state["sequence_features"]
+                predictions[PredictMode.LENGTH] = lengths
 
             if build_target_model:
                 target_model_state = target_model_op(featurizer_state=featurizer_state, Y=Y, params=params, mode=mode)
@@ -106,8 +145,9 @@ def get_model_fn(target_model_fn, predict_op, predict_proba_op, build_target_mod
                     predictions[PredictMode.PROBAS] = pred_proba_op
 
             if build_lm:
-                lm_predict_op, language_model_state = language_model_op(X=X, M=M, params=params,
-                                                                        featurizer_state=featurizer_state)
+                lm_predict_op, language_model_state = language_model_op(X=X, lengths=lengths, params=params,
+                                                                        featurizer_state=featurizer_state,
+                                                                        positions=positions)
                 if mode == tf.estimator.ModeKeys.TRAIN or mode == tf.estimator.ModeKeys.EVAL:
                     lm_loss = tf.reduce_mean(language_model_state["losses"])
                     train_loss += lm_loss_coef * lm_loss
@@ -48,6 +48,15 @@ class MultiLabelClassifier(BaseModel):
         self.config._threshold = threshold or self.config.multi_label_threshold
         return self._predict(X)
 
+    def iter_predict(self, X, threshold=None):
+        """
+        A generator version of `predict`, that yields the labels of each example as soon as its batch finishes.
+
+        :param X: An iterable of text, which is read lazily.
+        """
+        self.config._threshold = threshold or self.config.multi_label_threshold
+        return super().iter_predict(X)
+
     def predict_proba(self, X):
         """
         Produces a probability distribution over classes for each example in X.
@@ -1,13 +1,15 @@
+import itertools
+
 import numpy as np
 
-from finetune.base import BaseModel
+from finetune.base import BaseModel, PredictMode
 from finetune.input_pipeline import BasePipeline
 from finetune.encoding import ArrayEncodedOutput
 from finetune.target_encoders import IDEncoder
 import tensorflow as tf
 
 from finetune.network_modules import multi_choice_question
-from finetune.utils import list_transpose
+from finetune.utils import list_transpose, pad_and_stack
 
 class MultipleChoicePipeline(BasePipeline):
     def __init__(self, *args, **kwargs):
@@ -27,17 +29,21 @@ class MultipleChoicePipeline(BasePipeline):
 
         kwargs = arrays[0]._asdict()
         kwargs['tokens'] = [arr.tokens for arr in arrays]
-        kwargs['token_ids'] = np.stack([arr.token_ids for arr in arrays], 0)
-        kwargs['mask'] = np.stack([arr.mask for arr in arrays], 0)
+        kwargs['token_ids'] = pad_and_stack([arr.token_ids for arr in arrays])
+        kwargs['length'] = np.array([arr.length for arr in arrays], dtype=np.int32)
         yield ArrayEncodedOutput(**kwargs)
 
+    def _encoding_requests(self, Xs, Y=None):
+        q, answer_list = Xs
+        return [self._encoding_request(self._format_for_encoding([q, answer])) for answer in answer_list]
+
     def _format_for_encoding(self, X):
         return [X]
 
     def feed_shape_type_def(self):
         TS = tf.TensorShape
-        return ({"tokens": tf.int32, "mask": tf.float32}, tf.int32), (
-            {"tokens": TS([self.num_answers, self.config.max_length, 2]), "mask": TS([self.num_answers, self.config.max_length])}, TS([]))
+        return ({"tokens": tf.int32, "length": tf.int32}, tf.int32), (
+            {"tokens": TS([self.num_answers, self._sequence_length]), "length": TS([self.num_answers])}, TS([]))
 
     def _target_encoder(self):
         return IDEncoder()
@@ -149,3 +155,65 @@ class MultipleChoice(BaseModel):
         :returns: np.array of features of shape (n_examples, embedding_size).
         """
         return BaseModel.featurize(self, zip(questions, answers))
+
+    def iter_predict(self, questions, answers):
+        """
+        A generator version of `predict`, that yields the chosen answer for each question as soon as its batch
+        finishes.  `questions` and `answers` are read lazily.
+        """
+        answers, answers_for_inference = itertools.tee(answers)
+        raw_ids = BaseModel.iter_predict(self, zip(questions, answers_for_inference))
+        for ans, i in zip(answers, raw_ids):
+            yield ans[i]
+
+    def iter_predict_proba(self, questions, answers):
+        """
+        A generator version of `predict_proba`, that yields a dictionary from each answer to its probability as soon
+        as its batch finishes.  `questions` and `answers` are read lazily.
+        """
+        answers, answers_for_inference = itertools.tee(answers)
+        raw_probas = self._inference_stream(zip(questions, answers_for_inference), PredictMode.PROBAS)
+        for probas, answers_per_sample in zip(raw_probas, answers):
+            yield dict(zip(answers_per_sample, probas))
+
+    def iter_featurize(self, questions, answers):
+        """
+        A generator version of `featurize`, that yields the features of each question as soon as its batch finishes.
+        `questions` and `answers` are read lazily.
+        """
+        return BaseModel.iter_featurize(self, zip(questions, answers))
+
+    async def apredict(self, questions, answers):
+        """
+        A coroutine version of `predict`, see `BaseModel.apredict`.
+        """
+        return await self._abatched("predict", questions, answers)
+
+    async def apredict_proba(self, questions, answers):
+        """
+        A coroutine version of `predict_proba`, see `BaseModel.apredict`.
+        """
+        return await self._abatched("predict_proba", questions, answers)
+
+    async def afeaturize(self, questions, answers):
+        """
+        A coroutine version of `featurize`, see `BaseModel.apredict`.
+        """
+        return np.asarray(await self._abatched("featurize", questions, answers))
+
+    def featurize_to_file(self, questions, answers, path, dtype=np.float16, include_sequence=False):
+        """
+        Writes the features of each question to memory-mapped numpy files in the folder `path`, see
+        `BaseModel.featurize_to_file`.  The sequence features of each question hold the tokens of each of its answers in
+        turn, with the number of tokens of each answer in lengths.npy.
+
+        :param questions: List or array of text, shape [batch]
+        :param answers: List or array of text, shape [n_answers, batch]
+        :param path: Folder to write to.  Created if it does not exist.
+        :param dtype: Numpy dtype the features are stored as.
+        :param include_sequence: Whether to also store the features of each token.
+        :returns: features.npy, opened as a read-only memory-mapped array.
+        """
+        return BaseModel.featurize_to_file(
+            self, list(zip(questions, answers)), path, dtype=dtype, include_sequence=include_sequence
+        )
@@ -3,8 +3,8 @@ import functools
 import tensorflow as tf
 from tensorflow.contrib.crf import crf_log_likelihood
 
-from finetune.transformer import dropout, embed, block, attn, norm
-from finetune.utils import shape_list, merge_leading_dims
+from finetune.transformer import dropout, embed, block, cached_block, attn, norm
+from finetune.utils import shape_list, merge_leading_dims, sample_with_temperature
 from finetune.recompute_grads import recompute_grad
 
 
@@ -27,22 +27,26 @@ def perceptron(x, ny, config, w_init=None, b_init=None):
         return tf.matmul(x, w) + b
 
 
-def featurizer(X, encoder, config, train=False, reuse=None):
+def featurizer(X, encoder, config, train=False, reuse=None, positions=None, return_kv=False):
     """
     The transformer element of the finetuning model. Maps from tokens ids to a dense, embedding of the sequence.
 
-    :param X: A tensor of token indexes with shape [batch_size, sequence_length, token_idx]
+    :param X: A tensor of token indexes with shape [batch_size, sequence_length]
     :param encoder: A TextEncoder object.
     :param config: A config object, containing all parameters for the featurizer.
     :param train: If this flag is true, dropout and losses are added to the graph.
     :param reuse: Should reuse be set within this scope.
+    :param positions: Optionally, the position of each token within its own example, when several examples are packed
+        into each sequence.  Tokens then only attend to tokens of the same example.
+    :param return_kv: If true, the attention keys and values of each layer are also returned, to start decoding from.
     :return: A dict containing;
         embed_weights: the word embedding matrix.
         features: The output of the featurizer_final state.
         sequence_features: The output of the featurizer at each timestep.
+        kv_cache: If `return_kv`, a list of the (keys, values) of each layer, see `cached_attn`.
     """
-    initial_shape = [a or -1 for a in X.get_shape().as_list()]
-    X = tf.reshape(X, shape=[-1] + initial_shape[-2:])
+    initial_shape = shape_list(X)
+    X = tf.reshape(X, shape=[-1, initial_shape[-1]])
 
     with tf.variable_scope('model/featurizer', reuse=reuse):
         embed_weights = tf.get_variable("we", [encoder.vocab_size + config.max_length, config.n_embed],
@@ -52,9 +56,18 @@ def featurizer(X, encoder, config, train=False, reuse=None):
         else:
             embed_weights = tf.stop_gradient(embed_weights)
 
-        X = tf.reshape(X, [-1, config.max_length, 2])
+        if positions is None:
+            positions = tf.zeros_like(X) + tf.range(shape_list(X)[1])
+            segments = None
+        else:
+            positions = tf.reshape(positions, shape_list(X))
+            # a new example starts at every position 0
+            segments = tf.cumsum(tf.to_int32(tf.equal(positions, 0)), axis=1)
+        # positional indices follow the vocabulary in the embedding matrix
+        X = tf.stack([X, encoder.vocab_size + positions], -1)
 
         h = embed(X, embed_weights)
+        kv_cache = []
         for layer in range(config.n_layer):
             if (layer - config.n_layer) == config.num_layers_trained and config.num_layers_trained != 12:
                 h = tf.stop_gradient(h)
@@ -65,44 +78,57 @@ def featurizer(X, encoder, config, train=False, reuse=None):
             with tf.variable_scope('h%d_' % layer):
                 block_fn = functools.partial(block, n_head=config.n_heads, act_fn=config.act_fn,
                                              resid_pdrop=config.resid_p_drop, attn_pdrop=config.attn_p_drop,
-                                             scope='h%d' % layer, train=train_layer, scale=True)
+                                             scope='h%d' % layer, train=train_layer, scale=True, segments=segments)
                 if config.low_memory_mode and train_layer:
                     block_fn = recompute_grad(block_fn, use_entire_scope=True)
-                h = block_fn(h)
+                if return_kv:
+                    h, kv = block_fn(h, return_kv=True)
+                    kv_cache.append(kv)
+                else:
+                    h = block_fn(h)
 
         # Use hidden state at classifier token as input to final proj. + softmax
         clf_h = tf.reshape(h, [-1, config.n_embed])  # [batch * seq_len, embed]
         clf_token = encoder['_classify_']
         pool_idx = tf.cast(tf.argmax(tf.cast(tf.equal(X[:, :, 0], clf_token), tf.float32), 1), tf.int32)
-        clf_h = tf.gather(clf_h, tf.range(shape_list(X)[0], dtype=tf.int32) * config.max_length + pool_idx)
-        clf_h = tf.reshape(clf_h, shape=initial_shape[: -2] + [config.n_embed])
-        seq_feats = tf.reshape(h, shape=initial_shape[:-1] + [config.n_embed])
+        clf_h = tf.gather(clf_h, tf.range(shape_list(X)[0], dtype=tf.int32) * shape_list(X)[1] + pool_idx)
+        clf_h = tf.reshape(clf_h, shape=initial_shape[:-1] + [config.n_embed])
+        seq_feats = tf.reshape(h, shape=initial_shape + [config.n_embed])
 
-        return {
+        featurizer_state = {
             'embed_weights': embed_weights,
             'features': clf_h,
             'sequence_features': seq_feats
         }
+        if return_kv:
+            featurizer_state['kv_cache'] = kv_cache
+        return featurizer_state
 
 
-def language_model(*, X, M, embed_weights, hidden, config, reuse=None):
+def language_model(*, X, lengths, embed_weights, hidden, config, reuse=None, positions=None):
     """
     A language model output and loss for the language modelling objective described in the original finetune paper.
     This language model uses weights that are tied to the input embedding.
     :param X: The raw token ids fed to the featurizer.
-    :param M: A loss mask, with 1's where losses should be counted and 0's elsewhere.
+    :param lengths: The number of tokens in each sequence of X, from which the loss mask is built.
     :param embed_weights: The word embedding matrix, normally the one returned by the featurizer.
     :param hidden: Output of the featurizer.
     :param config: A config object.
     :param reuse: A Flag passed through to the tf.variable_scope context manager.
+    :param positions: Optionally, the position of each token within its own example, when several examples are packed
+        into each sequence.  The first token of each example is then not predicted from the previous example.
     :return: A dict containing:
         logits: The un-normalised log-probabilities over each word in the vocabulary.
         loss: The masked language modelling loss.
 
     """
-    X = merge_leading_dims(X, 3)
-    M = merge_leading_dims(M, 2)
+    X = merge_leading_dims(X, 2)
+    lengths = tf.reshape(lengths, [-1])
     hidden = merge_leading_dims(hidden, 3)
+    # 1's where losses should be counted and 0's over padding, the loss on the first token is never counted
+    M = tf.sequence_mask(lengths, shape_list(X)[1], dtype=tf.float32)
+    if positions is not None:
+        M *= tf.to_float(tf.reshape(positions, shape_list(X)) > 0)
 
     with tf.variable_scope('model/language-model', reuse=reuse):
         # language model ignores last hidden state because we don't have a target
@@ -111,7 +137,7 @@ def language_model(*, X, M, embed_weights, hidden, config, reuse=None):
         lm_logits = tf.matmul(lm_h, embed_weights, transpose_b=True)  # tied weights
         lm_losses = tf.nn.sparse_softmax_cross_entropy_with_logits(
             logits=lm_logits,
-            labels=tf.reshape(X[:, 1:, 0], [-1])
+            labels=tf.reshape(X[:, 1:], [-1])
         )
 
         lm_losses = tf.reshape(lm_losses, [shape_list(X)[0], shape_list(X)[1] - 1])
@@ -127,6 +153,150 @@ def language_model(*, X, M, embed_weights, hidden, config, reuse=None):
         }
 
 
+def _cached_decoder_step(tokens, index, embed_weights, kv_cache, encoder, config):
+    """
+    Runs one new token of each sequence through the featurizer, reading and extending the attention cache of every
+    layer, and returns the final hidden state of that token.
+    """
+    with tf.variable_scope('model/featurizer', reuse=True):
+        # positions past the end only occur for sequences that have finished, whose outputs are discarded
+        positions = tf.minimum(index, config.max_length - 1)
+        h = tf.gather(embed_weights, tokens) + tf.gather(embed_weights, encoder.vocab_size + positions)
+        h = h[:, None, :]
+        new_kv_cache = []
+        for layer, kv in enumerate(kv_cache):
+            with tf.variable_scope('h%d_' % layer):
+                h, kv = cached_block(h, n_head=config.n_heads, act_fn=config.act_fn, scope='h%d' % layer, kv=kv,
+                                     index=index, scale=True)
+                new_kv_cache.append(kv)
+        return h[:, 0], new_kv_cache
+
+
+def _kv_shape_invariants(config):
+    head_dim = config.n_embed // config.n_heads
+    return (
+        tf.TensorShape([None, config.n_heads, head_dim, None]),
+        tf.TensorShape([None, config.n_heads, None, head_dim])
+    )
+
+
+def _top_k_logits(logits, k):
+    # rules out all but the k most likely tokens
+    kth_largest = tf.nn.top_k(logits, k=k).values[:, -1:]
+    return logits - 1e9 * tf.to_float(logits < kth_largest)
+
+
+def _tile_beams(x, num_beams):
+    # [batch, ...] -> [batch * num_beams, ...], with the beams of each example next to each other
+    x_shape = shape_list(x)
+    tiled = tf.tile(x[:, None], [1, num_beams] + [1] * (len(x_shape) - 1))
+    return tf.reshape(tiled, [x_shape[0] * num_beams] + x_shape[1:])
+
+
+def generate_sequences(*, X, lengths, encoder, config, logit_mask, max_length, num_beams=1, top_k=None,
+                       reuse=None):
+    """
+    Extends each sequence of X with tokens from the language model, one token at a time, until the classify token is
+    chosen or the sequence holds `max_length` tokens.  Each sequence stops independently of the others in its batch.
+    The attention keys and values of every layer are cached, so each step runs only the newest token through the
+    transformer and computes logits for that token alone.
+
+    With `num_beams` of 1, tokens are sampled with temperature `config.lm_temp`, from the `top_k` most likely tokens
+    if given.  Otherwise a beam search keeps the `num_beams` sequences of highest total log probability and the best
+    one is returned.
+
+    :param X: The token ids of the seed sequences, padded to `config.max_length`, [batch, max_length].
+    :param lengths: The number of seed tokens in each sequence, at least 1, [batch].
+    :param encoder: A TextEncoder object.
+    :param config: A config object.
+    :param logit_mask: Added to the language model logits before sampling, to rule out some tokens.
+    :param max_length: The longest sequence to generate, at most `config.max_length`.
+    :param num_beams: The number of hypotheses kept for each sequence by beam search, or 1 to sample.
+    :param top_k: Optionally, the number of most likely tokens to sample from.
+    :param reuse: A Flag passed through to the tf.variable_scope context manager.
+    :return: A dict containing:
+        tokens: The seed tokens followed by the generated tokens, [batch, max_length].
+        lengths: The number of tokens of each sequence in `tokens`.
+    """
+    featurizer_state = featurizer(X, encoder=encoder, config=config, train=False, reuse=reuse, return_kv=True)
+    embed_weights = featurizer_state['embed_weights']
+    batch_size = shape_list(X)[0]
+    # the hidden state of the last seed token predicts the first new token
+    hidden = tf.gather_nd(
+        featurizer_state['sequence_features'], tf.stack([tf.range(batch_size), lengths - 1], axis=1)
+    )
+    kv_cache = featurizer_state['kv_cache']
+    eos = encoder.clf_token
+    n_ctx = shape_list(X)[1]
+    max_length = tf.minimum(max_length, n_ctx)
+
+    if num_beams > 1:
+        X, lengths, hidden = [_tile_beams(x, num_beams) for x in (X, lengths, hidden)]
+        kv_cache = [(_tile_beams(keys, num_beams), _tile_beams(values, num_beams)) for keys, values in kv_cache]
+        # only the first hypothesis of each sequence is extended at the first step, so that the beams differ
+        scores = tf.reshape(tf.tile([[0.] + [-1e9] * (num_beams - 1)], [batch_size, 1]), [-1])
+    else:
+        scores = tf.zeros([batch_size])
+
+    def choose_tokens(hidden, scores, finished):
+        """
+        :return: The next token of each sequence, the sequence it extends and the sequence's new score.
+        """
+        logits = tf.matmul(hidden, embed_weights, transpose_b=True) + logit_mask
+        if num_beams == 1:
+            if top_k:
+                logits = _top_k_logits(logits, top_k)
+            next_tokens = tf.to_int32(sample_with_temperature(logits, config.lm_temp))
+            return next_tokens, None, scores
+
+        log_probs = tf.nn.log_softmax(logits)
+        n_logits = shape_list(log_probs)[1]
+        # finished hypotheses are kept by a single placeholder extension that leaves their score unchanged
+        placeholder = tf.one_hot(tf.zeros_like(scores, dtype=tf.int32), n_logits, on_value=0., off_value=-1e9)
+        log_probs = tf.where(finished, placeholder, log_probs)
+        candidates = tf.reshape(scores[:, None] + log_probs, [batch_size, num_beams * n_logits])
+        scores, choices = tf.nn.top_k(candidates, k=num_beams)
+        parents = choices // n_logits + tf.range(batch_size)[:, None] * num_beams
+        return tf.reshape(choices % n_logits, [-1]), tf.reshape(parents, [-1]), tf.reshape(scores, [-1])
+
+    def body(tokens, index, finished, scores, hidden, kv_cache):
+        next_tokens, parents, scores = choose_tokens(hidden, scores, finished)
+        if parents is not None:
+            tokens, index, finished = [tf.gather(x, parents) for x in (tokens, index, finished)]
+            kv_cache = [(tf.gather(keys, parents), tf.gather(values, parents)) for keys, values in kv_cache]
+        write = tf.one_hot(index, n_ctx, dtype=tf.int32) * tf.to_int32(tf.logical_not(finished))[:, None]
+        tokens = tokens * (1 - write) + next_tokens[:, None] * write
+        hidden, kv_cache = _cached_decoder_step(next_tokens, index, embed_weights, kv_cache, encoder, config)
+        index += tf.to_int32(tf.logical_not(finished))
+        finished = tf.logical_or(
+            finished, tf.logical_or(tf.equal(next_tokens, eos), index >= max_length)
+        )
+        return tokens, index, finished, scores, hidden, kv_cache
+
+    tokens, lengths, _, _, _, _ = tf.while_loop(
+        cond=lambda tokens, index, finished, *_: tf.logical_not(tf.reduce_all(finished)),
+        body=body,
+        loop_vars=(X, lengths, lengths >= max_length, scores, hidden, kv_cache),
+        shape_invariants=(
+            tf.TensorShape([None, None]),
+            tf.TensorShape([None]),
+            tf.TensorShape([None]),
+            tf.TensorShape([None]),
+            tf.TensorShape([None, config.n_embed]),
+            [_kv_shape_invariants(config)] * config.n_layer
+        ),
+        back_prop=False
+    )
+    if num_beams > 1:
+        # hypotheses are kept in order of score, so the first of each sequence is the best
+        tokens = tf.reshape(tokens, [batch_size, num_beams, n_ctx])[:, 0]
+        lengths = tf.reshape(lengths, [batch_size, num_beams])[:, 0]
+    return {
+        'tokens': tokens,
+        'lengths': lengths
+    }
+
+
 def _apply_class_weight(losses, targets, class_weights=None):
     if class_weights is not None:
         # loss multiplier applied based on true class
@@ -308,6 +478,9 @@ def sequence_labeler(hidden, targets, n_targets, config, pad_id, multilabel=Fals
             logits = class_reweighting(class_weights)(logits)
 
         log_likelihood = 0.0
+        if targets is not None:
+            # every timestep of the padded batch is scored
+            sequence_lengths = tf.fill([tf.shape(targets)[0]], tf.shape(targets)[1])
         if multilabel:
             transition_params = []
             logits_individual = tf.unstack(logits, n_targets, axis=-1)
@@ -321,7 +494,7 @@ def sequence_labeler(hidden, targets, n_targets, config, pad_id, multilabel=Fals
                     log_likelihood += crf_log_likelihood(
                         logits[-1],
                         targets_individual[i],
-                        kwargs.get('max_length') * tf.ones(tf.shape(targets)[0]),
+                        sequence_lengths,
                         transition_params=transition_params[-1]
                     )[0]
             logits = tf.stack(logits, axis=-1)
@@ -331,7 +504,7 @@ def sequence_labeler(hidden, targets, n_targets, config, pad_id, multilabel=Fals
                 log_likelihood, _ = crf_log_likelihood(
                     logits,
                     targets,
-                    kwargs.get('max_length') * tf.ones(tf.shape(targets)[0]),
+                    sequence_lengths,
                     transition_params=transition_params
                 )
 
@@ -0,0 +1,141 @@
+"""
+Cache of model outputs, keyed by the model and the example they were computed from.
+"""
+import os
+import sys
+import json
+import pickle
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# bumped whenever the entry layout changes, so that stale entries are never read
+CACHE_FORMAT_VERSION = 1
+
+
+def _normalize(X):
+    # lists, tuples and arrays of the same text are the same example
+    if isinstance(X, (list, tuple, np.ndarray)):
+        return [_normalize(item) for item in X]
+    if isinstance(X, str):
+        return str(X)
+    return repr(X)
+
+
+def _nbytes(value):
+    """
+    Approximate memory held by an output, counting the data of arrays rather than their python wrappers.
+    """
+    if isinstance(value, (np.ndarray, np.generic)):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(_nbytes(k) + _nbytes(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(_nbytes(item) for item in value)
+    return sys.getsizeof(value)
+
+
+class PredictionCache(object):
+    """
+    Keeps the outputs of a model for each example it has seen, so that repeated examples skip encoding and inference.
+    The most recently used outputs are kept in memory up to `max_bytes`, and if `cache_dir` is given every output is
+    also written there, one pickle per entry, to outlive the process and the memory budget.
+
+    Entries are keyed by a hash of a model fingerprint, the kind of output and the example, see `key`.
+    """
+
+    def __init__(self, max_bytes, cache_dir=None):
+        """
+        :param max_bytes: Approximate memory that cached outputs may take up.
+        :param cache_dir: Optionally, a directory to store every cached output in.  Created if it does not exist.
+        """
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(fingerprint, name, X):
+        """
+        :param fingerprint: A string that identifies the model and its settings.
+        :param name: The kind of output, for instance a `PredictMode`.
+        :param X: A single example.
+        """
+        text = json.dumps(_normalize(X), ensure_ascii=False)
+        return hashlib.sha1(
+            '{}{}{}{}'.format(CACHE_FORMAT_VERSION, fingerprint, name, text).encode('utf-8')
+        ).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.pkl')
+
+    def get(self, key):
+        """
+        :return: Whether the entry was found, and its value if it was.
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, self._entries[key][0]
+
+        if self.cache_dir is not None:
+            try:
+                with open(self._path(key), 'rb') as fp:
+                    value = pickle.load(fp)
+            except (FileNotFoundError, NotADirectoryError):
+                pass
+            else:
+                self._remember(key, value)
+                with self._lock:
+                    self.hits += 1
+                return True, value
+
+        with self._lock:
+            self.misses += 1
+        return False, None
+
+    def put(self, key, value):
+        if isinstance(value, np.ndarray) and value.base is not None:
+            # a row of a batch would otherwise keep the whole batch alive
+            value = value.copy()
+        self._remember(key, value)
+        if self.cache_dir is not None:
+            path = self._path(key)
+            folder = os.path.dirname(path)
+            os.makedirs(folder, exist_ok=True)
+            # write then rename, so that concurrent readers and writers never see a partial entry
+            fd, tmp_path = tempfile.mkstemp(dir=folder)
+            with os.fdopen(fd, 'wb') as fp:
+                pickle.dump(value, fp, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+
+    def _remember(self, key, value):
+        size = _nbytes(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.nbytes -= evicted_size
+
+    def clear(self):
+        """
+        Forgets the outputs held in memory.  Entries on disk are kept.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,275 @@
+"""
+Pre-tokenizers split text into the word-level tokens that are byte-pair encoded by `TextEncoder`.
+"""
+import re
+import functools
+from abc import ABCMeta, abstractmethod
+from collections import namedtuple
+
+from finetune.errors import FinetuneError
+
+DEFAULT_PRETOKENIZER = 'spacy'
+PRETOKENIZE_BATCH_SIZE = 128
+
+Token = namedtuple("Token", [
+    "text",  # token string (str)
+    "idx",   # character offset of the token in the original text (int)
+])
+
+
+class Pretokenizer(object, metaclass=ABCMeta):
+    """
+    Splits text into tokens exposing `.text` and `.idx`, the same interface as spacy tokens.
+    """
+
+    @abstractmethod
+    def __call__(self, text):
+        pass
+
+    def pipe(self, texts, batch_size=PRETOKENIZE_BATCH_SIZE, n_process=1):
+        """
+        Tokenize many texts at once.
+
+        :param texts: An iterable of strings.
+        :param batch_size: Number of texts processed together.
+        :param n_process: Number of processes, for backends that support it.
+        :return: An iterator over the tokens of each text.
+        """
+        return (self(text) for text in texts)
+
+
+class SpacyPretokenizer(Pretokenizer):
+    """
+    Tokenizes with spacy's english tokenizer.  The spacy model is only loaded on first use.
+    """
+
+    @property
+    def nlp(self):
+        if not hasattr(self, '_nlp'):
+            import spacy
+            self._nlp = spacy.load('en', disable=['parser', 'tagger', 'ner', 'textcat'])
+        return self._nlp
+
+    def __call__(self, text):
+        return self.nlp(text)
+
+    def pipe(self, texts, batch_size=PRETOKENIZE_BATCH_SIZE, n_process=1):
+        # older spacy versions don't support multiprocessing in `pipe`
+        kwargs = {'n_process': n_process} if n_process != 1 else {}
+        return self.nlp.pipe(texts, batch_size=batch_size, **kwargs)
+
+
+_HYPHENS = r'-|–|—|--|---|——|~'
+_QUOTES = '\'"”“`‘´’‚,„»«「」『』（）〔〕【】《》〈〉'
+_PUNCT = '…,:;!?¿؟¡()[]{}<>_#*&。？！，、；：～·।،؛٪'
+_CURRENCY = r'\$|£|€|¥|฿|US\$|C\$|A\$|₽|﷼|₴'
+_UNITS = (
+    r'km|km²|km³|m|m²|m³|dm|dm²|dm³|cm|cm²|cm³|mm|mm²|mm³|ha|µm|nm|yd|in|ft|kg|g|mg|µg|t|lb|oz|m/s|km/h|kmh|mph|'
+    r'hPa|Pa|mbar|mb|MB|kb|KB|gb|GB|tb|TB|T|G|M|K|%'
+)
+_ALPHA = r'[^\W\d_]'
+_LOWER = 'a-zß-öø-ÿ'
+_UPPER = 'A-ZÀ-ÖØ-Þ'
+
+_PREFIX_RE = re.compile('|'.join(
+    ['§', '%', '=', '—', '–', r'\+(?![0-9])', r'\.\.+'] +
+    [re.escape(char) for char in _PUNCT + _QUOTES] +
+    [_CURRENCY]
+).join(['^(?:', ')']))
+
+_SUFFIX_RE = re.compile('|'.join(
+    [r'\.\.+', "'s", "'S", '’s', '’S', '—', '–'] +
+    [re.escape(char) for char in _PUNCT + _QUOTES] +
+    [
+        r'(?<=[0-9])\+',
+        r'(?<=°[FfCcKk])\.',
+        r'(?<=[0-9])(?:{})'.format(_CURRENCY),
+        r'(?<=[0-9])(?:{})'.format(_UNITS),
+        r'(?<=[0-9{}%²\-\)\]\+{}])\.'.format(_LOWER, re.escape(_QUOTES)),
+        r'(?<=[{u}][{u}])\.'.format(u=_UPPER),
+    ]
+).join(['(?:', ')$']))
+
+_INFIX_RE = re.compile('|'.join([
+    r'\.\.+',
+    '…',
+    r'(?<=[0-9])[+\-\*^](?=[0-9-])',
+    r'(?<=[{}])\.(?=[{}])'.format(_LOWER, _UPPER),
+    r'(?<={a}),(?={a})'.format(a=_ALPHA),
+    r'(?<={a})[?";:=,.]*(?:{h})(?={a})'.format(a=_ALPHA, h=_HYPHENS),
+    r'(?<={a}|")[:<>=/](?={a})'.format(a=_ALPHA),
+]))
+
+_WORD_RE = re.compile(r'\S+')
+_URL_RE = re.compile(r'^(?:https?://|www\.)\S+$', re.IGNORECASE)
+
+_PRONOUNS = ['i', 'you', 'he', 'she', 'it', 'we', 'they', 'who', 'what', 'there', 'that']
+_NEGATED_VERBS = [
+    'ai', 'are', 'ca', 'could', 'did', 'do', 'does', 'had', 'has', 'have', 'is', 'may', 'might', 'must', 'need',
+    'ought', 'sha', 'should', 'was', 'were', 'wo', 'would'
+]
+_ABBREVIATIONS = [
+    'mr.', 'mrs.', 'ms.', 'dr.', 'st.', 'jr.', 'sr.', 'prof.', 'inc.', 'ltd.', 'co.', 'corp.', 'vs.', 'etc.',
+    'e.g.', 'i.e.', 'a.m.', 'p.m.', 'u.s.', 'u.k.', 'no.', 'mt.', 'gov.', 'jan.', 'feb.', 'mar.', 'apr.', 'jun.',
+    'jul.', 'aug.', 'sep.', 'sept.', 'oct.', 'nov.', 'dec.'
+]
+
+
+def _special_cases():
+    """
+    Lower cased tokenizer exceptions, mapping a string to the lengths of the tokens it is split into.
+    """
+    cases = {}
+    for verb in _NEGATED_VERBS:
+        for negation in ["n't", "nt", "n’t"]:
+            cases[verb + negation] = (len(verb), len(negation))
+    for pronoun in _PRONOUNS:
+        for apostrophe in ["'", "’"]:
+            for suffix in ['m', 'll', 've', 're', 'd']:
+                cases[pronoun + apostrophe + suffix] = (len(pronoun), len(suffix) + 1)
+    for orth in ['cannot', 'gonna', 'gotta']:
+        cases[orth] = (3, 3) if orth == 'cannot' else (3, 2)
+    for orth in _ABBREVIATIONS + [char + '.' for char in 'abcdefghijklmnopqrstuvwxyz']:
+        cases[orth] = (len(orth),)
+    return cases
+
+
+_SPECIAL_CASES = _special_cases()
+
+
+def _special_case(string):
+    return _SPECIAL_CASES.get(string.lower())
+
+
+def _split_special_case(string, lengths):
+    spans = []
+    start = 0
+    for length in lengths:
+        spans.append((start, length))
+        start += length
+    return spans
+
+
+def _split_infixes(string, offset):
+    spans = []
+    start = 0
+    for match in _INFIX_RE.finditer(string):
+        infix_start, infix_end = match.span()
+        if infix_start == 0:
+            continue
+        if infix_start != start:
+            spans.append((offset + start, infix_start - start))
+        if infix_start != infix_end:
+            spans.append((offset + infix_start, infix_end - infix_start))
+        start = infix_end
+    if start < len(string):
+        spans.append((offset + start, len(string) - start))
+    return spans
+
+
+@functools.lru_cache(maxsize=2 ** 16)
+def _split_word(word):
+    """
+    Splits a string containing no whitespace into tokens using spacy's english prefix, suffix, infix and exception
+    rules.
+
+    :return: A tuple of (offset, length) for each token, relative to the start of `word`.
+    """
+    special = _special_case(word)
+    if special:
+        return tuple(_split_special_case(word, special))
+    if word.isalpha() or word.isdigit() or _URL_RE.match(word):
+        return ((0, len(word)),)
+
+    prefixes = []
+    suffixes = []
+    start, end = 0, len(word)
+    while start < end:
+        string = word[start:end]
+        if _special_case(string):
+            break
+        prefix = _PREFIX_RE.search(string)
+        pre_len = prefix.end() if prefix else 0
+        if pre_len and _special_case(string[pre_len:]):
+            prefixes.append((start, pre_len))
+            start += pre_len
+            break
+        suffix = _SUFFIX_RE.search(string[pre_len:])
+        suf_len = len(suffix.group()) if suffix else 0
+        if suf_len and _special_case(string[:-suf_len]):
+            suffixes.append((end - suf_len, suf_len))
+            end -= suf_len
+            break
+        if pre_len and suf_len and pre_len + suf_len <= len(string):
+            prefixes.append((start, pre_len))
+            suffixes.append((end - suf_len, suf_len))
+            start += pre_len
+            end -= suf_len
+        elif pre_len:
+            prefixes.append((start, pre_len))
+            start += pre_len
+        elif suf_len:
+            suffixes.append((end - suf_len, suf_len))
+            end -= suf_len
+        else:
+            break
+
+    spans = list(prefixes)
+    if start < end:
+        string = word[start:end]
+        special = _special_case(string)
+        if special:
+            spans.extend((start + offset, length) for offset, length in _split_special_case(string, special))
+        else:
+            spans.extend(_split_infixes(string, start))
+    spans.extend(reversed(suffixes))
+    return tuple(spans)
+
+
+class RegexPretokenizer(Pretokenizer):
+    """
+    A pure python re-implementation of the boundaries produced by spacy's english tokenizer.  It has no load time and
+    avoids spacy's per-call overhead.  Exceptions are limited to common contractions and abbreviations, so rare
+    special cases may be split differently from spacy.
+    """
+
+    def __call__(self, text):
+        tokens = []
+        end = 0
+        for match in _WORD_RE.finditer(text):
+            start = match.start()
+            if start != end:
+                # as in spacy, a single space following a token is attached to that token rather than emitted
+                ws_start = end + 1 if end > 0 and text[end] == ' ' else end
+                if ws_start < start:
+                    tokens.append(Token(text[ws_start:start], ws_start))
+            word = match.group()
+            end = match.end()
+            spans = _split_word(word)
+            if len(spans) == 1:
+                tokens.append(Token(word, start))
+            else:
+                tokens.extend(Token(word[offset:offset + length], start + offset) for offset, length in spans)
+        ws_start = end + 1 if end > 0 and text[end:end + 1] == ' ' else end
+        if ws_start < len(text):
+            tokens.append(Token(text[ws_start:], ws_start))
+        return tokens
+
+
+PRETOKENIZERS = {
+    'spacy': SpacyPretokenizer,
+    'regex': RegexPretokenizer,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def get_pretokenizer(name=DEFAULT_PRETOKENIZER):
+    """
+    :param name: One of `PRETOKENIZERS`.
+    :return: A shared instance of the named pre-tokenizer.
+    """
+    if name not in PRETOKENIZERS:
+        raise FinetuneError(
+            "Unknown pretokenizer {}, expected one of {}".format(name, sorted(PRETOKENIZERS))
+        )
+    return PRETOKENIZERS[name]()
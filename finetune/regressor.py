@@ -42,6 +42,15 @@ class Regressor(BaseModel):
         """
         return super().predict(X).tolist()
 
+    def iter_predict(self, X):
+        """
+        A generator version of `predict`, that yields the prediction for each example as soon as its batch finishes.
+
+        :param X: An iterable of text, which is read lazily.
+        """
+        for prediction in super().iter_predict(X):
+            yield prediction.tolist()
+
     def predict_proba(self, X):
         """
         Produces a probability distribution over classes for each example in X.
@@ -51,6 +60,9 @@ class Regressor(BaseModel):
         """
         raise AttributeError("`Regressor` model does not support `predict_proba`.")
 
+    def iter_predict_proba(self, X):
+        raise AttributeError("`Regressor` model does not support `predict_proba`.")
+
     def finetune(self, X, Y=None, batch_size=None):
         """
         :param X: list or array of text.
@@ -2,6 +2,7 @@ import itertools
 import math
 import warnings
 import copy
+from collections import deque
 
 import tensorflow as tf
 import numpy as np
@@ -19,47 +20,63 @@ class SequencePipeline(BasePipeline):
     def __init__(self, config, multi_label):
         super(SequencePipeline, self).__init__(config)
         self.multi_label = multi_label
+        # when set to a deque, the character offsets of the chunks of each document are appended as it is encoded
+        self.chunk_locs = None
 
-    def _post_data_initialization(self, Y):
+    def _post_data_initialization(self, Y, label_encoder=None):
         Y_ = list(itertools.chain.from_iterable(Y))
-        super()._post_data_initialization(Y_)
+        super()._post_data_initialization(Y_, label_encoder=label_encoder)
+
+    @property
+    def _pad_token(self):
+        return [self.config.pad_token] if self.multi_label else self.config.pad_token
 
     def text_to_tokens_mask(self, X, Y=None):
-        pad_token = [self.config.pad_token] if self.multi_label else self.config.pad_token
-        out_gen = self._text_to_ids(X, Y=Y, pad_token=pad_token)
+        out_gen = self._text_to_ids(X, Y=Y, pad_token=self._pad_token)
+        if Y is None and self.chunk_locs is not None:
+            out_gen = list(out_gen)
+            self.chunk_locs.append([out.char_locs for out in out_gen])
         for out in out_gen:
-            feats = {"tokens": out.token_ids, "mask": out.mask}
+            feats = {"tokens": out.token_ids, "length": out.length}
             if Y is None:
                 yield feats
             else:
                 yield feats, self.label_encoder.transform(out.labels)
 
+    def _encoding_requests(self, X, Y=None):
+        return [self._encoding_request(self._format_for_encoding(X), Y=Y, pad_token=self._pad_token)]
+
     def _format_for_encoding(self, X):
         return [X]
 
     def feed_shape_type_def(self):
         TS = tf.TensorShape
         target_shape = (
-            [self.config.max_length, self.label_encoder.target_dim] 
-            if self.multi_label else [self.config.max_length]
+            [self._sequence_length, self.label_encoder.target_dim]
+            if self.multi_label else [self._sequence_length]
         )
         return (
             (
                 {
                     "tokens": tf.int32,
-                    "mask": tf.float32
+                    "length": tf.int32
                 },
                 tf.int32
             ), 
             (
                 {
-                    "tokens": TS([self.config.max_length, 2]), 
-                    "mask": TS([self.config.max_length])
+                    "tokens": TS([self._sequence_length]),
+                    "length": TS([])
                 }, 
                 TS(target_shape)
             )
         )
 
+    @property
+    def _target_pad_value(self):
+        # padded timesteps of multi-label targets are left all zero, as the pad class is excluded from the loss
+        return 0 if self.multi_label else self.pad_idx
+
     def _target_encoder(self):
         if self.multi_label:
             return SequenceMultiLabelingEncoder()
@@ -104,13 +121,24 @@ class SequenceLabeler(BaseModel):
         return super()._initialize()
 
     def finetune(self, Xs, Y=None, batch_size=None):
-        Xs, Y_new = indico_to_finetune_sequence(Xs, labels=Y, multi_label=self.multi_label, none_value="<PAD>")
+        Xs, Y_new = indico_to_finetune_sequence(
+            Xs, labels=Y, multi_label=self.multi_label, none_value="<PAD>", pretokenizer=self.config.pretokenizer
+        )
         Y = Y_new if Y is not None else None
         return super().finetune(Xs, Y=Y, batch_size=batch_size)
 
-    def _inference(self, Xs, mode=None):
-        Xs = [[x] for x in Xs]
-        return super()._inference(Xs, mode=mode)
+    def _inference_stream(self, Xs, mode=None, input_pipeline=None, sequence_features=False):
+        if callable(Xs):
+            docs = Xs
+            Xs = lambda: ([x] for x in docs())
+        elif hasattr(Xs, "__len__"):
+            Xs = [[x] for x in Xs]
+        else:
+            Xs = ([x] for x in Xs)
+        # long documents are split into several chunks, so outputs are cached per document by `iter_predict` instead
+        return self._run_inference(
+            Xs, mode=mode, input_pipeline=input_pipeline, sequence_features=sequence_features
+        )
 
     def predict(self, X):
         """
@@ -119,93 +147,129 @@ class SequenceLabeler(BaseModel):
         :param X: A list / array of text, shape [batch]
         :returns: list of class labels.
         """
+        return list(self.iter_predict(X))
+
+    def iter_predict(self, X):
+        """
+        A generator version of `predict`, that yields the annotations of each document as soon as the batches holding
+        its chunks finish.
+
+        :param X: An iterable of text, which is read lazily.
+        """
+        return self._with_prediction_cache("annotations", X, self._iter_annotations)
+
+    def _iter_annotations(self, X):
+        if hasattr(X, "__len__") and not callable(X):
+            self.input_pipeline._resolve_max_length(X)
+            inference_input = X
+            next_doc = iter(X).__next__
+        else:
+            # documents are recorded as the input pipeline reads them, ahead of their predictions
+            X = self.input_pipeline.single_pass_input(X)
+            read_docs = deque()
+
+            def inference_input():
+                for x in X():
+                    read_docs.append(x)
+                    yield x
+
+            next_doc = read_docs.popleft
+
         chunk_size = self.config.max_length - 2
         step_size = chunk_size // 3
-        arr_encoded = list(itertools.chain.from_iterable(self.input_pipeline._text_to_ids([x]) for x in X))
-        labels, batch_probas = [], []
-        for pred in self._inference(X, mode=None):
-            labels.append(self.input_pipeline.label_encoder.inverse_transform(pred[PredictMode.NORMAL]))
-            batch_probas.append(pred[PredictMode.PROBAS])
+        # a copy of the pipeline records the offsets of each document's chunks as it encodes them, ahead of their
+        # predictions
+        input_pipeline = copy.copy(self.input_pipeline)
+        input_pipeline.chunk_locs = deque()
+        predictions = self._inference_stream(inference_input, mode=None, input_pipeline=input_pipeline)
 
+        doc_texts = []
         all_subseqs = []
         all_labels = []
         all_probs = []
 
-        doc_idx = -1
-        for chunk_idx, (label_seq, proba_seq) in enumerate(zip(labels, batch_probas)):
-
-            position_seq = arr_encoded[chunk_idx].char_locs
-            start_of_doc = arr_encoded[chunk_idx].token_ids[0][0] == ENCODER.start
-            end_of_doc = (
-                    chunk_idx + 1 >= len(arr_encoded) or
-                    arr_encoded[chunk_idx + 1].token_ids[0][0] == ENCODER.start
-            )
-            """
-            Chunk idx for prediction.  Dividers at `step_size` increments.
-            [  1  |  1  |  2  |  3  |  3  ]
-            """
-            start, end = 0, None
-            if start_of_doc:
-                # if this is the first chunk in a document, start accumulating from scratch
-                doc_subseqs = []
-                doc_labels = []
-                doc_probs = []
-                doc_idx += 1
-                start_of_token = 0
-                if not end_of_doc:
-                    end = step_size * 2
-            else:
-                if end_of_doc:
-                    # predict on the rest of sequence
-                    start = step_size
+        for pred in predictions:
+            doc_text = next_doc()
+            doc_chunk_locs = input_pipeline.chunk_locs.popleft()
+            doc_subseqs = []
+            doc_labels = []
+            doc_probs = []
+            start_of_token = 0
+            for chunk_idx, position_seq in enumerate(doc_chunk_locs):
+                if chunk_idx > 0:
+                    pred = next(predictions)
+                label_seq = self.input_pipeline.label_encoder.inverse_transform(pred[PredictMode.NORMAL])
+                proba_seq = pred[PredictMode.PROBAS]
+                start_of_doc = chunk_idx == 0
+                end_of_doc = chunk_idx == len(doc_chunk_locs) - 1
+                """
+                Chunk idx for prediction.  Dividers at `step_size` increments.
+                [  1  |  1  |  2  |  3  |  3  ]
+                """
+                start, end = 0, None
+                if start_of_doc:
+                    if not end_of_doc:
+                        end = step_size * 2
                 else:
-                    # predict only on middle third
-                    start, end = step_size, step_size * 2
-            
-            label_seq = label_seq[start:end]
-            position_seq = position_seq[start:end]
-            proba_seq = proba_seq[start:end]
-
-            for label, position, proba in zip(label_seq, position_seq, proba_seq):
-                if position == -1:
-                    # indicates padding / special tokens
-                    continue
-
-                # if there are no current subsequence
-                # or the current subsequence has the wrong label
-                if not doc_subseqs or label != doc_labels[-1]:
-                    # start new subsequence
-                    doc_subseqs.append(X[doc_idx][start_of_token:position])
-                    doc_labels.append(label)
-                    doc_probs.append([proba])
-                else:
-                    # continue appending to current subsequence
-                    doc_subseqs[-1] += X[doc_idx][start_of_token:position]
-                    doc_probs[-1].append(proba)
-
-                start_of_token = position
-
-            if end_of_doc:
-                # last chunk in a document
-                prob_dicts = []
-                for prob_seq in doc_probs:
-                    # format probabilities as dictionary
-                    probs = np.mean(np.vstack(prob_seq), axis=0)
-                    prob_dicts.append(dict(zip(self.input_pipeline.label_encoder.classes_, probs)))
-                    if self.multi_label:
-                        del prob_dicts[-1][self.config.pad_token]
-
-                all_subseqs.append(doc_subseqs)
-                all_labels.append(doc_labels)
-                all_probs.append(prob_dicts)
+                    if end_of_doc:
+                        # predict on the rest of sequence
+                        start = step_size
+                    else:
+                        # predict only on middle third
+                        start, end = step_size, step_size * 2
+
+                label_seq = label_seq[start:end]
+                position_seq = position_seq[start:end]
+                proba_seq = proba_seq[start:end]
+
+                for label, position, proba in zip(label_seq, position_seq, proba_seq):
+                    if position == -1:
+                        # indicates padding / special tokens
+                        continue
+
+                    # if there are no current subsequence
+                    # or the current subsequence has the wrong label
+                    if not doc_subseqs or label != doc_labels[-1]:
+                        # start new subsequence
+                        doc_subseqs.append(doc_text[start_of_token:position])
+                        doc_labels.append(label)
+                        doc_probs.append([proba])
+                    else:
+                        # continue appending to current subsequence
+                        doc_subseqs[-1] += doc_text[start_of_token:position]
+                        doc_probs[-1].append(proba)
+
+                    start_of_token = position
+
+            prob_dicts = []
+            for prob_seq in doc_probs:
+                # format probabilities as dictionary
+                probs = np.mean(np.vstack(prob_seq), axis=0)
+                prob_dicts.append(dict(zip(self.input_pipeline.label_encoder.classes_, probs)))
+                if self.multi_label:
+                    del prob_dicts[-1][self.config.pad_token]
+
+            doc_texts.append(doc_text)
+            all_subseqs.append(doc_subseqs)
+            all_labels.append(doc_labels)
+            all_probs.append(prob_dicts)
+            if len(doc_texts) >= self.config.batch_size:
+                yield from self._to_indico_sequence(doc_texts, all_subseqs, all_labels, all_probs)
+                doc_texts, all_subseqs, all_labels, all_probs = [], [], [], []
+
+        if doc_texts:
+            yield from self._to_indico_sequence(doc_texts, all_subseqs, all_labels, all_probs)
+
+    def _to_indico_sequence(self, raw_texts, subseqs, labels, probs):
+        # maps documents back to character offsets several at a time, so that they are pretokenized together
         _, doc_annotations = finetune_to_indico_sequence(
-            raw_texts=X,
-            subseqs=all_subseqs,
-            labels=all_labels,
-            probs=all_probs,
-            subtoken_predictions=self.config.subtoken_predictions
+            raw_texts=raw_texts,
+            subseqs=subseqs,
+            labels=labels,
+            probs=probs,
+            subtoken_predictions=self.config.subtoken_predictions,
+            pretokenizer=self.config.pretokenizer
         )
-
         return doc_annotations
 
     def featurize(self, X):
@@ -226,6 +290,12 @@ class SequenceLabeler(BaseModel):
         """
         return self.predict(X)
 
+    def iter_predict_proba(self, X):
+        """
+        A generator version of `predict_proba`, see `iter_predict`.
+        """
+        return self.iter_predict(X)
+
     def _target_model(self, featurizer_state, targets, n_outputs, train=False, reuse=None, **kwargs):
         return sequence_labeler(
             hidden=featurizer_state['sequence_features'],
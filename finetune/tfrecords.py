@@ -0,0 +1,178 @@
+"""
+Sharded TFRecord files of encoded examples, so that corpora too large to hold in memory are only encoded once.
+"""
+import os
+import glob
+
+import joblib
+import numpy as np
+import tensorflow as tf
+
+from finetune.errors import FinetuneError
+
+METADATA_FILENAME = 'metadata.jl'
+SHARD_FILENAME = 'shard-{:05d}-of-{:05d}.tfrecord'
+SHARD_GLOB = 'shard-*-of-*.tfrecord'
+N_PARALLEL_CALLS = 8
+
+
+def _feature(values, dtype):
+    values = np.asarray(values).ravel()
+    if dtype.is_integer:
+        return tf.train.Feature(int64_list=tf.train.Int64List(value=values.astype(np.int64)))
+    return tf.train.Feature(float_list=tf.train.FloatList(value=values.astype(np.float32)))
+
+
+def _components(types, shapes):
+    """
+    Flattens the structure given by `feed_shape_type_def` into a dict of name -> (type, shape), with targets (if any)
+    stored under the name "targets".
+    """
+    if isinstance(types, tuple):
+        (feature_types, target_type), (feature_shapes, target_shape) = types, shapes
+        components = {name: (feature_types[name], feature_shapes[name]) for name in feature_types}
+        components["targets"] = (target_type, target_shape)
+        return components
+    return {name: (types[name], shapes[name]) for name in types}
+
+
+def serialize_example(example, types):
+    """
+    :param example: An output of `BasePipeline.text_to_tokens_mask`, either features or (features, targets).
+    :param types: The matching types given by `BasePipeline.feed_shape_type_def`.
+    :return: The example as a serialized `tf.train.Example`.
+    """
+    if isinstance(types, tuple):
+        features, targets = example
+        arrays = dict(features, targets=targets)
+        types = dict(types[0], targets=types[1])
+    else:
+        arrays = example
+    feature = {}
+    for name, dtype in types.items():
+        value = np.asarray(arrays[name])
+        feature[name] = _feature(value, dtype)
+        feature[name + "_shape"] = _feature(value.shape, tf.int64)
+    return tf.train.Example(features=tf.train.Features(feature=feature)).SerializeToString()
+
+
+def parse_example(serialized, types, shapes):
+    """
+    Inverse of `serialize_example`, in-graph.  Only the features are parsed if `types` does not include targets.
+    """
+    components = _components(types, shapes)
+    spec = {}
+    for name, (dtype, _) in components.items():
+        spec[name] = tf.VarLenFeature(tf.int64 if dtype.is_integer else tf.float32)
+        spec[name + "_shape"] = tf.VarLenFeature(tf.int64)
+    parsed = tf.parse_single_example(serialized, spec)
+
+    tensors = {}
+    for name, (dtype, shape) in components.items():
+        value = tf.cast(tf.sparse_tensor_to_dense(parsed[name]), dtype)
+        value = tf.reshape(value, tf.to_int32(tf.sparse_tensor_to_dense(parsed[name + "_shape"])))
+        value.set_shape(shape)
+        tensors[name] = value
+
+    if isinstance(types, tuple):
+        targets = tensors.pop("targets")
+        return tensors, targets
+    return tensors
+
+
+def write_tfrecords(path, examples, types, n_shards=1, **metadata):
+    """
+    Writes examples round-robin to `n_shards` TFRecord files in the directory `path`, along with their metadata.
+    Shards previously written to `path` are removed.
+
+    :param examples: An iterable of outputs of `BasePipeline.text_to_tokens_mask`.
+    :param types: The matching types given by `BasePipeline.feed_shape_type_def`.
+    :return: The number of examples written.
+    """
+    os.makedirs(path, exist_ok=True)
+    for filename in glob.glob(os.path.join(path, SHARD_GLOB)):
+        os.remove(filename)
+
+    writers = [
+        tf.python_io.TFRecordWriter(os.path.join(path, SHARD_FILENAME.format(i, n_shards)))
+        for i in range(n_shards)
+    ]
+    n_examples = 0
+    try:
+        for example in examples:
+            writers[n_examples % n_shards].write(serialize_example(example, types))
+            n_examples += 1
+    finally:
+        for writer in writers:
+            writer.close()
+
+    joblib.dump(dict(metadata, n_examples=n_examples), os.path.join(path, METADATA_FILENAME))
+    return n_examples
+
+
+class EncodedDataset(object):
+    """
+    A directory of sharded TFRecord files written by `BaseModel.write_tfrecords`, that can be passed to `finetune`,
+    `predict` and `featurize` in place of text.  All shards are read concurrently and parsed by tf.data, so no python
+    code runs per example.
+    """
+
+    def __init__(self, path, n_parallel_calls=N_PARALLEL_CALLS):
+        """
+        :param path: Directory the examples were written to.
+        :param n_parallel_calls: Number of examples parsed in parallel.
+        """
+        self.path = path
+        self.n_parallel_calls = n_parallel_calls
+        try:
+            self.metadata = joblib.load(os.path.join(path, METADATA_FILENAME))
+        except FileNotFoundError:
+            raise FinetuneError("{} does not contain examples written by `write_tfrecords`".format(path))
+
+    @property
+    def files(self):
+        return sorted(glob.glob(os.path.join(self.path, SHARD_GLOB)))
+
+    @property
+    def with_targets(self):
+        return self.metadata["label_encoder"] is not None
+
+    @property
+    def label_encoder(self):
+        return self.metadata["label_encoder"]
+
+    @property
+    def targets_sample(self):
+        return self.metadata["targets_sample"]
+
+    def __len__(self):
+        return self.metadata["n_examples"]
+
+    def check_config(self, config):
+        if config.max_length != self.metadata["max_length"]:
+            raise FinetuneError(
+                "Examples in {} were encoded with max_length={}, but config.max_length is {}".format(
+                    self.path, self.metadata["max_length"], config.max_length
+                )
+            )
+        if self.metadata["dynamic_padding"] and not config.dynamic_padding:
+            raise FinetuneError(
+                "Examples in {} were encoded with dynamic_padding=True, so must be read with dynamic padding".format(
+                    self.path
+                )
+            )
+
+    def dataset(self, types, shapes):
+        """
+        :param types: The types given by `BasePipeline.feed_shape_type_def`, or only those of the features.
+        :param shapes: The matching shapes.
+        :return: A `tf.data.Dataset` of the parsed examples, in the order they were written.
+        """
+        files = self.files
+        dataset = tf.data.Dataset.from_tensor_slices(files)
+        # examples were written round-robin, so reading one from each shard in turn restores their original order
+        dataset = dataset.apply(tf.contrib.data.parallel_interleave(
+            tf.data.TFRecordDataset, cycle_length=max(1, len(files)), block_length=1
+        ))
+        return dataset.map(lambda serialized: parse_example(serialized, types, shapes),
+                           num_parallel_calls=self.n_parallel_calls)
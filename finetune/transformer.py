@@ -23,15 +23,18 @@ def dropout(x, pdrop, train):
     return x
 
 
-def mask_attn_weights(w):
+def mask_attn_weights(w, segments=None):
     n = shape_list(w)[-1]
     b = tf.matrix_band_part(tf.ones([n, n]), -1, 0)
     b = tf.reshape(b, [1, 1, n, n])
+    if segments is not None:
+        # tokens only attend to earlier tokens of the same segment
+        b = b * tf.to_float(tf.equal(segments[:, None, :, None], segments[:, None, None, :]))
     w = w * b + -1e9 * (1 - b)
     return w
 
 
-def _attn(q, k, v, attn_pdrop, train=False, scale=False, mask=True):
+def _attn(q, k, v, attn_pdrop, train=False, scale=False, mask=True, segments=None):
     w = tf.matmul(q, k)
 
     if scale:
@@ -39,7 +42,7 @@ def _attn(q, k, v, attn_pdrop, train=False, scale=False, mask=True):
         w = w * tf.rsqrt(tf.cast(n_state, tf.float32))
 
     if mask:
-        w = mask_attn_weights(w)
+        w = mask_attn_weights(w, segments=segments)
     w = tf.nn.softmax(w)
 
     w = dropout(w, attn_pdrop, train)
@@ -85,22 +88,59 @@ def conv1d(x, scope, nf, rf, w_init=tf.random_normal_initializer(stddev=0.02), b
         return c
 
 
-def attn(x, scope, n_state, n_head, resid_pdrop, attn_pdrop, train=False, scale=False, mask=True):
+def _split_qkv(x, n_state, n_head, train=False):
+    c = conv1d(x, 'c_attn', n_state * 3, 1, train=train)
+    q, k, v = tf.split(c, 3, 2)
+    return split_heads(q, n_head), split_heads(k, n_head, k=True), split_heads(v, n_head)
+
+
+def attn(x, scope, n_state, n_head, resid_pdrop, attn_pdrop, train=False, scale=False, mask=True, segments=None,
+         return_kv=False):
     assert n_state % n_head == 0
     with tf.variable_scope(scope):
-        c = conv1d(x, 'c_attn', n_state * 3, 1, train=train)
-        q, k, v = tf.split(c, 3, 2)
-        q = split_heads(q, n_head)
-        k = split_heads(k, n_head, k=True)
-        v = split_heads(v, n_head)
+        q, k, v = _split_qkv(x, n_state, n_head, train=train)
         a = _attn(q, k, v, attn_pdrop=attn_pdrop, train=train, scale=scale,
-                  mask=mask)
+                  mask=mask, segments=segments)
         a = merge_heads(a)
         a = conv1d(a, 'c_proj', n_state, 1, train=train)
         a = dropout(a, resid_pdrop, train)
+        if return_kv:
+            return a, (k, v)
         return a
 
 
+def cached_attn(x, scope, n_state, n_head, kv, index, scale=False):
+    """
+    Masked self-attention for a single new position of each sequence, against the keys and values cached for the
+    positions before it.
+
+    :param x: The input at the new position, [batch, 1, n_state].
+    :param kv: Cached keys [batch, n_head, head_dim, n_ctx] and values [batch, n_head, n_ctx, head_dim], as returned
+        by `attn` with `return_kv=True`.
+    :param index: The position of `x` in each sequence, [batch].  Its key and value are written to the cache there.
+    :return: The attention output and the updated cache.
+    """
+    assert n_state % n_head == 0
+    with tf.variable_scope(scope):
+        q, k, v = _split_qkv(x, n_state, n_head)
+        keys, values = kv
+        n_ctx = shape_list(keys)[-1]
+        write = tf.one_hot(index, n_ctx)
+        keys = keys * (1 - write[:, None, None, :]) + k * write[:, None, None, :]
+        values = values * (1 - write[:, None, :, None]) + v * write[:, None, :, None]
+
+        w = tf.matmul(q, keys)
+        if scale:
+            w = w * tf.rsqrt(tf.cast(shape_list(v)[-1], tf.float32))
+        visible = tf.sequence_mask(index + 1, n_ctx, dtype=tf.float32)[:, None, None, :]
+        w = w * visible + -1e9 * (1 - visible)
+        w = tf.nn.softmax(w)
+
+        a = merge_heads(tf.matmul(w, values))
+        a = conv1d(a, 'c_proj', n_state, 1)
+        return a, (keys, values)
+
+
 def mlp(x, scope, n_state, act_fn, resid_pdrop, train=False):
     with tf.variable_scope(scope):
         nx = shape_list(x)[-1]
@@ -111,16 +151,35 @@ def mlp(x, scope, n_state, act_fn, resid_pdrop, train=False):
         return h2
 
 
-def block(x, n_head, act_fn, resid_pdrop, attn_pdrop, scope, train=False, scale=False):
+def block(x, n_head, act_fn, resid_pdrop, attn_pdrop, scope, train=False, scale=False, segments=None,
+          return_kv=False):
     with tf.variable_scope(scope):
         nx = shape_list(x)[-1]
-        a = attn(x, 'attn', nx, n_head, resid_pdrop, attn_pdrop, train=train, scale=scale)
+        a = attn(x, 'attn', nx, n_head, resid_pdrop, attn_pdrop, train=train, scale=scale, segments=segments,
+                 return_kv=return_kv)
+        if return_kv:
+            a, kv = a
         n = norm(x + a, 'ln_1')
         m = mlp(n, 'mlp', nx * 4, act_fn, resid_pdrop, train=train)
         h = norm(n + m, 'ln_2')
+        if return_kv:
+            return h, kv
         return h
 
 
+def cached_block(x, n_head, act_fn, scope, kv, index, scale=False):
+    """
+    A `block` applied to one new position of each sequence, see `cached_attn`.
+    """
+    with tf.variable_scope(scope):
+        nx = shape_list(x)[-1]
+        a, kv = cached_attn(x, 'attn', nx, n_head, kv, index, scale=scale)
+        n = norm(x + a, 'ln_1')
+        m = mlp(n, 'mlp', nx * 4, act_fn, resid_pdrop=0.)
+        h = norm(n + m, 'ln_2')
+        return h, kv
+
+
 def embed(X, we):
     e = tf.gather(we, X)
     #    h = add_timing_signal_1d(e[:, :, 0])
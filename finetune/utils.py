@@ -1,17 +1,31 @@
 import os
+import itertools
 import warnings
 import numpy as np
 import tensorflow as tf
 from scipy import interpolate
 
-from finetune.encoding import NLP
+from finetune.pretokenizers import get_pretokenizer, DEFAULT_PRETOKENIZER
 from finetune import config
 
 def merge_leading_dims(X, target_rank):
-    shape = [-1] + X.get_shape().as_list()[1 - target_rank:]
+    shape = [-1] + shape_list(X)[1 - target_rank:]
     return tf.reshape(X, shape)
 
 
+def pad_and_stack(arrays, axis=0):
+    """
+    Stacks arrays that may differ in length along `axis`, zero padding each to the longest.
+    """
+    length = max(array.shape[axis] for array in arrays)
+    padded = []
+    for array in arrays:
+        pad_width = [(0, 0)] * array.ndim
+        pad_width[axis] = (0, length - array.shape[axis])
+        padded.append(np.pad(array, pad_width, 'constant'))
+    return np.stack(padded, 0)
+
+
 def interpolate_pos_embed(positional_embed, new_len):
     xx = np.linspace(0, 512, new_len)
     newKernel = interpolate.RectBivariateSpline(np.arange(positional_embed.shape[0]),
@@ -72,6 +86,18 @@ def flatten(outer):
     return [el for inner in outer for el in inner]
 
 
+def iter_batches(iterable, batch_size):
+    """
+    Yields lists of up to `batch_size` consecutive items of `iterable`.
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
 def list_transpose(l):
     return [list(i) for i in zip(*l)]
 
@@ -102,7 +128,7 @@ def truncate_text(text, max_chars=100):
 
 
 def finetune_to_indico_sequence(raw_texts, subseqs, labels, probs=None, none_value=config.PAD_TOKEN,
-                                subtoken_predictions=False):
+                                subtoken_predictions=False, pretokenizer=DEFAULT_PRETOKENIZER):
     """
     Maps from the labeled substring format into the 'indico' format. This is the exact inverse operation to
     :meth indico_to_finetune_sequence:.
@@ -127,11 +153,14 @@ def finetune_to_indico_sequence(raw_texts, subseqs, labels, probs=None, none_val
     :param data: A list of segmented text of the form list(list(str))
     :param labels: Categorical labels for each sub-string in data.
     :param none_value: The none value used to encode the input format.
+    :param pretokenizer: Name of the pretokenizer used to find token boundaries.
     :return: Texts, annoatations both in the 'indico' format.
     """
     annotations = []
-    for raw_text, doc_seq, label_seq, prob_seq in zip(raw_texts, subseqs, labels, probs or [None] * len(raw_texts)):
-        tokens = NLP(raw_text)
+    docs = get_pretokenizer(pretokenizer).pipe(raw_texts)
+    for raw_text, tokens, doc_seq, label_seq, prob_seq in zip(
+        raw_texts, docs, subseqs, labels, probs or [None] * len(raw_texts)
+    ):
         token_starts = [token.idx for token in tokens]
         token_ends = [token.idx + len(token.text) for token in tokens]
         n_tokens = len(tokens)
@@ -208,7 +237,7 @@ def finetune_to_indico_sequence(raw_texts, subseqs, labels, probs=None, none_val
 
 
 def indico_to_finetune_sequence(texts, labels=None, multi_label=True, none_value=config.PAD_TOKEN,
-                                subtoken_labels=False):
+                                subtoken_labels=False, pretokenizer=DEFAULT_PRETOKENIZER):
     """
     Maps from the 'indico' format sequence labeling data. Into a labeled substring format. This is the exact inverse of
     :meth finetune_to_indico_sequence:.
@@ -234,6 +263,7 @@ def indico_to_finetune_sequence(texts, labels=None, multi_label=True, none_value
     :param texts: A list of raw text.
     :param labels: A list of targets of the form list(list(dict))).
     :param none_value: A categorical label to use as the none value.
+    :param pretokenizer: Name of the pretokenizer used to find token boundaries.
     :return: Segmented Text, Labels of the form described above.
     """
     all_subseqs = []
@@ -243,8 +273,7 @@ def indico_to_finetune_sequence(texts, labels=None, multi_label=True, none_value
     if labels is None:
         labels = [[]] * len(texts)
 
-    for text, label_seq in zip(texts, labels):
-        tokens = NLP(text)
+    for text, tokens, label_seq in zip(texts, get_pretokenizer(pretokenizer).pipe(texts), labels):
         token_starts = [token.idx for token in tokens]
         token_ends = [token.idx + len(token.text) for token in tokens]
         n_tokens = len(tokens)
@@ -0,0 +1,155 @@
+"""
+Precompiled, memory-mapped form of the byte-pair encoding vocabulary and merges.
+"""
+import os
+import json
+import codecs
+import shutil
+import tempfile
+import logging
+from collections.abc import Mapping
+
+import numpy as np
+
+LOGGER = logging.getLogger('finetune')
+
+VOCAB_ARRAYS = ['encoder_keys', 'encoder_values', 'decoder_keys', 'decoder_values', 'merge_keys', 'merge_ranks']
+
+
+class ArrayMapping(Mapping):
+    """
+    A mapping backed by a sorted array of keys and an array of values, so that both arrays can be memory-mapped and
+    loaded without parsing json.  The arrays are converted to a dict on first use, as dict lookups are far faster
+    than a binary search over the arrays in the inner loop of byte-pair encoding.  Items may be assigned, as with a
+    dict.
+    """
+
+    def __init__(self, keys, values, parse_key=None):
+        """
+        :param keys: Sorted array of keys.
+        :param values: Array of values, aligned with `keys`.
+        :param parse_key: Optionally, a function that converts a key of `keys` to the format it is looked up by.
+        """
+        self.keys_ = keys
+        self.values_ = values
+        self.parse_key = parse_key
+        self._items = None
+
+    @property
+    def items_(self):
+        if self._items is None:
+            keys = self.keys_.tolist()
+            if self.parse_key is not None:
+                keys = map(self.parse_key, keys)
+            self._items = dict(zip(keys, self.values_.tolist()))
+        return self._items
+
+    def __getitem__(self, key):
+        return self.items_[key]
+
+    def __setitem__(self, key, value):
+        self.items_[key] = value
+
+    def __contains__(self, key):
+        return key in self.items_
+
+    def get(self, key, default=None):
+        return self.items_.get(key, default)
+
+    def __len__(self):
+        return len(self.items_)
+
+    def __iter__(self):
+        return iter(self.items_)
+
+
+def _merge_key(pair):
+    return ' '.join(pair)
+
+
+def _merge_pair(key):
+    return tuple(key.split(' '))
+
+
+def compiled_vocab_is_stale(compiled_path, source_paths):
+    """
+    :return: True if the compiled vocabulary at `compiled_path` is missing or older than any of `source_paths`.
+    """
+    if not all(os.path.exists(os.path.join(compiled_path, name + '.npy')) for name in VOCAB_ARRAYS):
+        return True
+    compiled_mtime = os.path.getmtime(compiled_path)
+    return any(os.path.getmtime(path) > compiled_mtime for path in source_paths)
+
+
+def compile_vocab(encoder_path, bpe_path, compiled_path):
+    """
+    Converts the json encoder and bpe merges files to a directory of `.npy` arrays that `load_compiled_vocab` can
+    memory-map.  The directory is written atomically, so concurrent processes never observe a partial vocabulary.
+    """
+    encoder = json.load(open(encoder_path))
+    merges = codecs.open(bpe_path, encoding='utf8').read().split('\n')[1:-1]
+    merges = [_merge_key(merge.split()) for merge in merges]
+
+    tokens = np.array(list(encoder.keys()))
+    ids = np.array(list(encoder.values()), dtype=np.int32)
+    token_order = np.argsort(tokens, kind='mergesort')
+    id_order = np.argsort(ids, kind='mergesort')
+
+    merge_keys = np.array(merges)
+    # keep the last rank of a duplicated merge, as dict(zip(merges, range(len(merges)))) does
+    merge_ranks = np.arange(len(merges), dtype=np.int32)
+    merge_order = np.argsort(merge_keys, kind='mergesort')
+    merge_keys = merge_keys[merge_order]
+    merge_ranks = merge_ranks[merge_order]
+    last = np.append(merge_keys[1:] != merge_keys[:-1], True)
+
+    arrays = {
+        'encoder_keys': tokens[token_order],
+        'encoder_values': ids[token_order],
+        'decoder_keys': ids[id_order],
+        'decoder_values': tokens[id_order],
+        'merge_keys': merge_keys[last],
+        'merge_ranks': merge_ranks[last],
+    }
+
+    parent = os.path.dirname(os.path.abspath(compiled_path))
+    tmp_path = tempfile.mkdtemp(dir=parent)
+    try:
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_path, name + '.npy'), array)
+        if os.path.exists(compiled_path):
+            shutil.rmtree(compiled_path)
+        os.rename(tmp_path, compiled_path)
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if compiled_vocab_is_stale(compiled_path, [encoder_path, bpe_path]):
+            raise
+
+
+def load_compiled_vocab(compiled_path):
+    """
+    :return: encoder, decoder and bpe_ranks mappings backed by the memory-mapped arrays in `compiled_path`.
+    """
+    arrays = {
+        name: np.load(os.path.join(compiled_path, name + '.npy'), mmap_mode='r')
+        for name in VOCAB_ARRAYS
+    }
+    encoder = ArrayMapping(arrays['encoder_keys'], arrays['encoder_values'])
+    decoder = ArrayMapping(arrays['decoder_keys'], arrays['decoder_values'])
+    bpe_ranks = ArrayMapping(arrays['merge_keys'], arrays['merge_ranks'], parse_key=_merge_pair)
+    return encoder, decoder, bpe_ranks
+
+
+def get_compiled_vocab(encoder_path, bpe_path, compiled_path):
+    """
+    Loads the compiled vocabulary, compiling it first if it is missing or out of date.
+
+    :return: encoder, decoder and bpe_ranks mappings, or None if the vocabulary could not be compiled.
+    """
+    if compiled_vocab_is_stale(compiled_path, [encoder_path, bpe_path]):
+        try:
+            compile_vocab(encoder_path, bpe_path, compiled_path)
+        except OSError:
+            LOGGER.warning("Unable to write compiled vocabulary to {}".format(compiled_path))
+            return None
+    return load_compiled_vocab(compiled_path)
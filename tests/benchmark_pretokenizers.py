@@ -0,0 +1,40 @@
+"""
+Compares the throughput of the pretokenizer backends on SST, including the time spacy takes to load.
+
+Usage:
+    python tests/benchmark_pretokenizers.py [n_texts]
+"""
+import os
+import sys
+import time
+
+import pandas as pd
+
+from finetune.datasets import generic_download
+from finetune.encoding import _text_standardize
+from finetune.pretokenizers import PRETOKENIZERS
+
+DATASET_PATH = os.path.join('Data', 'Classify', 'SST-binary.csv')
+
+
+def main(n_texts=500):
+    if not os.path.exists(DATASET_PATH):
+        os.makedirs(os.path.dirname(DATASET_PATH), exist_ok=True)
+        generic_download(
+            url="https://s3.amazonaws.com/enso-data/SST-binary.csv",
+            text_column="Text",
+            target_column="Target",
+            filename="SST-binary.csv"
+        )
+    texts = [_text_standardize(text) for text in pd.read_csv(DATASET_PATH, nrows=n_texts).Text]
+    for name, pretokenizer_cls in sorted(PRETOKENIZERS.items()):
+        start = time.time()
+        # a fresh instance, so that load time is included
+        pretokenizer = pretokenizer_cls()
+        for text in texts:
+            pretokenizer(text)
+        print("{}: {:.0f} texts / second".format(name, len(texts) / (time.time() - start)))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
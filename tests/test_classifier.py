@@ -1,11 +1,18 @@
+import itertools
+import json
 import os
 import unittest
 import logging
 import shutil
 import string
+import tempfile
 from copy import copy
+from contextlib import contextmanager, ExitStack
 from pathlib import Path
 from unittest.mock import MagicMock
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import types
 import warnings
 
 # prevent excessive warning logs 
@@ -20,12 +27,29 @@ from sklearn.metrics import accuracy_score, recall_score
 from finetune import Classifier
 from finetune.datasets import generic_download
 from finetune.input_pipeline import ENCODER
+from finetune.encoding import EncodedOutput
+from finetune.model import PredictMode
 from finetune.config import get_config, get_small_model_config
 from finetune.errors import FinetuneError
+from finetune.export import load_exported
+from finetune.batching import MicroBatcher
 
 SST_FILENAME = "SST-binary.csv"
 
 
+@contextmanager
+def override_config(model, **settings):
+    """
+    Changes settings of `model` within the context, restoring their previous values on exit.
+    """
+    previous = {key: model.config[key] for key in settings}
+    model.config.update(settings)
+    try:
+        yield model
+    finally:
+        model.config.update(previous)
+
+
 class TestClassifier(unittest.TestCase):
     n_sample = 20
     n_hidden = 768
@@ -76,6 +100,12 @@ class TestClassifier(unittest.TestCase):
             **kwargs
         )
 
+    def fit_sample_model(self, **kwargs):
+        model = Classifier(config=self.default_config(**kwargs))
+        train_sample = self.dataset.sample(n=self.n_sample)
+        model.fit(train_sample.Text.values, train_sample.Target.values)
+        return model
+
     def test_fit_lm_only(self):
         """
         Ensure LM only training does not error out
@@ -206,6 +236,296 @@ class TestClassifier(unittest.TestCase):
         features = model.featurize(train_sample.Text)
         self.assertEqual(features.shape, (self.n_sample, self.n_hidden))
 
+    def test_dynamic_padding(self):
+        """
+        Ensure length bucketed, dynamically padded batches train, from generators and from in-memory arrays
+        """
+        for in_memory_dataset in [False, True]:
+            model = self.fit_sample_model(
+                dynamic_padding=True, bucket_boundaries=[8, 16, 32], in_memory_dataset=in_memory_dataset
+            )
+            self.assertEqual(len(model.predict(self.dataset.Text[:self.n_sample])), self.n_sample)
+
+    def test_inference_schedules(self):
+        """
+        Ensure settings that only change how inference is batched and run leave its outputs unchanged
+        """
+        model = self.fit_sample_model()
+        # varied lengths, so that sorting and dynamic padding reorder and trim batches
+        texts = [text * (i % 4 + 1) for i, text in enumerate(self.dataset.Text[:self.n_sample])]
+        predictions = list(model.predict(texts))
+        probas = model.predict_proba(texts)
+        features = model.featurize(texts)
+
+        sort_by_length = {"sort_by_length": True, "length_sort_window": 7}
+        schedules = [
+            ("dynamic_padding", {"dynamic_padding": True}, False),
+            ("in_memory_dataset", {"in_memory_dataset": True}, False),
+            ("in_memory_dynamic_padding", {"in_memory_dataset": True, "dynamic_padding": True}, False),
+            ("sort_by_length", sort_by_length, False),
+            ("cached_predict", {}, True),
+            ("cached_sort_by_length", sort_by_length, True),
+        ]
+        for name, settings, cached in schedules:
+            with self.subTest(name), ExitStack() as stack:
+                stack.enter_context(override_config(model, **settings))
+                if cached:
+                    stack.enter_context(model.cached_predict())
+                self.assertEqual(list(model.predict(texts)), predictions)
+                for scheduled_probas, expected_probas in zip(model.predict_proba(texts), probas):
+                    for label in expected_probas:
+                        self.assertAlmostEqual(scheduled_probas[label], expected_probas[label], places=3)
+                np.testing.assert_allclose(model.featurize(texts), features, rtol=1e-4, atol=1e-4)
+
+    def test_tfrecords(self):
+        """
+        Ensure a model can be trained on, and predict from, examples written to TFRecord shards
+        """
+        model = Classifier(config=self.default_config())
+        train_sample = self.dataset.sample(n=self.n_sample)
+        valid_sample = self.dataset.sample(n=self.n_sample)
+        train_records = model.write_tfrecords(
+            'tests/saved-models/train-records', train_sample.Text.values, train_sample.Target.values, n_shards=3
+        )
+        self.assertEqual(len(train_records), self.n_sample)
+        self.assertEqual(len(train_records.files), 3)
+        model.fit(train_records)
+
+        valid_records = model.write_tfrecords('tests/saved-models/valid-records', valid_sample.Text.values, n_shards=2)
+        self.assertEqual(list(model.predict(valid_records)), list(model.predict(valid_sample.Text.values)))
+
+    def test_compact_inputs(self):
+        """
+        Ensure examples are fed as token ids and a length, without positional indices or a mask
+        """
+        model = Classifier(config=self.default_config())
+        features = next(model.input_pipeline.text_to_tokens_mask("A compact example"))
+        self.assertEqual(set(features), {"tokens", "length"})
+        self.assertEqual(features["tokens"].shape, (128,))
+        self.assertEqual(features["tokens"].dtype, np.int32)
+        self.assertTrue(np.all(features["tokens"][features["length"]:] == 0))
+        self.assertTrue(np.all(features["tokens"][:features["length"]] != 0))
+
+    def test_hash_val_split(self):
+        """
+        Ensure generators are split into training and validation sets by a hash of each example
+        """
+        train_sample = self.dataset.sample(n=self.n_sample * 2)
+        texts, targets = list(train_sample.Text), list(train_sample.Target)
+        model = Classifier(config=self.default_config(hash_val_split=True, val_size=10))
+        model.fit(lambda: texts, lambda: targets)
+        self.assertGreater(model.config.val_size, 0)
+        self.assertEqual(model.config.dataset_size, len(texts) - model.config.val_size)
+        val_size = model.config.val_size
+
+        # the split only depends on the text of each example
+        model = Classifier(config=self.default_config(hash_val_split=True, val_size=10))
+        model.fit(lambda: texts[::-1], lambda: targets[::-1])
+        self.assertEqual(model.config.val_size, val_size)
+
+    def test_pack_sequences(self):
+        """
+        Ensure short examples are packed together for language model finetuning
+        """
+        model = Classifier(config=self.default_config(pack_sequences=True))
+        train_sample = self.dataset.sample(n=self.n_sample)
+        examples = itertools.chain.from_iterable(map(model.input_pipeline.text_to_tokens_mask, train_sample.Text))
+        packed = list(model.input_pipeline._pack_sequences(examples))
+        self.assertLess(len(packed), self.n_sample)
+        self.assertEqual(sum(np.sum(seq["positions"][:seq["length"]] == 0) for seq in packed), self.n_sample)
+        model.fit(train_sample.Text)
+
+    def test_auto_max_length(self):
+        """
+        Ensure max_length="auto" chooses a length that fits most of the training data
+        """
+        model = Classifier(config=self.default_config(max_length="auto", max_length_percentile=90))
+        train_sample = self.dataset.sample(n=self.n_sample)
+        model.fit(train_sample.Text.values, train_sample.Target.values)
+        self.assertIsInstance(model.config.max_length, int)
+        self.assertLessEqual(model.config.max_length, 512)
+        lengths = [next(model.input_pipeline.text_to_tokens_mask(text))["length"] for text in train_sample.Text]
+        self.assertGreaterEqual(np.mean(np.array(lengths) < model.config.max_length), 0.5)
+        predictions = model.predict(train_sample.Text.values)
+        self.assertEqual(len(predictions), self.n_sample)
+
+    def test_cached_predict(self):
+        """
+        Ensure calls within cached_predict share one session, which is rebuilt once the model is finetuned again
+        """
+        model = self.fit_sample_model()
+        texts = list(self.dataset.Text[:self.n_sample])
+        with model.cached_predict():
+            model.predict(texts[:1])
+            session = model._cached.predictions
+            model.predict_proba(texts)
+            model.featurize(texts)
+            self.assertIs(model._cached.predictions, session)
+
+            model.fit(texts, list(self.dataset.Target[:self.n_sample]))
+            model.predict(texts[:1])
+            self.assertIsNot(model._cached.predictions, session)
+        self.assertIsNone(model._cached.predictions)
+
+    def test_export(self):
+        """
+        Ensure an exported model makes the same predictions as the model it was exported from
+        """
+        export_path = 'tests/saved-models/exported'
+        model = self.fit_sample_model()
+        model.export(export_path)
+        with self.assertRaises(FinetuneError):
+            model.export(export_path)
+
+        exported = load_exported(export_path)
+        texts = list(self.dataset.sample(n=self.n_sample).Text)
+        self.assertEqual(list(exported.predict(texts)), list(model.predict(texts)))
+        np.testing.assert_allclose(exported.featurize(texts), model.featurize(texts), rtol=1e-4, atol=1e-4)
+        for exported_probas, probas in zip(exported.predict_proba(texts), model.predict_proba(texts)):
+            self.assertEqual(set(exported_probas), set(probas))
+        exported.close()
+
+    def test_micro_batcher(self):
+        """
+        Ensure requests submitted from many threads are batched together and get their own predictions
+        """
+        model = self.fit_sample_model(batch_size=4)
+        texts = list(self.dataset.sample(n=self.n_sample).Text)
+        predictions = model.predict(texts)
+
+        with MicroBatcher(model, max_wait=0.5) as batcher:
+            with ThreadPoolExecutor(max_workers=len(texts)) as pool:
+                futures = list(pool.map(batcher.submit, texts))
+                batched_predictions = [future.result() for future in futures]
+            metrics = batcher.metrics()
+
+        self.assertEqual(batched_predictions, list(predictions))
+        self.assertEqual(metrics["n_requests"], len(texts))
+        self.assertLess(metrics["n_batches"], len(texts))
+        self.assertGreater(metrics["batch_fill"], 0.25)
+        with self.assertRaises(FinetuneError):
+            batcher.submit(texts[0])
+
+    def test_async_predict(self):
+        """
+        Ensure the coroutine APIs match their blocking counterparts when awaited concurrently
+        """
+        model = self.fit_sample_model()
+        texts = list(self.dataset.sample(n=self.n_sample).Text)
+        predictions = model.predict(texts)
+        features = model.featurize(texts)
+
+        async def run():
+            return await asyncio.gather(
+                *[model.apredict([text]) for text in texts],
+                model.apredict_proba(texts),
+                model.afeaturize(texts)
+            )
+
+        results = asyncio.get_event_loop().run_until_complete(run())
+        async_predictions = [preds[0] for preds in results[:len(texts)]]
+        probas, async_features = results[len(texts):]
+        self.assertEqual(async_predictions, list(predictions))
+        self.assertEqual(len(probas), len(texts))
+        np.testing.assert_allclose(async_features, features, rtol=1e-4, atol=1e-4)
+        self.assertLess(model._batchers["predict"].n_batches, len(texts))
+
+        threads = [batcher._thread for batcher in model._batchers.values()]
+        model.close()
+        self.assertFalse(model._batchers)
+        self.assertFalse(any(thread.is_alive() for thread in threads))
+
+    def test_iter_predict(self):
+        """
+        Ensure the generator APIs read their input lazily and match the list APIs
+        """
+        model = self.fit_sample_model()
+        texts = list(self.dataset.sample(n=self.n_sample).Text)
+
+        predictions = model.iter_predict(text for text in texts)
+        self.assertIsInstance(predictions, types.GeneratorType)
+        self.assertEqual(list(predictions), list(model.predict(texts)))
+        self.assertEqual(len(list(model.iter_predict_proba(iter(texts)))), len(texts))
+        features = np.stack(list(model.iter_featurize(iter(texts))))
+        np.testing.assert_allclose(features, model.featurize(texts), rtol=1e-4, atol=1e-4)
+
+    def test_prediction_cache(self):
+        """
+        Ensure cached outputs match the model's, and repeated examples are only run once
+        """
+        model = self.fit_sample_model()
+        texts = list(self.dataset.sample(n=self.n_sample).Text)
+        predictions = model.predict(texts)
+        features = model.featurize(texts)
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            model.config.prediction_cache_mb = 16
+            model.config.prediction_cache_dir = cache_dir
+            try:
+                self.assertEqual(list(model.predict(texts + texts[:5])), list(predictions) + list(predictions[:5]))
+                self.assertEqual(model.prediction_cache.misses, len(set(texts)))
+                self.assertEqual(list(model.predict(texts)), list(predictions))
+                self.assertEqual(model.prediction_cache.hits, len(texts))
+                np.testing.assert_allclose(model.featurize(texts), features, rtol=1e-4, atol=1e-4)
+
+                # entries on disk outlive those in memory
+                model.prediction_cache.clear()
+                self.assertEqual(list(model.predict(texts)), list(predictions))
+                self.assertEqual(model.prediction_cache.hits, len(texts) * 2)
+
+                fingerprint = model._model_fingerprint()
+                # settings that do not change outputs leave the key alone
+                model.config.val_size = 10
+                self.assertEqual(model._model_fingerprint(), fingerprint)
+                model.config.val_size = None
+                model.fit(texts, list(self.dataset.sample(n=self.n_sample).Target))
+                self.assertNotEqual(model._model_fingerprint(), fingerprint)
+            finally:
+                model.config.prediction_cache_mb = 0
+                model.config.prediction_cache_dir = None
+
+    def test_featurize_to_file(self):
+        """
+        Ensure features written to file match featurize, and an interrupted export resumes where it left off
+        """
+        model = Classifier(config=self.default_config())
+        texts = list(self.dataset.Text[:self.n_sample])
+        features = model.featurize(texts)
+        path = "tests/saved-models/features"
+
+        written = model.featurize_to_file(texts, path, include_sequence=True)
+        self.assertEqual(written.dtype, np.float16)
+        np.testing.assert_allclose(written, features, rtol=1e-2, atol=1e-2)
+        offsets = np.load(os.path.join(path, "offsets.npy"))
+        lengths = np.load(os.path.join(path, "lengths.npy"))
+        self.assertEqual(offsets[0], 0)
+        np.testing.assert_array_equal(np.diff(offsets), lengths)
+        sequence_features = np.memmap(
+            os.path.join(path, "sequence_features.bin"), dtype=np.float16, mode="r", shape=(offsets[-1], self.n_hidden)
+        )
+        sequence_features = np.array(sequence_features)
+
+        # pretend the export was interrupted half way through
+        with open(os.path.join(path, "progress.json")) as fp:
+            progress = json.load(fp)
+        progress["n_done"] = self.n_sample // 2
+        progress["n_tokens"] = int(offsets[self.n_sample // 2])
+        with open(os.path.join(path, "progress.json"), "w") as fp:
+            json.dump(progress, fp)
+        with open(os.path.join(path, "sequence_features.bin"), "ab") as fp:
+            fp.write(b"partially written tokens")
+
+        written = model.featurize_to_file(texts, path, include_sequence=True)
+        np.testing.assert_allclose(written, features, rtol=1e-2, atol=1e-2)
+        resumed = np.memmap(
+            os.path.join(path, "sequence_features.bin"), dtype=np.float16, mode="r", shape=(offsets[-1], self.n_hidden)
+        )
+        self.assertEqual(os.path.getsize(os.path.join(path, "sequence_features.bin")), sequence_features.nbytes)
+        np.testing.assert_allclose(resumed, sequence_features, rtol=1e-2, atol=1e-2)
+
+        with self.assertRaises(FinetuneError):
+            model.featurize_to_file(texts[:-1], path, include_sequence=True)
+
     def test_reasonable_predictions(self):
         """
         Ensure model converges to a reasonable solution for a trivial problem
@@ -264,17 +584,58 @@ class TestClassifier(unittest.TestCase):
         self.assertEqual(type(lm_out_2), str)
         self.assertIn('_start_Indico RULE'.lower(), lm_out_2)
 
+    def test_generate_texts(self):
+        """
+        Ensure several seeds decode together with beam search and sampling, and that batching does not change results
+        """
+        model = Classifier(config=self.default_config(lm_temp=0.0))
+        seeds = ["Indico RULE", "", "The market"]
+        greedy = model.generate_texts(seeds, max_length=12)
+        self.assertEqual(greedy, [model.generate_text(seed, max_length=12) for seed in seeds])
+
+        beams = model.generate_texts(seeds, num_beams=3, max_length=12)
+        self.assertEqual(len(beams), len(seeds))
+        for seed, text in zip(seeds, beams):
+            self.assertIn('_start_{}'.format(seed).lower(), text)
+
+        model.config.lm_temp = 0.5
+        sampled = model.generate_texts(seeds, max_length=12, top_k=5)
+        self.assertEqual(len(sampled), len(seeds))
+        self.assertTrue(all(type(text) == str for text in sampled))
+
     def test_early_termination_lm(self):
         model = Classifier(verbose=False)
 
-        # A dirty mock to make all model inferences output a hundred _classify_ tokens
+        # A dirty mock to make the generation graph stop at the first _classify_ token
         fake_estimator = MagicMock()
         model.get_estimator = lambda *args, **kwargs: fake_estimator
-        fake_estimator.predict = MagicMock(return_value=iter([{"GEN_TEXT" :100 * [ENCODER['_classify_']]}]))
+        generated = np.array([ENCODER.start] + 100 * [ENCODER['_classify_']])
+        fake_estimator.predict = MagicMock(return_value=iter([{"GEN_TEXT": generated, "GEN_TEXT_LEN": 2}]))
 
         lm_out = model.generate_text()
         self.assertEqual(lm_out, '_start__classify_')
 
+    def test_cached_generation(self):
+        """
+        Ensure greedy decoding with cached keys and values matches decoding with the full sequence at every step
+        """
+        model = Classifier(config=self.default_config(lm_temp=0.0))
+        n_tokens = 6
+        lm_out = model.generate_text("Indico", max_length=n_tokens)
+
+        token_ids = [ENCODER.start] + ENCODER._encode(["Indico"]).token_ids.tolist()
+        estimator = model.get_estimator(force_build_lm=True)
+        while len(token_ids) < n_tokens and token_ids[-1] != ENCODER.clf_token:
+            arr_encoded = model.input_pipeline._array_format(EncodedOutput(token_ids=token_ids))
+            input_fn = lambda: tf.data.Dataset.from_tensors(
+                {"tokens": arr_encoded.token_ids, "length": np.int32(arr_encoded.length)}
+            ).batch(1)
+            predictions = next(estimator.predict(input_fn=input_fn, predict_keys=PredictMode.GENERATE_TEXT))
+            # the language model output at position i predicts the token at position i + 1
+            token_ids.append(int(predictions[PredictMode.GENERATE_TEXT][len(token_ids) - 1]))
+
+        self.assertEqual(lm_out, ENCODER.decode(token_ids))
+
     def test_validation(self):
         """
         Ensure validation settings do not result in an error
@@ -0,0 +1,221 @@
+import os
+import sys
+import unittest
+import tempfile
+
+import numpy as np
+
+# required for tensorflow logging control
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+from finetune.encoding import TextEncoder, SubTokens, encoded_rows, sliding_windows
+from finetune.encoding_cache import EncodingCache
+from finetune.download import download_data_if_required
+
+
+def _get_pairs(word):
+    return set(zip(word, word[1:]))
+
+
+def reference_bpe(token, bpe_ranks):
+    """
+    Original rescanning byte-pair encoder, kept as a reference for the heap based implementation.
+    """
+    word = tuple(token[:-1]) + (token[-1] + '</w>',)
+    pairs = _get_pairs(word)
+    if not pairs:
+        return token + '</w>'
+
+    while True:
+        bigram = min(pairs, key=lambda pair: bpe_ranks.get(pair, float('inf')))
+        if bigram not in bpe_ranks:
+            break
+        first, second = bigram
+        new_word = []
+        i = 0
+        while i < len(word):
+            try:
+                j = word.index(first, i)
+                new_word.extend(word[i:j])
+                i = j
+            except ValueError:
+                new_word.extend(word[i:])
+                break
+
+            if word[i] == first and i < len(word) - 1 and word[i + 1] == second:
+                new_word.append(first + second)
+                i += 2
+            else:
+                new_word.append(word[i])
+                i += 1
+        word = tuple(new_word)
+        if len(word) == 1:
+            break
+        pairs = _get_pairs(word)
+    word = ' '.join(word)
+    if word == '\n  </w>':
+        word = '\n</w>'
+    return word
+
+
+class TestTextEncoder(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        download_data_if_required()
+
+    def setUp(self):
+        self.encoder = TextEncoder()
+        self.encoder._lazy_init()
+
+    def assertEncodedEqual(self, encoded, expected):
+        for field in expected._fields:
+            value, expected_value = getattr(encoded, field), getattr(expected, field)
+            if isinstance(expected_value, np.ndarray):
+                np.testing.assert_array_equal(value, expected_value)
+            elif isinstance(expected_value, SubTokens):
+                self.assertEqual(list(value), list(expected_value))
+            else:
+                self.assertEqual(value, expected_value)
+
+    def test_bpe_matches_reference(self):
+        words = [
+            "the", "quick", "brown", "fox", "antidisestablishmentarianism", "aaaaaaaa", "abababab",
+            "mississippi", "finetune", "x", "\n", "supercalifragilisticexpialidocious", "1234567890"
+        ]
+        for word in words:
+            self.assertEqual(self.encoder.bpe(word), reference_bpe(word, self.encoder.bpe_ranks))
+
+    def test_bpe_cache_bounded(self):
+        encoder = TextEncoder(cache_size=2)
+        encoder._lazy_init()
+        for word in ["one", "two", "three", "one"]:
+            encoder.bpe(word)
+        info = encoder.cache_info()
+        self.assertEqual(info.currsize, 2)
+        self.assertEqual(info.misses, 4)
+        encoder.bpe("one")
+        self.assertEqual(encoder.cache_info().hits, 1)
+
+    def test_compiled_vocab(self):
+        encoder = TextEncoder(use_compiled_vocab=False)
+        encoder._lazy_init()
+        self.assertNotIsInstance(self.encoder.encoder, dict)
+        self.assertEqual(self.encoder.vocab_size, encoder.vocab_size)
+        for token in ["the</w>", "dog</w>", "_start_", "_classify_", "not-a-token"]:
+            self.assertEqual(self.encoder.encoder.get(token), encoder.encoder.get(token))
+        for idx in [0, 1, 1000, encoder.vocab_size - 1, encoder.vocab_size]:
+            self.assertEqual(self.encoder.decoder.get(idx), encoder.decoder.get(idx))
+        for pair in list(encoder.bpe_ranks)[::1000] + [("no", "merge")]:
+            self.assertEqual(self.encoder.bpe_ranks.get(pair), encoder.bpe_ranks.get(pair))
+        texts = ["I am a dog.", "A dog that's incredibly bright!"]
+        self.assertEncodedEqual(self.encoder._encode(texts), encoder._encode(texts))
+
+    def test_pretokenize(self):
+        texts = ["I am a dog.", "A dog that's incredibly bright!", "I can talk, read, and write"]
+        expected = self.encoder._encode(texts)
+        pretokenized = self.encoder.pretokenize(texts, batch_size=2)
+        self.assertEncodedEqual(self.encoder._encode(texts, pretokenized=pretokenized), expected)
+        reversed_rows = encoded_rows(self.encoder._encode(texts[::-1], pretokenized=pretokenized))
+        for row, expected_row in zip(reversed_rows, encoded_rows(expected)[::-1]):
+            self.assertEncodedEqual(row, expected_row)
+
+    def test_encode_arrays(self):
+        texts = ["I am a dog.", "", "A dog that's incredibly bright!"]
+        encoded = self.encoder._encode(texts, labels=["a", "b", "c"])
+        self.assertEqual(encoded.token_ids.dtype, np.int32)
+        self.assertEqual(encoded.char_locs.dtype, np.int32)
+        self.assertEqual(encoded.offsets[0], 0)
+        self.assertEqual(encoded.offsets[-1], len(encoded.token_ids))
+        rows = encoded_rows(encoded)
+        self.assertEqual(len(rows[1].token_ids), 0)
+        self.assertEqual(rows[2].labels, ["c"] * len(rows[2].token_ids))
+        self.assertEqual(
+            list(rows[0].tokens), [self.encoder.decoder[idx] for idx in rows[0].token_ids]
+        )
+        self.assertIsInstance(rows[0].tokens[1:], SubTokens)
+
+        multi = self.encoder.encode_multi_input([texts[:1], texts[2:]], max_length=8)
+        self.assertEqual(len(multi.token_ids), 8)
+        self.assertEqual(multi.token_ids[0], self.encoder.start)
+        self.assertEqual(multi.token_ids[-1], self.encoder.clf_token)
+        self.assertEqual(multi.char_locs[0], -1)
+
+        # substituted characters must not throw off the label of their text
+        texts = ["A dash — at last — here", "No dash", "Another dash — or two —", "Done"]
+        encoded = self.encoder._encode(texts, labels=["a", "b", "c", "d"])
+        for row, label in zip(encoded_rows(encoded), ["a", "b", "c", "d"]):
+            self.assertEqual(row.labels, [label] * len(row.token_ids))
+
+    def test_subtokens(self):
+        encoded = self.encoder._encode(["A dash — and an ellipsis…"])
+        self.assertIn("—</w>", list(encoded.tokens))
+        self.assertEqual(list(encoded.tokens[1:]), list(encoded.tokens)[1:])
+        multi = self.encoder.encode_multi_input([["A dash — here"]], max_length=16)
+        self.assertIn("—</w>", list(multi.tokens))
+
+        self.encoder["_extra_"] = self.encoder.vocab_size
+        ids = np.array([self.encoder.start, self.encoder["_extra_"]], dtype=np.int32)
+        self.assertEqual(list(self.encoder.subtokens(ids)), ["_start_", "_extra_"])
+
+    def test_encode_windows(self):
+        segments = [" ".join(["The quick brown fox jumped over the lazy dog."] * 20), "Woof, woof!\n\nWoof."]
+        labels = ["a", "b"]
+        expected = list(sliding_windows(
+            self.encoder.encode_multi_input([segments], Y=labels, max_length=sys.maxsize), 30, 10
+        ))
+        windows = list(self.encoder.encode_windows(segments, Y=labels, window_size=30, step_size=10, piece_size=50))
+        self.assertEqual(len(windows), len(expected))
+        for window, expected_window in zip(windows, expected):
+            self.assertEncodedEqual(window, expected_window)
+
+        # segments with substituted characters keep their own labels
+        segments = ["A dash — at last — here", "No dash", "Another dash — or two — and more", "Done — done"]
+        labels = ["a", "b", "c", "d"]
+        windows = list(self.encoder.encode_windows(segments, Y=labels, window_size=100, step_size=30, piece_size=50))
+        expected_labels = ["<PAD>"]
+        for segment, label in zip(segments, labels):
+            expected_labels.extend([label] * len(self.encoder._encode([segment]).token_ids))
+        self.assertEqual(list(windows[0].labels[:len(expected_labels)]), expected_labels)
+
+    def test_regex_pretokenizer(self):
+        texts = ["I am a dog.", "A dog that's incredibly bright!", "I can't talk -- read, and write"]
+        encoder = TextEncoder(pretokenizer='regex')
+        self.assertEncodedEqual(encoder._encode(texts), self.encoder._encode(texts))
+        self.assertNotEqual(encoder.fingerprint, self.encoder.fingerprint)
+
+        variant = self.encoder.with_pretokenizer('regex')
+        self.assertIs(variant.encoder, self.encoder.encoder)
+        self.assertIs(self.encoder.with_pretokenizer('regex'), variant)
+        self.assertEqual(variant.fingerprint, encoder.fingerprint)
+        self.assertEqual(self.encoder.pretokenizer_name, 'spacy')
+        self.assertEncodedEqual(variant._encode(texts), encoder._encode(texts))
+
+    def test_encode_batch(self):
+        examples = [[["I am a dog."]], [["A dog that's incredibly bright!", "Woof."]], [["I can talk"], ["and write"]]]
+        expected = [self.encoder.encode_multi_input(Xs, max_length=16) for Xs in examples]
+        encoded = self.encoder.encode_batch(examples * 4, max_length=16, n_jobs=2)
+        self.assertEqual(len(encoded), len(expected) * 4)
+        for encoded_example, expected_example in zip(encoded, expected * 4):
+            self.assertEncodedEqual(encoded_example, expected_example)
+
+    def test_encoding_cache(self):
+        examples = [[["I am a dog — woof!", "Woof!"]], [["A dog that's incredibly bright!"], [""]]]
+        labels = [["a", "b"], ["c"]]
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = EncodingCache(cache_dir, self.encoder.fingerprint)
+            for Xs, Y in zip(examples, labels):
+                expected = self.encoder.encode_multi_input(Xs, Y=Y if len(Xs) == 1 else None, max_length=8)
+                for _ in range(2):
+                    encoded = self.encoder.encode_multi_input(
+                        Xs, Y=Y if len(Xs) == 1 else None, max_length=8, cache=cache
+                    )
+                    self.assertEncodedEqual(encoded, expected)
+            self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+            other = EncodingCache(cache_dir, "another encoder")
+            self.assertIsNone(other.get(examples[0]))
+
+
+if __name__ == '__main__':
+    unittest.main()
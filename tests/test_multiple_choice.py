@@ -1,11 +1,14 @@
 import os
+import asyncio
 import unittest
 import logging
 from copy import copy
 from pathlib import Path
 import codecs
 import json
+import tempfile
 
+import numpy as np
 import tensorflow as tf
 # required for tensorflow logging control
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
@@ -46,3 +49,26 @@ class TestQuestionAnswer(unittest.TestCase):
 
         self.assertEqual(["orange"], model.predict(["Dog, cat, fish, orange, what is the odd one out?"],
                                                    [["orange", "Dog", "fish", "cat"]]))
+
+    def test_featurize_to_file(self):
+        model = MultipleChoice(max_length=64)
+        questions = ["Dog, cat, fish, orange, what is the odd one out?", "Boat, car, chicken, what is the odd one out?"]
+        answers = [["orange", "Dog", "fish", "cat"], ["chicken", "Boat", "car", "train"]]
+        features = model.featurize(questions, answers)
+        with tempfile.TemporaryDirectory() as path:
+            written = model.featurize_to_file(questions, answers, path, dtype=np.float32, include_sequence=True)
+            np.testing.assert_allclose(written, features, rtol=1e-4, atol=1e-4)
+            # the tokens of every answer are kept, each counted separately
+            lengths = np.load(os.path.join(path, "lengths.npy"))
+            offsets = np.load(os.path.join(path, "offsets.npy"))
+            self.assertEqual(lengths.shape, (2, 4))
+            np.testing.assert_array_equal(np.diff(offsets), lengths.sum(axis=1))
+
+    def test_async_featurize(self):
+        questions = ["Dog, cat, fish, orange, what is the odd one out?", "Boat, car, chicken, what is the odd one out?"]
+        answers = [["orange", "Dog", "fish", "cat"], ["chicken", "Boat", "car", "train"]]
+        with MultipleChoice(max_length=64) as model:
+            # featurize needs no finetuning, and takes its arguments through the same batching as predict
+            features = model.featurize(questions, answers)
+            async_features = asyncio.get_event_loop().run_until_complete(model.afeaturize(questions, answers))
+            np.testing.assert_allclose(async_features, features, rtol=1e-4, atol=1e-4)
@@ -0,0 +1,83 @@
+import os
+import json
+import unittest
+from pathlib import Path
+
+# required for tensorflow logging control
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+import pandas as pd
+
+from finetune.datasets import generic_download
+from finetune.encoding import _text_standardize
+from finetune.pretokenizers import get_pretokenizer
+from finetune.errors import FinetuneError
+
+SST_FILENAME = "SST-binary.csv"
+
+
+class TestPretokenizers(unittest.TestCase):
+    n_sample = 500
+    dataset_path = os.path.join(
+        'Data', 'Classify', 'SST-binary.csv'
+    )
+    testdata_path = os.path.join(os.path.dirname(__file__), 'testdata.json')
+
+    @classmethod
+    def _download_sst(cls):
+        """
+        Download Stanford Sentiment Treebank to data directory
+        """
+        path = Path(cls.dataset_path)
+        if path.exists():
+            return
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        generic_download(
+            url="https://s3.amazonaws.com/enso-data/SST-binary.csv",
+            text_column="Text",
+            target_column="Target",
+            filename=SST_FILENAME
+        )
+
+    @classmethod
+    def setUpClass(cls):
+        cls._download_sst()
+        with open(cls.testdata_path) as fp:
+            cls.testdata = json.load(fp)[0]
+        cls.sst = list(pd.read_csv(cls.dataset_path, nrows=cls.n_sample).Text)
+        cls.spacy = get_pretokenizer('spacy')
+        cls.regex = get_pretokenizer('regex')
+
+    def boundaries(self, pretokenizer, text):
+        return [(token.text, token.idx) for token in pretokenizer(text)]
+
+    def test_matches_spacy_on_test_data(self):
+        texts = self.testdata + [
+            "I can't believe it's not butter.",
+            "Well-known authors (e.g. Orwell) wrote in English...",
+            "  Leading and trailing whitespace \n with a newline  ",
+        ]
+        for text in texts + [_text_standardize(text) for text in texts]:
+            self.assertEqual(self.boundaries(self.regex, text), self.boundaries(self.spacy, text))
+
+    def test_agrees_with_spacy(self):
+        """
+        Raw and standardized SST sentences should be split into the same tokens as spacy, up to rare special cases.
+        """
+        texts = self.sst + [_text_standardize(text) for text in self.sst]
+        n_agree = sum(self.boundaries(self.regex, text) == self.boundaries(self.spacy, text) for text in texts)
+        self.assertGreaterEqual(n_agree / len(texts), 0.99)
+
+    def test_offsets(self):
+        for text in self.sst:
+            for token in self.regex(text):
+                self.assertEqual(text[token.idx:token.idx + len(token.text)], token.text)
+
+    def test_unknown_pretokenizer(self):
+        with self.assertRaises(FinetuneError):
+            get_pretokenizer('unknown')
+
+
+if __name__ == '__main__':
+    unittest.main()
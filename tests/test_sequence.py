@@ -185,6 +185,30 @@ class TestSequenceLabeler(unittest.TestCase):
         self.assertEqual(len(predictions[0]), 20)
         self.assertTrue(any(pred["text"] == "dog" for pred in predictions[0]))
 
+        streamed_predictions = list(self.model.iter_predict(iter(test_sequence * 3)))
+        self.assertEqual(streamed_predictions, predictions * 3)
+
+        self.model.config.sort_by_length = True
+        sorted_predictions = self.model.predict(["I am a dog."] + test_sequence)
+        self.assertEqual(
+            [(pred["text"], pred["label"]) for pred in sorted_predictions[1]],
+            [(pred["text"], pred["label"]) for pred in predictions[0]]
+        )
+
+    def test_dynamic_padding(self):
+        """
+        Ensure dynamically padded batches of sequence labels train and predict
+        """
+        self.model.config.dynamic_padding = True
+        raw_docs = ["".join(text) for text in self.texts]
+        texts, annotations = finetune_to_indico_sequence(raw_docs, self.texts, self.labels)
+        train_texts, test_texts, train_annotations, test_annotations = train_test_split(texts, annotations, test_size=0.1)
+        self.model.fit(train_texts, train_annotations)
+        predictions = self.model.predict(test_texts)
+        self.assertEqual(len(predictions), len(test_texts))
+        token_recall = sequence_labeling_token_recall(test_annotations, predictions)
+        self.assertIn('Named Entity', token_recall)
+
     def test_fit_predict_multi_model(self):
         """
         Ensure model training does not error out